@@ -5,6 +5,7 @@ from . import model
 from . import isophote
 from . import galfit
 from . import catalog
+from . import convolution
 from . import detection
 from . import imtools
 from . import utils
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Convolve images with small and large kernels."""
+
+import os
+import hashlib
+import collections
+import concurrent.futures
+
+import numpy as np
+
+from scipy import fft
+from scipy import ndimage
+
+__all__ = ['gaussian_kernel_1d', 'separate_kernel', 'Convolver', 'get_convolver',
+           'convolve_image']
+
+
+def gaussian_kernel_1d(sigma, truncate=4.0):
+    """Normalized 1-D Gaussian kernel, the same as `ndimage.gaussian_filter1d`.
+
+    Parameters
+    ----------
+    sigma: float
+        Sigma of the Gaussian, in pixel.
+    truncate: float, optional
+        Truncate the kernel at this many sigma. Default: 4.0
+
+    Return
+    ------
+        The kernel, with 2 * int(truncate * sigma + 0.5) + 1 elements.
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / float(sigma)) ** 2)
+
+    return kernel / kernel.sum()
+
+
+def separate_kernel(kernel, rtol=1E-6):
+    """Split a 2-D kernel into the outer product of two 1-D kernels.
+
+    Parameters
+    ----------
+    kernel: 2-D array
+        The kernel.
+    rtol: float, optional
+        Largest relative difference between the kernel and the product.
+        Default: 1E-6
+
+    Return
+    ------
+        The kernels along y and x, or None if the kernel is not separable.
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    u_vec, s_val, vh_vec = np.linalg.svd(kernel)
+    k_y = u_vec[:, 0] * np.sqrt(s_val[0])
+    k_x = vh_vec[0] * np.sqrt(s_val[0])
+
+    if np.abs(np.outer(k_y, k_x) - kernel).max() > rtol * np.abs(kernel).max():
+        return None
+
+    return k_y, k_x
+
+
+def _n_workers(workers):
+    """Number of threads, negative values count back from the number of CPUs."""
+    n_cpu = os.cpu_count() or 1
+    if workers is None:
+        return 1
+
+    return max(workers if workers > 0 else n_cpu + 1 + workers, 1)
+
+
+class Convolver(object):
+    """Convolve images with a kernel, with the fastest method for its size.
+
+    The methods are:
+
+        - 'separable': one 1-D convolution along each axis, for Gaussian
+          kernels and other kernels that are the outer product of two 1-D
+          kernels. The cost per pixel is the sum of the two kernel sizes.
+        - 'direct': `ndimage.convolve`, for small kernels.
+        - 'fft': one FFT of the whole image, for large kernels.
+        - 'overlap-save': FFT of blocks of the image, for large kernels on
+          large images. Each block is the size of the FFT minus the kernel
+          size, and overlaps the next block by the kernel size, like the
+          overlap-add method but writing each block straight into the output.
+
+    The 'auto' method picks 'separable' when the kernel is separable and the
+    sum of the sizes is at most `max_separable`, 'direct' for kernels with at
+    most `max_direct` pixels, 'fft' when the image is at most twice the block
+    size of 'overlap-save', and 'overlap-save' otherwise. With one CPU, the
+    FFT of a 2000 x 2000 float32 image takes about as long as the separable
+    convolution with a Gaussian of sigma=3, or the direct one with a 4 x 4
+    kernel. The blocks of 'overlap-save' use less memory than the FFT of the
+    whole image, for the same time.
+
+    All the methods give the same result as `ndimage.convolve` with the
+    'reflect' mode, which is also the mode of `ndimage.gaussian_filter`. The
+    images are converted to `dtype`, float32 by default. The FFT of the kernel
+    is cached for each FFT shape, so it is only computed once for images of
+    the same shape. The FFTs use `workers` threads, and the other methods
+    split the image into strips of rows for the threads.
+
+    """
+    def __init__(self, kernel=None, sigma=None, truncate=4.0, method='auto',
+                 dtype=np.float32, workers=-1, max_separable=48, max_direct=16,
+                 block_size=1024):
+        """Constructor.
+
+        Parameters
+        ----------
+        kernel: 2-D array, optional
+            The kernel. Either `kernel` or `sigma` is needed.
+        sigma: float or tuple, optional
+            Sigma of a Gaussian kernel, or (sigma_y, sigma_x), in pixel.
+        truncate: float, optional
+            Truncate the Gaussian kernel at this many sigma. Default: 4.0
+        method: str, optional
+            'auto', 'separable', 'direct', 'fft' or 'overlap-save'.
+            Default: 'auto'
+        dtype: numpy dtype, optional
+            Data type of the convolution. Default: np.float32
+        workers: int, optional
+            Number of threads, negative values count back from the number of
+            CPUs. Default: -1, all the CPUs
+        max_separable: int, optional
+            Largest sum of the sizes of the 1-D kernels for the 'separable'
+            method. Default: 48
+        max_direct: int, optional
+            Largest number of pixels of the kernel for the 'direct' method.
+            Default: 16
+        block_size: int, optional
+            Smallest FFT size of the blocks of 'overlap-save'. Default: 1024
+        """
+        if sigma is not None:
+            sig_y, sig_x = np.broadcast_to(np.asarray(sigma, dtype=float), (2,))
+            self.kernels_1d = (gaussian_kernel_1d(sig_y, truncate=truncate),
+                               gaussian_kernel_1d(sig_x, truncate=truncate))
+            kernel = np.outer(*self.kernels_1d)
+        elif kernel is not None:
+            kernel = np.asarray(kernel, dtype=np.float64)
+            self.kernels_1d = separate_kernel(kernel)
+        else:
+            raise Exception("# Need either kernel or sigma!")
+
+        self.kernel = kernel
+        self.dtype = np.dtype(dtype)
+        self.workers = workers
+
+        if method == 'auto':
+            if (self.kernels_1d is not None and
+                    len(self.kernels_1d[0]) + len(self.kernels_1d[1]) <= max_separable):
+                method = 'separable'
+            elif kernel.size <= max_direct:
+                method = 'direct'
+        elif method == 'separable' and self.kernels_1d is None:
+            raise Exception("# The kernel is not separable!")
+        elif method not in ('separable', 'direct', 'fft', 'overlap-save'):
+            raise Exception("# Wrong choice of convolution method!")
+        self.method = method
+
+        # FFT shape of the blocks
+        self.block_fft = tuple(
+            fft.next_fast_len(max(block_size, 4 * size), real=True) for size in kernel.shape)
+
+        self._cache = {}
+
+    @property
+    def shape(self):
+        """Shape of the kernel."""
+        return self.kernel.shape
+
+    def kernel_fft(self, shape):
+        """FFT of the zero-padded kernel, see `mock.PSFConvolver`."""
+        if shape not in self._cache:
+            self._cache[shape] = fft.rfft2(
+                self.kernel.astype(self.dtype), s=shape, workers=_n_workers(self.workers))
+
+        return self._cache[shape]
+
+    def method_for(self, shape):
+        """Method for an image shape."""
+        if self.method != 'auto':
+            return self.method
+        block = [n_fft - size + 1 for n_fft, size in zip(self.block_fft, self.shape)]
+        if shape[0] <= 2 * block[0] and shape[1] <= 2 * block[1]:
+            return 'fft'
+
+        return 'overlap-save'
+
+    def _strips(self, func, img, out):
+        """Run an ndimage filter on strips of rows in threads."""
+        n_strip = min(_n_workers(self.workers), max(img.shape[0] // 64, 1))
+        if n_strip == 1:
+            func(img, out)
+            return out
+
+        halo = self.shape[0]
+        bounds = np.linspace(0, img.shape[0], n_strip + 1).astype(int)
+
+        def run(ii):
+            row_0, row_1 = bounds[ii], bounds[ii + 1]
+            pad_0, pad_1 = max(row_0 - halo, 0), min(row_1 + halo, img.shape[0])
+            strip = np.empty((pad_1 - pad_0, img.shape[1]), dtype=out.dtype)
+            func(img[pad_0:pad_1], strip)
+            out[row_0:row_1] = strip[row_0 - pad_0:row_1 - pad_0]
+
+        with concurrent.futures.ThreadPoolExecutor(n_strip) as pool:
+            list(pool.map(run, range(n_strip)))
+
+        return out
+
+    def _separable(self, img, out):
+        """Two 1-D convolutions."""
+        k_y, k_x = [k.astype(self.dtype) for k in self.kernels_1d]
+
+        def func(data, result):
+            ndimage.convolve1d(data, k_y, axis=0, output=result, mode='reflect')
+            ndimage.convolve1d(result, k_x, axis=1, output=result, mode='reflect')
+
+        return self._strips(func, img, out)
+
+    def _direct(self, img, out):
+        """Direct 2-D convolution."""
+        kernel = self.kernel.astype(self.dtype)
+
+        def func(data, result):
+            ndimage.convolve(data, kernel, output=result, mode='reflect')
+
+        return self._strips(func, img, out)
+
+    def _fft(self, img, out, block=None):
+        """Convolution with FFTs of blocks of the padded image.
+
+        Output pixel i is the pixel i + k - 1 of the linear convolution of the
+        image padded by k - 1 - k // 2 pixels before and k // 2 pixels after,
+        for a kernel size k along each axis, which is `ndimage.convolve`.
+        """
+        k_y, k_x = self.shape
+        padded = np.pad(img, ((k_y - 1 - k_y // 2, k_y // 2),
+                              (k_x - 1 - k_x // 2, k_x // 2)), mode='symmetric')
+
+        if block is None:
+            block = img.shape
+            fft_shape = tuple(fft.next_fast_len(n + k - 1, real=True)
+                              for n, k in zip(block, self.shape))
+        else:
+            fft_shape = self.block_fft
+        kernel_fft = self.kernel_fft(fft_shape)
+        workers = _n_workers(self.workers)
+
+        # One row of blocks at a time, in one batch of FFTs
+        for row in range(0, img.shape[0], block[0]):
+            n_row = min(block[0], img.shape[0] - row)
+            cols = list(range(0, img.shape[1], block[1]))
+            stack = np.zeros((len(cols),) + fft_shape, dtype=self.dtype)
+            for jj, col in enumerate(cols):
+                chunk = padded[row:row + n_row + k_y - 1, col:col + block[1] + k_x - 1]
+                stack[jj, :chunk.shape[0], :chunk.shape[1]] = chunk
+            conv = fft.irfft2(fft.rfft2(stack, workers=workers) * kernel_fft,
+                              s=fft_shape, workers=workers)
+            for jj, col in enumerate(cols):
+                n_col = min(block[1], img.shape[1] - col)
+                out[row:row + n_row, col:col + n_col] = conv[
+                    jj, k_y - 1:k_y - 1 + n_row, k_x - 1:k_x - 1 + n_col]
+
+        return out
+
+    def __call__(self, img, out=None):
+        """Convolve an image.
+
+        Parameters
+        ----------
+        img: 2-D array
+            The image.
+        out: 2-D array, optional
+            Output array with the `dtype` of the convolver. It can not be the
+            input image. Default: None, a new array
+
+        Return
+        ------
+            The convolved image.
+        """
+        img = np.ascontiguousarray(img, dtype=self.dtype)
+        if out is None:
+            out = np.empty(img.shape, dtype=self.dtype)
+
+        method = self.method_for(img.shape)
+        if method == 'separable':
+            return self._separable(img, out)
+        elif method == 'direct':
+            return self._direct(img, out)
+        elif method == 'fft':
+            return self._fft(img, out)
+
+        return self._fft(img, out, block=tuple(
+            n_fft - size + 1 for n_fft, size in zip(self.block_fft, self.shape)))
+
+
+# Recently used convolvers, see `get_convolver`
+_CONVOLVERS = collections.OrderedDict()
+_MAX_CONVOLVERS = 8
+
+
+def get_convolver(kernel=None, sigma=None, **kwargs):
+    """Get a `Convolver`, reusing a recent one with the same kernel and settings.
+
+    Parameters
+    ----------
+    kernel: 2-D array, optional
+        The kernel.
+    sigma: float or tuple, optional
+        Sigma of a Gaussian kernel, in pixel.
+    **kwargs:
+        Other parameters of `Convolver`.
+
+    Return
+    ------
+        The `Convolver` object.
+    """
+    if kernel is not None:
+        kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+        kernel_key = (kernel.shape, hashlib.sha1(kernel).hexdigest())
+    else:
+        kernel_key = tuple(np.broadcast_to(np.asarray(sigma, dtype=float), (2,)))
+    key = (kernel_key, tuple(sorted(
+        (name, str(value)) for name, value in kwargs.items())))
+
+    if key in _CONVOLVERS:
+        _CONVOLVERS.move_to_end(key)
+    else:
+        _CONVOLVERS[key] = Convolver(kernel=kernel, sigma=sigma, **kwargs)
+        if len(_CONVOLVERS) > _MAX_CONVOLVERS:
+            _CONVOLVERS.popitem(last=False)
+
+    return _CONVOLVERS[key]
+
+
+def convolve_image(img, kernel=None, sigma=None, out=None, **kwargs):
+    """Convolve an image with a kernel or a Gaussian, see `Convolver`.
+
+    Parameters
+    ----------
+    img: 2-D array
+        The image.
+    kernel: 2-D array, optional
+        The kernel. Either `kernel` or `sigma` is needed.
+    sigma: float or tuple, optional
+        Sigma of a Gaussian kernel, or (sigma_y, sigma_x), in pixel.
+    out: 2-D array, optional
+        Output array. Default: None, a new array
+    **kwargs:
+        Other parameters of `Convolver`, e.g. `method`, `dtype` and `workers`.
+
+    Return
+    ------
+        The convolved image, float32 by default.
+    """
+    return get_convolver(kernel=kernel, sigma=sigma, **kwargs)(img, out=out)
@@ -3,6 +3,7 @@
 """Detect objects on the image."""
 
 import copy
+import functools
 
 import numpy as np
 import scipy.stats as st
@@ -16,6 +17,7 @@ from astropy.table import Table, Column
 import sep
 
 from kungpao.imtools import *
+from kungpao.imtools import _copy_image
 
 
 __all__ = ['sep_detection', 'simple_convolution_kernel', 'get_gaussian_kernel',
@@ -140,6 +142,19 @@ def get_gaussian_kernel(img_size, sig, theta=0.0, return_array=False, **kwargs):
     return kernal
 
 
+@functools.lru_cache(maxsize=16)
+def _detection_kernel(kernel):
+    """Read-only kernel of `sep_detection`, built once for each choice."""
+    if isinstance(kernel, int):
+        filter_kernel = simple_convolution_kernel(kernel)
+    else:
+        img_size, sig = [list(arg) if isinstance(arg, tuple) else arg for arg in kernel]
+        filter_kernel = get_gaussian_kernel(img_size, sig, return_array=True)
+    filter_kernel.flags.writeable = False
+
+    return filter_kernel
+
+
 def sep_detection(img, threshold, kernel=4, err=None, use_sig=True,
                   subtract_bkg=True, return_bkg=True, return_seg=True,
                   bkg_kwargs=None, **det_kwargs):
@@ -154,13 +169,17 @@ def sep_detection(img, threshold, kernel=4, err=None, use_sig=True,
 
     """
     # Determine the kernel used in detection
-    if isinstance(kernel, int):
-        filter_kernel = simple_convolution_kernel(kernel)
+    if isinstance(kernel, (int, np.integer)):
+        filter_kernel = _detection_kernel(int(kernel))
     elif isinstance(kernel, (list, tuple, np.ndarray)):
-        filter_kernel = get_gaussian_kernel(kernel[0], kernel[1])
+        filter_kernel = _detection_kernel(tuple(
+            tuple(arg) if isinstance(arg, (list, np.ndarray)) else arg
+            for arg in list(kernel)[:2]))
     else:
         raise Exception("Wrong choice for convolution kernel")
 
+    img, err = prepare_image(img), prepare_image(err)
+
     # Estimate background, subtract it if necessary
     if bkg_kwargs is not None:
         bkg, rms = img_measure_background(img, use_sep=True, **bkg_kwargs)
@@ -227,6 +246,7 @@ def detect_high_sb_objects(img, sig, threshold=30.0, min_area=100, mask=None,
     2:  > 15 sigma, size > 10000
     '''
     # Object detection: high threshold, relative small minimum size
+    img, sig = prepare_image(img), prepare_image(sig)
     obj_hsig, seg_hsig = sep.extract(img, threshold, err=sig,
                                      minarea=min_area, mask=mask,
                                      deblend_nthresh=deb_thr_hsig,
@@ -234,12 +254,10 @@ def detect_high_sb_objects(img, sig, threshold=30.0, min_area=100, mask=None,
                                      segmentation_map=True)
 
     # Remove objects with low peak surface brightness
-    idx_low_peak_mu = []
     obj_hsig = Table(obj_hsig)
-    for idx, obj in enumerate(obj_hsig):
-        if obj_peak_mu(obj) >= mu_limit:
-            seg_hsig[seg_hsig == (idx + 1)] = 0
-            idx_low_peak_mu.append(idx)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        idx_low_peak_mu = np.flatnonzero(obj_peak_mu(obj_hsig) >= mu_limit)
+    SegmentationMap(seg_hsig, copy=False).remove(idx_low_peak_mu + 1)
 
     obj_hsig.remove_rows(idx_low_peak_mu)
 
@@ -258,6 +276,7 @@ def detect_low_sb_objects(img, threshold, sig, msk_hsig_1, msk_hsig_2, noise,
                           deb_cont_lsig=0.001, frac_mask=0.2, verbose=False):
     """Detect all the low threshold pixels."""
     # Detect the low sigma pixels on the image
+    img, sig = prepare_image(img), prepare_image(sig)
     obj_lsig, seg_lsig = sep.extract(img, threshold, err=sig,
                                      minarea=minarea, mask=mask,
                                      deblend_nthresh=deb_thr_lsig,
@@ -274,38 +293,26 @@ def detect_low_sb_objects(img, threshold, sig, msk_hsig_1, msk_hsig_2, noise,
     y_mid = (obj_lsig['ymin'] + obj_lsig['ymax']) / 2.0
 
     # Remove the LSB objects whose center fall on the high-threshold mask
-    seg_lsig_clean = copy.deepcopy(seg_lsig)
+    seg_lsig_clean = SegmentationMap(seg_lsig, copy=False)
     obj_lsig_clean = copy.deepcopy(obj_lsig)
-    img_lsig_clean = copy.deepcopy(img)
-
-    idx_remove = []
-    for idx, obj in enumerate(obj_lsig):
-        # xcen, ycen = int(obj['y']), int(obj['x'])
-        xmid, ymid = int(y_mid[idx]), int(x_mid[idx])
-        msk_hsig = (msk_hsig_1 | msk_hsig_2)
-        if (msk_hsig[xmid, ymid] > 0):
-            # Replace the segement with zero
-            seg_lsig_clean[seg_lsig == (idx + 1)] = 0
-            # Replace the image with noise
-            img_lsig_clean[seg_lsig == (idx + 1)] = noise[seg_lsig == (idx + 1)]
-            # Remove the object
-            idx_remove.append(idx)
+    img_lsig_clean = _copy_image(img)
+
+    msk_hsig = (msk_hsig_1 | msk_hsig_2)
+    idx_remove = np.flatnonzero(
+        msk_hsig[np.asarray(y_mid).astype(int), np.asarray(x_mid).astype(int)] > 0)
+    # Replace the image with noise, and the segement with zero
+    seg_lsig_clean.replace(img_lsig_clean, noise, idx_remove + 1)
+    seg_lsig_clean.remove(idx_remove + 1)
 
     obj_lsig_clean.remove_rows(idx_remove)
 
     # Remove LSB objects whose segments overlap with the high-threshold mask
-    frac_msk = np.asarray([(msk_hsig_1[seg_lsig_clean == idx]).sum() /
-                           np.asarray([seg_lsig_clean == idx]).sum()
-                           for idx in obj_lsig_clean['index']])
-
-    idx_overlap = []
-    for index, idx in enumerate(obj_lsig_clean['index']):
-        if frac_msk[index] >= frac_mask:
-            # Replace the segement with zero
-            seg_lsig_clean[seg_lsig == idx] = 0
-            # Replace the image with noise
-            img_lsig_clean[seg_lsig == idx] = noise[seg_lsig == idx]
-            # Remove the object
-            idx_overlap.append(index)
-
-    return seg_lsig_clean, img_lsig_clean
+    frac_msk = seg_lsig_clean.overlap(msk_hsig_1)[obj_lsig_clean['index']]
+
+    with np.errstate(invalid='ignore'):
+        idx_overlap = np.asarray(obj_lsig_clean['index'])[frac_msk >= frac_mask]
+    seg_lsig_clean.replace(img_lsig_clean, noise, idx_overlap)
+    seg_lsig_clean.remove(idx_overlap)
+
+    return seg_lsig_clean.seg, img_lsig_clean
+
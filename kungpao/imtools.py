@@ -4,11 +4,15 @@
 
 import os
 import copy
+import hashlib
+import warnings
+import functools
+import contextlib
+import collections
 
 import numpy as np
 
 from scipy import ndimage
-from scipy.ndimage.filters import gaussian_filter
 
 from astropy.io import fits
 from astropy.nddata import Cutout2D
@@ -23,14 +27,95 @@ import sep
 from . import io
 from . import query
 from . import display
-
-__all__ = ['img_cutout', 'get_pixel_value', 'seg_remove_cen_obj',
-           'seg_index_cen_obj', 'seg_remove_obj', 'seg_index_obj',
-           'img_clean_up', 'seg_to_mask', 'get_psf_model',
+from .convolution import convolve_image
+
+__all__ = ['img_cutout', 'get_pixel_value', 'SegmentationMap',
+           'seg_remove_cen_obj', 'seg_index_cen_obj', 'seg_remove_obj',
+           'seg_index_obj', 'img_clean_up', 'img_detect_passes',
+           'img_detect_passes_tiled', 'TiledBackground', 'passes_to_clean',
+           'passes_to_mask', 'img_clean_and_mask', 'seg_to_mask',
+           'segs_to_mask', 'mask_radius', 'grow_mask', 'get_psf_model',
            'combine_mask', 'img_obj_mask', 'img_subtract_bright_star',
-           'gaia_star_mask', 'iraf_star_mask', 'img_noise_map_conv',
-           'mask_high_sb_pixels', 'img_replace_with_noise',
-           'img_measure_background', 'img_sigma_clipping', 'get_psfex_model']
+           'img_subtract_bright_stars', 'moffat_profile', 'gaia_star_mask',
+           'iraf_star_mask', 'img_noise_map_conv', 'mask_high_sb_pixels',
+           'img_replace_with_noise', 'img_replace_with_sky_noise',
+           'draw_noise', 'check_random_state', 'set_memory_mode',
+           'memory_mode', 'prepare_image', 'BackgroundPyramid',
+           'MeshBackground', 'img_measure_background', 'set_background_cache',
+           'clear_background_cache', 'img_sigma_clipping', 'get_psfex_model']
+
+
+# Memory mode of the image pipeline, see `set_memory_mode`
+_MEMORY_MODE = {'float32': False, 'in_place': False}
+
+
+def set_memory_mode(float32=None, in_place=None):
+    """Set the memory mode of the image pipeline.
+
+    Parameters
+    ----------
+    float32: bool, optional
+        Convert the images to native-endian float32 at the start of the
+        detection and masking functions. Default: None, no change
+    in_place: bool, optional
+        Modify the input images in place instead of copies, in the functions
+        that return a modified image: `img_replace_with_noise`,
+        `img_replace_with_sky_noise`, `img_subtract_bright_star`,
+        `seg_remove_cen_obj`, `seg_remove_obj`, `passes_to_clean` (which
+        reuses the 'img_noise_replace' image), `passes_to_mask` (which
+        removes the object from the segmentation maps of the products) and
+        `detection.detect_low_sb_objects`. Default: None, no change
+
+    Return
+    ------
+        The previous mode, as a dictionary.
+    """
+    previous = dict(_MEMORY_MODE)
+    if float32 is not None:
+        _MEMORY_MODE['float32'] = bool(float32)
+    if in_place is not None:
+        _MEMORY_MODE['in_place'] = bool(in_place)
+
+    return previous
+
+
+@contextlib.contextmanager
+def memory_mode(float32=True, in_place=True):
+    """Context manager for the memory mode, see `set_memory_mode`.
+
+    Example:
+        with memory_mode(float32=True, in_place=True):
+            img_mask = img_obj_mask(img, sig=sig)
+    """
+    previous = set_memory_mode(float32=float32, in_place=in_place)
+    try:
+        yield
+    finally:
+        set_memory_mode(**previous)
+
+
+def prepare_image(img, float32=None):
+    """Image as a C-contiguous, native-endian array for SEP.
+
+    The image is converted to float32 in the float32 memory mode. The array is
+    only copied when needed, e.g. for the big-endian data of FITS files.
+    None, scalars and 0-d arrays, e.g. a constant error, are returned as they
+    are.
+    """
+    if img is None or np.ndim(img) < 2:
+        return img
+
+    img = np.asarray(img)
+    float32 = _MEMORY_MODE['float32'] if float32 is None else float32
+    if float32:
+        return np.ascontiguousarray(img, dtype=np.float32)
+
+    return np.ascontiguousarray(img, dtype=img.dtype.newbyteorder('='))
+
+
+def _copy_image(img):
+    """Copy of the image, or the image itself in the in-place memory mode."""
+    return img if _MEMORY_MODE['in_place'] else copy.deepcopy(img)
 
 
 def gaia_star_mask(img, wcs, pix=0.168, mask_a=694.7, mask_b=4.04,
@@ -71,8 +156,14 @@ def img_noise_map_conv(img, sig, fwhm=1.0, thr_ini=2.5, mask=None,
                        bw_ini=80, bh_ini=80, fw_ini=4, fh_ini=4,
                        bw_glb=240, bh_glb=240, fw_glb=6, fh_glb=6,
                        deb_thr_ini=64, deb_cont_ini=0.001, minarea_ini=25,
-                       verbose=False):
-    """Identify all objects on the image, and generate a noise map."""
+                       rng=None, workers=-1, verbose=False):
+    """Identify all objects on the image, and generate a noise map.
+
+    The noise maps are float32 images drawn with `draw_noise`, using `rng`.
+    To only replace some pixels, use `img_replace_with_sky_noise` instead of
+    full noise maps. The image is smoothed in float32 by
+    `convolution.convolve_image` with `workers` threads.
+    """
     # Step 1: Image convolution:
     '''
     From Greco et al. 2018:
@@ -85,7 +176,8 @@ def img_noise_map_conv(img, sig, fwhm=1.0, thr_ini=2.5, mask=None,
     '''
     # Convolve the image with a circular Gaussian kernel with the size of PSF
     # Image convolution
-    img_conv = gaussian_filter(img, fwhm / 2.355)
+    img, sig = prepare_image(img), prepare_image(sig)
+    img_conv = convolve_image(img, sigma=fwhm / 2.355, workers=workers)
 
     # Step 2: Detect all objects and build a mask for background measurements
     '''
@@ -114,7 +206,8 @@ def img_noise_map_conv(img, sig, fwhm=1.0, thr_ini=2.5, mask=None,
                                       bw=bw_ini, bh=bh_ini, fw=fw_ini, fh=fh_ini)
 
         # Correct the background
-        img_conv_cor = img_conv - bkg_ini_conv.back()
+        bkg_ini_conv.subfrom(img_conv)
+        img_conv_cor = img_conv
     except Exception:
         img_conv_cor = img_conv
 
@@ -131,17 +224,14 @@ def img_noise_map_conv(img, sig, fwhm=1.0, thr_ini=2.5, mask=None,
     '''
     # Generate a noise map based on the initial background map
     # Replace the negative or zero variance region with huge noise level
+    rng = check_random_state(rng)
     sig_conv = bkg_glb_conv.rms()
     sig_conv[sig_conv <= 0] = 1E-10
-    bkg_glb_conv_noise = np.random.normal(loc=bkg_glb_conv.back(),
-                                          scale=sig_conv,
-                                          size=img_conv_cor.shape)
+    bkg_glb_conv_noise = draw_noise(bkg_glb_conv.back(), sig_conv, rng=rng)
 
     sig = bkg_glb.rms()
     sig[sig <= 0] = 1E-10
-    bkg_glb_noise = np.random.normal(loc=bkg_glb.back(),
-                                     scale=sig,
-                                     size=img.shape)
+    bkg_glb_noise = draw_noise(bkg_glb.back(), sig, rng=rng)
 
     return img_conv_cor, bkg_glb_conv_noise, bkg_glb_noise
 
@@ -241,22 +331,173 @@ def get_psfex_model(psf, wcs, coord_1, coord_2, prefix='psf_model',
     return psf_model
 
 
-def seg_to_mask(seg, sigma=5.0, msk_max=1000.0, msk_thr=0.01):
+def mask_radius(sigma, msk_thr=0.01, truncate=4.0):
+    """Radius that `seg_to_mask` grows the edge of a large object by.
+
+    Far from its corners, the smoothed mask of a large object drops like the
+    Gaussian CDF across its edge, so it is above `msk_thr` within
+    sigma * Phi^-1(1 - msk_thr) of the edge. It never reaches further than
+    the `truncate` * sigma support of the Gaussian filter.
+
+    Parameters
+    ----------
+    sigma: float
+        Sigma of the Gaussian Kernel.
+    msk_thr: float, optional
+        Threshold of the smoothed mask, as a fraction of the peak. Default: 0.01
+    truncate: float, optional
+        Truncation of the Gaussian kernel in unit of sigma. Default: 4.0
+
+    Return
+    ------
+        Radius in pixel.
+    """
+    from scipy.special import ndtri
+
+    return min(-sigma * ndtri(msk_thr), int(truncate * sigma + 0.5))
+
+
+def _or_window(packed, half):
+    """Logical or of the rows of a bit-packed array within +/- half rows."""
+    # Pad with half empty rows at the end, so the last rows get full windows
+    window = np.concatenate(
+        [packed, np.zeros((half,) + packed.shape[1:], dtype=packed.dtype)])
+
+    # Double the window of rows [i - span + 1, i] in each step
+    span = 1
+    while span < 2 * half + 1:
+        shift = min(span, 2 * half + 1 - span)
+        grown = window.copy()
+        grown[shift:] |= window[:-shift]
+        window, span = grown, span + shift
+
+    # Center the window on each row
+    return np.ascontiguousarray(window[half:])
+
+
+def _grow_packed(mask, radius, n_rect=4, out=None):
+    """Grow a binary mask, see `grow_mask`, and return it packed along the rows."""
+    mask = np.asarray(mask)
+    mask = mask if mask.dtype == bool else (mask > 0)
+    if out is None:
+        out = np.zeros((mask.shape[0], (mask.shape[1] + 7) // 8), dtype=np.uint8)
+
+    angles = np.linspace(0.0, np.pi / 2.0, n_rect) if n_rect > 1 else [np.pi / 4.0]
+    half_sizes = sorted({(int(radius * np.cos(angle) + 1E-8),
+                          int(radius * np.sin(angle) + 1E-8)) for angle in angles})
+
+    # Pack the bits along the columns to grow the mask along the rows, and
+    # along the rows to grow it along the columns
+    packed_col = np.packbits(mask, axis=0)
+    for h_x, h_y in half_sizes:
+        grown = _or_window(packed_col.T, h_x).T if h_x > 0 else packed_col
+        grown = np.packbits(np.unpackbits(grown, axis=0, count=mask.shape[0]), axis=1)
+        out |= _or_window(grown, h_y) if h_y > 0 else grown
+
+    return out
+
+
+def grow_mask(mask, radius, n_rect=4):
+    """Grow a binary mask by a disk of the radius.
+
+    The disk is approximated by the union of `n_rect` rectangles inscribed in
+    it, from a horizontal to a vertical line. Each rectangle is a dilation
+    along the rows and then the columns, which is done with a few logical or
+    operations on bit-packed arrays. So it is fast and uses 1 bit per pixel.
+
+    Parameters
+    ----------
+    mask: 2-D array
+        Binary mask.
+    radius: float
+        Radius of the disk in pixel.
+    n_rect: int, optional
+        Number of rectangles. Default: 4
+
+    Return
+    ------
+        The grown mask as a boolean array.
+    """
+    return np.unpackbits(_grow_packed(mask, radius, n_rect=n_rect), axis=1,
+                         count=np.shape(mask)[1]).view(bool)
+
+
+def seg_to_mask(seg, sigma=5.0, msk_max=1000.0, msk_thr=0.01, method='gaussian'):
     """Convert the segmentation array into an array.
 
     Parameters
     ----------
         sigma:  Sigma of the Gaussian Kernel
+        msk_thr: Threshold of the smoothed mask, as a fraction of the peak
+        method: 'gaussian' smooths the mask with the Gaussian kernel and keeps
+            the pixels above the threshold. 'dilate' grows the mask by the
+            radius from `mask_radius` with `grow_mask` instead, which is faster
+            and uses 1 byte per pixel. It grows small objects more than the
+            Gaussian kernel does: on the segmentations of `img_obj_mask`, ~1%
+            of the pixels are different.
 
     """
-    # Convolve the mask image with a gaussian kernel
-    msk_conv = ndimage.gaussian_filter(((seg.copy() > 0) * msk_max),
-                                       sigma=sigma, order=0)
-    msk_bool = msk_conv > (msk_thr * msk_max)
+    if method == 'dilate':
+        return grow_mask(seg, mask_radius(sigma, msk_thr)).view(np.uint8)
+    elif method != 'gaussian':
+        raise Exception("# Wrong choice of method: gaussian or dilate!")
+
+    # Convolve the mask image with a gaussian kernel in place. The scale of
+    # the mask (msk_max) cancels out in the threshold.
+    msk_conv = (seg > 0).astype(np.float32)
+    ndimage.gaussian_filter(msk_conv, sigma=sigma, order=0, output=msk_conv)
+    msk_bool = msk_conv > msk_thr
 
     return msk_bool.astype('uint8')
 
 
+def segs_to_mask(segs, sigmas, msk_thrs=0.01, method='gaussian'):
+    """Grow several segmentation arrays and combine them into one mask.
+
+    The masks are added to one boolean array. For the 'dilate' method, the
+    segmentations with the same radius are combined before growing them once.
+
+    Parameters
+    ----------
+    segs: list of 2-D arrays
+        Segmentation arrays or binary masks.
+    sigmas: float or list
+        Sigma of the Gaussian kernel for each segmentation.
+    msk_thrs: float or list, optional
+        Threshold for each segmentation. Default: 0.01
+    method: str, optional
+        'gaussian' or 'dilate', see `seg_to_mask`. Default: 'gaussian'
+
+    Return
+    ------
+        The combined mask as an uint8 array.
+    """
+    sigmas = np.broadcast_to(sigmas, len(segs))
+    msk_thrs = np.broadcast_to(msk_thrs, len(segs))
+
+    if method == 'dilate':
+        groups = {}
+        for seg, sigma, msk_thr in zip(segs, sigmas, msk_thrs):
+            radius = mask_radius(sigma, msk_thr)
+            if radius in groups:
+                groups[radius] |= (seg > 0)
+            else:
+                groups[radius] = (seg > 0)
+
+        # Add all the grown masks to one packed array
+        packed = None
+        for radius, mask in groups.items():
+            packed = _grow_packed(mask, radius, out=packed)
+
+        return np.unpackbits(packed, axis=1, count=np.shape(segs[0])[1])
+
+    img_mask = np.zeros(np.shape(segs[0]), dtype=bool)
+    for seg, sigma, msk_thr in zip(segs, sigmas, msk_thrs):
+        img_mask |= seg_to_mask(seg, sigma=sigma, msk_thr=msk_thr, method=method) > 0
+
+    return img_mask.view(np.uint8)
+
+
 def combine_mask(msk1, msk2):
     """Combine two mask images."""
     if (msk1.shape[0] != msk2.shape[0]) or (msk1.shape[1] != msk2.shape[1]):
@@ -292,13 +533,13 @@ def get_pixel_value(img, wcs, ra, dec):
 def seg_remove_cen_obj(seg):
     """Remove the central object from the segmentation.
 
-    TODO
-    ----
-        Should be absorbed by objects for segmentation image
+    Notes
+    -----
+        Use `SegmentationMap` for many operations on the same map.
 
     """
-    seg_copy = copy.deepcopy(seg)
-    seg_copy[seg == seg[int(seg.shape[0] / 2.0), int(seg.shape[1] / 2.0)]] = 0
+    seg_copy = _copy_image(seg)
+    seg_copy[seg_copy == seg_copy[int(seg.shape[0] / 2.0), int(seg.shape[1] / 2.0)]] = 0
 
     return seg_copy
 
@@ -306,9 +547,9 @@ def seg_remove_cen_obj(seg):
 def seg_index_cen_obj(seg):
     """Remove the index array for central object.
 
-    TODO
-    ----
-        Should be absorbed by objects for segmentation image
+    Notes
+    -----
+        Use `SegmentationMap` for many operations on the same map.
 
     """
     cen_obj = seg[int(seg.shape[0] / 2.0), int(seg.shape[1] / 2.0)]
@@ -326,11 +567,11 @@ def seg_remove_obj(seg, x, y):
     seg     : 2-D data array, segmentation mask
     x, y    : int, coordinates
 
-    TODO:
-        Should be absorbed by objects for segmentation image
+    Notes:
+        Use `SegmentationMap` for many operations on the same map.
     """
-    seg_copy = copy.deepcopy(seg)
-    seg_copy[seg == seg[int(y), int(x)]] = 0
+    seg_copy = _copy_image(seg)
+    seg_copy[seg_copy == seg_copy[int(y), int(x)]] = 0
 
     return seg_copy
 
@@ -338,9 +579,9 @@ def seg_remove_obj(seg, x, y):
 def seg_index_obj(seg, x, y):
     """Remove the index array for an object given its location.
 
-    TODO
-    ----
-        Should be absorbed by objects for segmentation image
+    Notes
+    -----
+        Use `SegmentationMap` for many operations on the same map.
 
     """
     obj = seg[int(x), int(y)]
@@ -350,132 +591,626 @@ def seg_index_obj(seg, x, y):
     return seg == obj
 
 
-def img_clean_up(
+class SegmentationMap(object):
+    """Segmentation map with the bounding box and the size of each label.
+
+    The bounding boxes (`scipy.ndimage.find_objects`) and the numbers of pixels
+    (`numpy.bincount`) are measured once, so selecting, removing or replacing
+    an object only touches the pixels in its bounding box, and statistics of
+    all the objects need one pass over the image.
+
+    The label of the object with the row `i` of a SEP catalog is `i + 1`.
+
+    """
+    def __init__(self, seg, copy=True):
+        """Constructor.
+
+        Parameters
+        ----------
+        seg: 2-D array
+            Segmentation map, with 0 for the background.
+        copy: bool, optional
+            Copy the map, otherwise the input array is modified in place by
+            `remove`. Default: True
+        """
+        seg = np.asarray(seg)
+        if not np.issubdtype(seg.dtype, np.integer):
+            seg = seg.astype(np.int32)
+        self.seg = seg.copy() if copy else seg
+
+        self.n_label = max(int(self.seg.max()), 0)
+        self.slices = ndimage.find_objects(self.seg, max_label=self.n_label)
+        self.npix = np.bincount(self.seg.ravel(), minlength=self.n_label + 1)
+
+    @property
+    def labels(self):
+        """Labels of all the objects on the map."""
+        return np.flatnonzero(self.npix[1:]) + 1
+
+    def label_at(self, x, y):
+        """Label at the pixel coordinates."""
+        return int(self.seg[int(y), int(x)])
+
+    def center_label(self):
+        """Label at the center of the map."""
+        return int(self.seg[int(self.seg.shape[0] / 2.0), int(self.seg.shape[1] / 2.0)])
+
+    def _slice(self, label):
+        """Bounding box of a label, or None."""
+        if label < 1 or label > self.n_label or self.npix[label] == 0:
+            return None
+        return self.slices[label - 1]
+
+    def pixels(self, label):
+        """Indices (rows, columns) of the pixels of an object."""
+        box = self._slice(label)
+        if box is None:
+            return (np.array([], dtype=int), np.array([], dtype=int))
+
+        rows, cols = np.nonzero(self.seg[box] == label)
+        return rows + box[0].start, cols + box[1].start
+
+    def index(self, labels):
+        """Boolean image of the pixels of the objects, see `seg_index_obj`."""
+        return self.select(labels).seg > 0
+
+    def select(self, labels):
+        """New map with only the objects."""
+        new = np.zeros_like(self.seg)
+        for label in np.atleast_1d(labels):
+            box = self._slice(label)
+            if box is not None:
+                new[box][self.seg[box] == label] = label
+
+        return SegmentationMap(new, copy=False)
+
+    def remove(self, labels):
+        """Remove the objects from the map in place.
+
+        Objects are removed in their bounding boxes, unless the boxes cover a
+        large part of the image, where one pass with a lookup table is faster.
+        """
+        labels = np.asarray([label for label in np.atleast_1d(labels)
+                             if self._slice(label) is not None], dtype=int)
+        if len(labels) == 0:
+            return self
+
+        area = sum((box[0].stop - box[0].start) * (box[1].stop - box[1].start)
+                   for box in (self.slices[label - 1] for label in labels))
+        if area > self.seg.size / 4:
+            keep = np.ones(self.n_label + 1, dtype=bool)
+            keep[labels] = False
+            self.seg[~keep[self.seg]] = 0
+        else:
+            for label in labels:
+                sub = self.seg[self.slices[label - 1]]
+                sub[sub == label] = 0
+
+        self.npix[labels] = 0
+        for label in labels:
+            self.slices[label - 1] = None
+
+        return self
+
+    def replace(self, img, values, labels):
+        """Replace the pixels of the objects on an image in place.
+
+        Parameters
+        ----------
+        img: 2-D array
+            Image with the same shape as the map.
+        values: float or 2-D array
+            New value, or image of the new values, e.g. a noise image.
+        labels: int or list
+            Labels of the objects.
+        """
+        for label in np.atleast_1d(labels):
+            box = self._slice(label)
+            if box is None:
+                continue
+            obj = self.seg[box] == label
+            img[box][obj] = values[box][obj] if np.ndim(values) == 2 else values
+
+        return img
+
+    def relabel(self):
+        """Relabel the objects with consecutive labels in place.
+
+        Return
+        ------
+            Old labels of the objects, so that the new label `i` was `old[i - 1]`.
+        """
+        old = self.labels
+        lookup = np.zeros(self.n_label + 1, dtype=self.seg.dtype)
+        lookup[old] = np.arange(len(old)) + 1
+        self.seg[...] = lookup[self.seg]
+
+        self.n_label = len(old)
+        self.slices = [self.slices[label - 1] for label in old]
+        self.npix = np.append(self.npix[0], self.npix[old])
+
+        return old
+
+    def sum(self, values):
+        """Sum of an image over the pixels of each label, including 0."""
+        return np.bincount(self.seg.ravel(), weights=np.ravel(values),
+                           minlength=self.n_label + 1)
+
+    def overlap(self, mask, labels=None):
+        """Fraction of the pixels of each object covered by a mask.
+
+        Parameters
+        ----------
+        mask: 2-D array
+            The mask.
+        labels: int or list, optional
+            Labels of the objects. Default: None, all labels.
+
+        Return
+        ------
+            Fraction for each label. For all labels, the array is indexed by the
+            label, with NaN for the labels without pixels.
+        """
+        if labels is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return self.sum(np.asarray(mask) > 0) / self.npix
+
+        frac = []
+        for label in np.atleast_1d(labels):
+            box = self._slice(label)
+            if box is None:
+                frac.append(np.nan)
+            else:
+                frac.append((np.asarray(mask)[box][self.seg[box] == label] > 0).sum() /
+                            float(self.npix[label]))
+
+        return np.asarray(frac)
+
+
+def check_random_state(rng=None):
+    """Random number generator from a seed.
+
+    None gives the `numpy.random` module, so `numpy.random.seed` still
+    controls the noise. An integer or a `numpy.random.Generator` gives a
+    `numpy.random.Generator`.
+    """
+    if rng is None or rng is np.random:
+        return np.random
+
+    return np.random.default_rng(rng)
+
+
+def draw_noise(loc, scale, mask=None, rng=None, dtype=np.float32):
+    """Draw Gaussian noise, only for the pixels in the mask.
+
+    Parameters
+    ----------
+    loc: float or 2-D array
+        Sky value, for all pixels or for each pixel.
+    scale: float or 2-D array
+        Sky RMS, for all pixels or for each pixel.
+    mask: 2-D boolean array, optional
+        Pixels to draw the noise for. Default: None, the whole image, which
+        needs the shape from `loc` or `scale`.
+    rng: int or `numpy.random.Generator`, optional
+        Seed or generator, see `check_random_state`. Default: None
+    dtype: data type, optional
+        Data type of the noise. Default: numpy.float32
+
+    Return
+    ------
+        Noise values for the pixels in the mask, in the order of
+        `img[mask]`, or the noise image when there is no mask.
+    """
+    rng = check_random_state(rng)
+
+    if mask is None:
+        shape = np.broadcast(np.asarray(loc), np.asarray(scale)).shape
+        loc_use, scale_use = loc, scale
+    else:
+        index = np.flatnonzero(mask)
+        shape = index.shape
+        loc_use = np.ravel(loc)[index] if np.ndim(loc) > 0 else loc
+        scale_use = np.ravel(scale)[index] if np.ndim(scale) > 0 else scale
+
+    if isinstance(rng, np.random.Generator):
+        noise = rng.standard_normal(shape, dtype=np.float32 if dtype == np.float32 else np.float64)
+    else:
+        noise = rng.standard_normal(shape)
+    noise = noise.astype(dtype, copy=False)
+    noise *= np.asarray(scale_use, dtype=dtype)
+    noise += np.asarray(loc_use, dtype=dtype)
+
+    return noise
+
+
+def _sep_background(img, bkg_param, mask=None):
+    """Run `sep.Background` with a parameter dictionary."""
+    return sep.Background(
+        img,
+        mask=mask,
+        maskthresh=0,
+        bw=bkg_param['bw'],
+        bh=bkg_param['bh'],
+        fw=bkg_param['fw'],
+        fh=bkg_param['fh'])
+
+
+def _sep_extract(img, det_param, sig=None):
+    """Run `sep.extract` with a parameter dictionary."""
+    return sep.extract(
+        img,
+        det_param['thr'],
+        err=sig,
+        minarea=det_param['minarea'],
+        deblend_nthresh=det_param['deb_n'],
+        deblend_cont=det_param['deb_c'],
+        segmentation_map=True)
+
+
+def img_detect_passes(
         img,
         sig=None,
         bad=None,
-        bkg_param_1={'bw': 20,
-                     'bh': 20,
-                     'fw': 3,
-                     'fh': 3},
-        det_param_1={'thr': 1.5,
-                     'minarea': 40,
-                     'deb_n': 128,
-                     'deb_c': 0.00001},
-        bkg_param_2={'bw': 150,
-                     'bh': 150,
-                     'fw': 7,
-                     'fh': 7},
-        det_param_2={'thr': 2.0,
-                     'minarea': 20,
-                     'deb_n': 64,
-                     'deb_c': 0.001},
-        bkg_param_3={'bw': 60,
-                     'bh': 60,
-                     'fw': 5,
-                     'fh': 5},
-        det_param_3={'thr': 3.5,
-                     'minarea': 10,
-                     'deb_n': 64,
-                     'deb_c': 0.005},
-        verbose=False,
-        visual=False,
-        diagnose=False,
-        **kwargs):
-    """Clean up the image.
+        bkg_param_1={'bw': 20, 'bh': 20, 'fw': 3, 'fh': 3},
+        det_param_1={'thr': 1.5, 'minarea': 40, 'deb_n': 128, 'deb_c': 0.00001},
+        bkg_param_2={'bw': 150, 'bh': 150, 'fw': 7, 'fh': 7},
+        det_param_2={'thr': 2.0, 'minarea': 20, 'deb_n': 64, 'deb_c': 0.001},
+        bkg_param_3={'bw': 60, 'bh': 60, 'fw': 5, 'fh': 5},
+        det_param_3={'thr': 3.5, 'minarea': 10, 'deb_n': 64, 'deb_c': 0.005},
+        bkg_sub_2=True,
+        rng=None,
+        full_noise=False,
+        verbose=False):
+    """Run the three background and detection passes used for cleaning and masking.
+
+    1. A very local sky is subtracted to detect and deblend objects.
+    2. All pixels above the threshold are detected on a large-scale sky.
+    3. The pixels from step 2 are replaced with noise drawn from a sky
+       measured without them, and the faint objects left are detected.
+
+    The noise is only drawn for the replaced pixels, see `draw_noise`, unless
+    `full_noise` is True.
 
-    TODO:
-        Should be absorbed by object for image later.
+    Parameters
+    ----------
+    img: 2-D array
+        The image.
+    sig: 2-D array, optional
+        The error image. Default: None
+    bad: 2-D array, optional
+        Mask of the bad pixels, used for the first background. Default: None
+    bkg_param_1, bkg_param_2, bkg_param_3: dict, optional
+        Parameters (bw, bh, fw, fh) of the backgrounds of each pass.
+    det_param_1, det_param_2, det_param_3: dict, optional
+        Parameters (thr, minarea, deb_n, deb_c) of the detections of each pass.
+    bkg_sub_2: bool, optional
+        Subtract the second background before the second detection. Default: True
+    rng: int or `numpy.random.Generator`, optional
+        Seed or generator for the noise, see `check_random_state`. Default: None
+    full_noise: bool, optional
+        Also draw the noise image for the whole image, e.g. for diagnostic
+        plots. Default: False
+    verbose: bool, optional
+        Print the progress. Default: False
+
+    Return
+    ------
+        Dictionary of all the products: the image and error image ('img', 'sig'),
+        the backgrounds ('bkg_1', 'bkg_2', 'bkg_3'), objects ('obj_1', ...) and
+        segmentation maps ('seg_1', ...) of each pass, the sky and its RMS for
+        the noise ('sky', 'sky_rms'), the random generator ('rng'), the noise
+        image ('noise', None unless `full_noise`), and the image used by the
+        last detection ('img_noise_replace').
     """
+    img, sig = prepare_image(img), prepare_image(sig)
+    # One work image for the background subtracted images
+    work = np.empty_like(img)
+
     # Measure a very local sky to help detection and deblending
     # Notice that this will remove large scale, and low surface brightness
     # features.
-    bkg_1 = sep.Background(
-        img,
-        mask=bad,
-        maskthresh=0,
-        bw=bkg_param_1['bw'],
-        bh=bkg_param_1['bh'],
-        fw=bkg_param_1['fw'],
-        fh=bkg_param_1['fh'])
+    bkg_1 = _sep_background(img, bkg_param_1, mask=bad)
     if verbose:
         print("# BKG 1: Mean Sky / RMS Sky = %10.5f / %10.5f" %
               (bkg_1.globalback, bkg_1.globalrms))
 
     # Subtract a local sky, detect and deblend objects
-    obj_1, seg_1 = sep.extract(
-        img - bkg_1.back(),
-        det_param_1['thr'],
-        err=sig,
-        minarea=det_param_1['minarea'],
-        deblend_nthresh=det_param_1['deb_n'],
-        deblend_cont=det_param_1['deb_c'],
-        segmentation_map=True)
+    np.copyto(work, img)
+    bkg_1.subfrom(work)
+    obj_1, seg_1 = _sep_extract(work, det_param_1, sig=sig)
     if verbose:
         print("# DET 1: Detect %d objects" % len(obj_1))
 
     # Detect all pixels above the threshold
-    bkg_2 = sep.Background(
-        img,
-        bw=bkg_param_2['bw'],
-        bh=bkg_param_2['bh'],
-        fw=bkg_param_2['fw'],
-        fh=bkg_param_2['fh'])
-
-    obj_2, seg_2 = sep.extract(
-        img,
-        det_param_2['thr'],
-        err=sig,
-        minarea=det_param_2['minarea'],
-        deblend_nthresh=det_param_2['deb_n'],
-        deblend_cont=det_param_2['deb_c'],
-        segmentation_map=True)
+    bkg_2 = _sep_background(img, bkg_param_2)
+    if bkg_sub_2:
+        np.copyto(work, img)
+        bkg_2.subfrom(work)
+    obj_2, seg_2 = _sep_extract(work if bkg_sub_2 else img, det_param_2, sig=sig)
     if verbose:
         print("# DET 2: Detect %d objects" % len(obj_2))
 
     # Estimate the background for generating noise image
-    bkg_3 = sep.Background(
-        img,
-        mask=seg_2,
-        maskthresh=0,
-        bw=bkg_param_3['bw'],
-        bh=bkg_param_3['bh'],
-        fw=bkg_param_3['fw'],
-        fh=bkg_param_3['fh'])
+    bkg_3 = _sep_background(img, bkg_param_3, mask=seg_2)
     if verbose:
         print("# BKG 3: Mean Sky / RMS Sky = %10.5f / %10.5f" %
               (bkg_3.globalback, bkg_3.globalrms))
 
+    # The noise is float32, so is the sky model
     if sig is None:
-        noise = np.random.normal(
-            loc=bkg_3.globalback, scale=bkg_3.globalrms, size=img.shape)
+        sky_val, sky_sig = bkg_3.globalback, bkg_3.globalrms
     else:
-        sky_val = bkg_3.back()
-        sky_sig = bkg_3.rms()
+        sky_val = bkg_3.back(dtype=np.float32)
+        sky_sig = bkg_3.rms(dtype=np.float32)
         sky_sig[sky_sig <= 0] = 1E-8
-        noise = np.random.normal(loc=sky_val, scale=sky_sig, size=img.shape)
 
     # Replace all detected pixels with noise
-    img_noise_replace = copy.deepcopy(img)
-    img_noise_replace[seg_2 > 0] = noise[seg_2 > 0]
+    rng = check_random_state(rng)
+    msk_2 = seg_2 > 0
+    img_noise_replace = work
+    np.copyto(img_noise_replace, img)
+    if full_noise:
+        noise = draw_noise(np.broadcast_to(sky_val, img.shape), sky_sig, rng=rng)
+        img_noise_replace[msk_2] = noise[msk_2]
+    else:
+        noise = None
+        img_noise_replace[msk_2] = draw_noise(sky_val, sky_sig, mask=msk_2, rng=rng)
 
     # Detect the faint objects left on the image
-    obj_3, seg_3 = sep.extract(
-        img_noise_replace,
-        det_param_3['thr'],
-        err=sig,
-        minarea=det_param_3['minarea'],
-        deblend_nthresh=det_param_3['deb_n'],
-        deblend_cont=det_param_3['deb_c'],
-        segmentation_map=True)
+    obj_3, seg_3 = _sep_extract(img_noise_replace, det_param_3, sig=sig)
     if verbose:
         print("# DET 3: Detect %d objects" % len(obj_3))
 
+    return {
+        'img': img,
+        'sig': sig,
+        "bkg_1": bkg_1,
+        "obj_1": obj_1,
+        "seg_1": seg_1,
+        "bkg_2": bkg_2,
+        "obj_2": obj_2,
+        "seg_2": seg_2,
+        "bkg_3": bkg_3,
+        "obj_3": obj_3,
+        "seg_3": seg_3,
+        "sky": sky_val,
+        "sky_rms": sky_sig,
+        "rng": rng,
+        "noise": noise,
+        "img_noise_replace": img_noise_replace
+    }
+
+
+class TiledBackground(object):
+    """Background stitched from tiles, with the interface of `sep.Background`."""
+    def __init__(self, back, rms):
+        self._back, self._rms = back, rms
+        self.globalback = float(np.median(back))
+        self.globalrms = float(np.median(rms))
+
+    def back(self):
+        """Background image."""
+        return self._back.copy()
+
+    def rms(self):
+        """Background RMS image."""
+        return self._rms.copy()
+
+
+_OBJ_X_COLS = ['x', 'xmin', 'xmax', 'xpeak', 'xcpeak']
+_OBJ_Y_COLS = ['y', 'ymin', 'ymax', 'ypeak', 'ycpeak']
+
+
+def _tile_passes(task):
+    """Run the passes on one tile and keep the arrays of the products."""
+    img, sig, bad, seed, kwargs = task
+    passes = img_detect_passes(img, sig=sig, bad=bad, rng=seed, **kwargs)
+
+    for key in ('bkg_1', 'bkg_2', 'bkg_3'):
+        passes[key] = (passes[key].back(), passes[key].rms())
+    passes.pop('rng')
+
+    return passes
+
+
+def _tile_slices(shape, tile_size, halo):
+    """Slices of the tiles with and without the halo, and of the core in the tile."""
+    tiles = []
+    for y_0 in range(0, shape[0], tile_size):
+        for x_0 in range(0, shape[1], tile_size):
+            y_1, x_1 = min(y_0 + tile_size, shape[0]), min(x_0 + tile_size, shape[1])
+            y_h0, x_h0 = max(y_0 - halo, 0), max(x_0 - halo, 0)
+            y_h1, x_h1 = min(y_1 + halo, shape[0]), min(x_1 + halo, shape[1])
+            tiles.append(((slice(y_0, y_1), slice(x_0, x_1)),
+                          (slice(y_h0, y_h1), slice(x_h0, x_h1)),
+                          (slice(y_0 - y_h0, y_1 - y_h0), slice(x_0 - x_h0, x_1 - x_h0))))
+
+    return tiles
+
+
+def _merge_tile_labels(seg, tile_size):
+    """Merge the labels that touch across the tile boundaries and relabel them."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    pairs = []
+    for y_b in range(tile_size, seg.shape[0], tile_size):
+        pairs.append(np.stack([seg[y_b - 1, :], seg[y_b, :]]))
+    for x_b in range(tile_size, seg.shape[1], tile_size):
+        pairs.append(np.stack([seg[:, x_b - 1], seg[:, x_b]]))
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=seg.dtype)
+    pairs = pairs[:, (pairs[0] > 0) & (pairs[1] > 0)]
+
+    n_label = int(seg.max()) + 1
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])),
+                       shape=(n_label, n_label))
+    _, comp = connected_components(graph, directed=False)
+
+    used = np.zeros(n_label, dtype=bool)
+    used[np.unique(seg)] = True
+    used[0] = False
+
+    lookup = np.zeros(n_label, dtype=seg.dtype)
+    lookup[used] = np.searchsorted(np.unique(comp[used]), comp[used]) + 1
+
+    return lookup[seg]
+
+
+def img_detect_passes_tiled(img, sig=None, bad=None, tile_size=1024, halo=128,
+                            n_proc=None, use_threads=False, rng=None,
+                            verbose=False, **kwargs):
+    """Run the passes of `img_detect_passes` on overlapping tiles in parallel.
+
+    The image is split into tiles of `tile_size` pixels, each with a halo of
+    `halo` pixels on every side. The passes run on each tile with its halo, and
+    only the core of the tile is kept. The segmentation labels are made unique
+    across the tiles, and the labels that touch across a tile boundary are
+    merged into one object.
+
+    Compared to `img_detect_passes`:
+
+    - The backgrounds (`TiledBackground`) are measured on the tiles, so they
+      differ by a fraction of the sky RMS near the tile boundaries.
+    - Detections agree where objects are well inside the halo. Objects larger
+      than the halo, or deblended differently in the two tiles, can change
+      their labels near the boundaries. On a mock image with 256 pixel tiles
+      and a 64 pixel halo, >99% of the pixels get the same object mask.
+    - The objects are the ones with their centers in the core of each tile,
+      with their coordinates on the whole image. The labels are not indices
+      of the object catalogs anymore.
+
+    Use a halo larger than the biggest objects and comparable to the
+    background boxes.
+
+    Parameters
+    ----------
+    img: 2-D array
+        The image.
+    sig: 2-D array, optional
+        The error image. Default: None
+    bad: 2-D array, optional
+        Mask of the bad pixels. Default: None
+    tile_size: int, optional
+        Size of the tiles without the halo. Default: 1024
+    halo: int, optional
+        Size of the halo around each tile. Default: 128
+    n_proc: int, optional
+        Number of processes or threads. Default: number of CPUs
+    use_threads: bool, optional
+        Use threads instead of processes. Default: False
+    rng: int or `numpy.random.Generator`, optional
+        Seed or generator for the noise images of the tiles. Default: None
+    verbose: bool, optional
+        Print the progress. Default: False
+    **kwargs:
+        Other parameters of `img_detect_passes`.
+
+    Return
+    ------
+        Dictionary of the products, see `img_detect_passes`.
+    """
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    img, sig = prepare_image(img), prepare_image(sig)
+    tiles = _tile_slices(img.shape, tile_size, halo)
+    rng = np.random.default_rng(rng)
+    seeds = rng.integers(0, 2 ** 32, len(tiles))
+
+    # SEP needs C-contiguous arrays
+    tasks = [tuple(None if arr is None else np.ascontiguousarray(arr[ext])
+                   for arr in (img, sig, bad)) + (seed, kwargs)
+             for (_, ext, _), seed in zip(tiles, seeds)]
+
+    n_proc = multiprocessing.cpu_count() if n_proc is None else int(n_proc)
+    if n_proc <= 1 or len(tasks) == 1:
+        results = [_tile_passes(task) for task in tasks]
+    else:
+        pool = (ThreadPool if use_threads else multiprocessing.Pool)(min(n_proc, len(tasks)))
+        try:
+            results = pool.map(_tile_passes, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    passes = {'img': img, 'sig': sig, 'rng': rng}
+    for key in ('noise', 'img_noise_replace', 'sky', 'sky_rms'):
+        if results[0][key] is None:
+            passes[key] = None
+        else:
+            passes[key] = np.empty(img.shape, dtype=np.asarray(results[0][key]).dtype)
+    for key in ('bkg_1', 'bkg_2', 'bkg_3'):
+        passes[key] = (np.empty(img.shape), np.empty(img.shape))
+
+    for step in ('1', '2', '3'):
+        seg, objs, offset = np.zeros(img.shape, dtype=np.int32), [], 0
+        for (core, _, local), result in zip(tiles, results):
+            seg_tile = result['seg_' + step][local]
+            seg[core] = np.where(seg_tile > 0, seg_tile + offset, 0)
+            offset += max(int(result['seg_' + step].max()), 0)
+
+            obj = result['obj_' + step].copy()
+            for col in _OBJ_X_COLS:
+                obj[col] += core[1].start - local[1].start
+            for col in _OBJ_Y_COLS:
+                obj[col] += core[0].start - local[0].start
+            in_core = ((obj['x'] >= core[1].start - 0.5) & (obj['x'] < core[1].stop - 0.5) &
+                       (obj['y'] >= core[0].start - 0.5) & (obj['y'] < core[0].stop - 0.5))
+            objs.append(obj[in_core])
+
+        passes['seg_' + step] = _merge_tile_labels(seg, tile_size)
+        passes['obj_' + step] = np.concatenate(objs)
+
+    for (core, _, local), result in zip(tiles, results):
+        for key in ('noise', 'img_noise_replace', 'sky', 'sky_rms'):
+            if passes[key] is not None:
+                passes[key][core] = result[key][local] if np.ndim(result[key]) else result[key]
+        for key in ('bkg_1', 'bkg_2', 'bkg_3'):
+            passes[key][0][core] = result[key][0][local]
+            passes[key][1][core] = result[key][1][local]
+
+    for key in ('bkg_1', 'bkg_2', 'bkg_3'):
+        passes[key] = TiledBackground(*passes[key])
+
+    if verbose:
+        print("# Run the passes on %d tiles" % len(tiles))
+        for step in ('1', '2', '3'):
+            print("# DET %s: Detect %d objects" % (step, len(passes['obj_' + step])))
+
+    return passes
+
+
+def _run_passes(img, tile_size=None, halo=128, n_proc=None, use_threads=False,
+                **kwargs):
+    """Run the passes on the whole image, or on tiles when `tile_size` is set."""
+    if tile_size is None:
+        return img_detect_passes(img, **kwargs)
+
+    return img_detect_passes_tiled(img, tile_size=tile_size, halo=halo, n_proc=n_proc,
+                                   use_threads=use_threads, **kwargs)
+
+
+def passes_to_clean(passes, verbose=False):
+    """Replace all objects except the central one with noise.
+
+    Parameters
+    ----------
+    passes: dict
+        Products of `img_detect_passes`.
+    verbose: bool, optional
+        Print the progress. Default: False
+
+    Return
+    ------
+        The cleaned image. In the in-place memory mode, it is built on the
+        'img_noise_replace' image of the products, see `set_memory_mode`.
+    """
     # Combine the two segmentation maps
-    seg_comb = (seg_2 + seg_3)
+    seg_comb = (passes['seg_2'] + passes['seg_3'])
 
     # Index for the central object
-    obj_cen_mask = seg_index_cen_obj(seg_1)
+    obj_cen_mask = seg_index_cen_obj(passes['seg_1'])
     if verbose:
         if obj_cen_mask is not None:
             print("# Central object: %d pixels" % np.sum(obj_cen_mask))
@@ -485,24 +1220,175 @@ def img_clean_up(
     if obj_cen_mask is not None:
         seg_comb[obj_cen_mask] = 0
 
-    img_clean = copy.deepcopy(img)
-    img_clean[seg_comb > 0] = noise[seg_comb > 0]
+    if passes['noise'] is not None:
+        img_clean = _copy_image(passes['img'])
+        img_clean[seg_comb > 0] = passes['noise'][seg_comb > 0]
+        return img_clean
+
+    # The pixels of the second pass are already replaced with noise, only
+    # draw the noise for the new pixels of the third pass
+    img_clean = _copy_image(passes['img_noise_replace'])
+    if obj_cen_mask is not None:
+        img_clean[obj_cen_mask] = passes['img'][obj_cen_mask]
+
+    msk_new = (seg_comb > 0) & (passes['seg_2'] == 0)
+    img_clean[msk_new] = draw_noise(passes['sky'], passes['sky_rms'], mask=msk_new,
+                                    rng=passes['rng'])
+
+    return img_clean
+
+
+def passes_to_mask(passes, sig_msk_1=3.0, sig_msk_2=5.0, sig_msk_3=2.0,
+                   thr_msk_1=0.01, thr_msk_2=0.01, thr_msk_3=0.01,
+                   object_remove=None, grow_method='gaussian'):
+    """Build the object mask without the central, or the chosen, object.
+
+    Parameters
+    ----------
+    passes: dict
+        Products of `img_detect_passes`.
+    sig_msk_1, sig_msk_2, sig_msk_3: float, optional
+        Sigma of the Gaussian kernels to grow the masks of each pass.
+    thr_msk_1, thr_msk_2, thr_msk_3: float, optional
+        Thresholds of the grown masks of each pass.
+    object_remove: tuple, optional
+        (x, y) of the object to keep unmasked. Default: None, the central one.
+    grow_method: str, optional
+        Method to grow the masks, 'gaussian' or 'dilate', see `seg_to_mask`.
+        Default: 'gaussian'
+
+    Returns
+    -------
+    img_mask: 2-D array
+        The object mask.
+    segs: list
+        The segmentation maps of each pass without the object.
+
+    """
+    if object_remove is None:
+        segs = [seg_remove_cen_obj(passes[key]) for key in ('seg_1', 'seg_2', 'seg_3')]
+    else:
+        # TODO: Make it work for an array of objects
+        segs = [seg_remove_obj(passes[key], object_remove[1], object_remove[0])
+                for key in ('seg_1', 'seg_2', 'seg_3')]
+
+    img_mask = segs_to_mask(segs, [sig_msk_1, sig_msk_2, sig_msk_3],
+                            msk_thrs=[thr_msk_1, thr_msk_2, thr_msk_3],
+                            method=grow_method)
+
+    return img_mask, segs
+
+
+def img_clean_and_mask(img, sig=None, bad=None, bkg_sub_2=True,
+                       sig_msk_1=3.0, sig_msk_2=5.0, sig_msk_3=2.0,
+                       thr_msk_1=0.01, thr_msk_2=0.01, thr_msk_3=0.01,
+                       object_remove=None, grow_method='gaussian', verbose=False,
+                       **kwargs):
+    """Get both the cleaned image and the object mask from one set of passes.
+
+    This is cheaper than calling `img_clean_up` and `img_obj_mask`, which run
+    all the backgrounds and detections again. Both products share the same
+    noise image.
+
+    Parameters
+    ----------
+    img: 2-D array
+        The image.
+    sig: 2-D array, optional
+        The error image. Default: None
+    bad: 2-D array, optional
+        Mask of the bad pixels. Default: None
+    bkg_sub_2: bool, optional
+        Subtract the second background before the second detection, like
+        `img_obj_mask` does. `img_clean_up` does not. Default: True
+    sig_msk_*, thr_msk_*, object_remove, grow_method:
+        See `passes_to_mask`.
+    verbose: bool, optional
+        Print the progress. Default: False
+    **kwargs:
+        Background and detection parameters of `img_detect_passes`. Set
+        `tile_size`, and optionally `halo`, `n_proc` and `use_threads`, to run
+        them on tiles with `img_detect_passes_tiled`.
+
+    Returns
+    -------
+    img_clean: 2-D array
+        The cleaned image.
+    img_mask: 2-D array
+        The object mask.
+    passes: dict
+        Products of `img_detect_passes`.
+
+    """
+    passes = _run_passes(img, sig=sig, bad=bad, bkg_sub_2=bkg_sub_2,
+                         verbose=verbose, **kwargs)
+
+    img_clean = passes_to_clean(passes, verbose=verbose)
+    img_mask, _ = passes_to_mask(
+        passes, sig_msk_1=sig_msk_1, sig_msk_2=sig_msk_2, sig_msk_3=sig_msk_3,
+        thr_msk_1=thr_msk_1, thr_msk_2=thr_msk_2, thr_msk_3=thr_msk_3,
+        object_remove=object_remove, grow_method=grow_method)
+
+    return img_clean, img_mask, passes
+
+
+def img_clean_up(
+        img,
+        sig=None,
+        bad=None,
+        bkg_param_1={'bw': 20,
+                     'bh': 20,
+                     'fw': 3,
+                     'fh': 3},
+        det_param_1={'thr': 1.5,
+                     'minarea': 40,
+                     'deb_n': 128,
+                     'deb_c': 0.00001},
+        bkg_param_2={'bw': 150,
+                     'bh': 150,
+                     'fw': 7,
+                     'fh': 7},
+        det_param_2={'thr': 2.0,
+                     'minarea': 20,
+                     'deb_n': 64,
+                     'deb_c': 0.001},
+        bkg_param_3={'bw': 60,
+                     'bh': 60,
+                     'fw': 5,
+                     'fh': 5},
+        det_param_3={'thr': 3.5,
+                     'minarea': 10,
+                     'deb_n': 64,
+                     'deb_c': 0.005},
+        tile_size=None,
+        halo=128,
+        n_proc=None,
+        use_threads=False,
+        verbose=False,
+        visual=False,
+        diagnose=False,
+        **kwargs):
+    """Clean up the image.
+
+    All objects except the central one are replaced with noise. See
+    `img_detect_passes` for the detections, and `img_clean_and_mask` to get
+    the object mask from the same passes. When `tile_size` is set, the passes
+    run on tiles in parallel, see `img_detect_passes_tiled`.
+
+    TODO:
+        Should be absorbed by object for image later.
+    """
+    everything = _run_passes(
+        img, sig=sig, bad=bad,
+        bkg_param_1=bkg_param_1, det_param_1=det_param_1,
+        bkg_param_2=bkg_param_2, det_param_2=det_param_2,
+        bkg_param_3=bkg_param_3, det_param_3=det_param_3,
+        bkg_sub_2=False, tile_size=tile_size, halo=halo, n_proc=n_proc,
+        use_threads=use_threads, full_noise=diagnose, verbose=verbose)
+
+    img_clean = passes_to_clean(everything, verbose=verbose)
 
     if diagnose:
-        everything = {
-            'img': img,
-            'sig': sig,
-            "bkg_1": bkg_1,
-            "obj_1": obj_1,
-            "seg_1": seg_1,
-            "bkg_2": bkg_2,
-            "obj_2": obj_2,
-            "seg_2": seg_2,
-            "bkg_3": bkg_3,
-            "obj_3": obj_3,
-            "seg_3": seg_3,
-            "noise": noise
-        }
         if visual:
             return img_clean, everything, display.diagnose_image_clean(
                 img_clean, everything, **kwargs)
@@ -546,126 +1432,30 @@ def img_obj_mask(img, sig=None, bad=None,
                               'deb_n': 64, 'deb_c': 0.005},
                  sig_msk_1=3.0, sig_msk_2=5.0, sig_msk_3=2.0,
                  thr_msk_1=0.01, thr_msk_2=0.01, thr_msk_3=0.01,
-                 object_remove=None,
+                 object_remove=None, grow_method='gaussian',
+                 tile_size=None, halo=128, n_proc=None, use_threads=False,
                  verbose=False, visual=False, diagnose=False, **kwargs):
-    """Make object mask."""
-    # Measure a very local sky to help detection and deblending
-    # Notice that this will remove large scale, and low surface brightness
-    # features.
-    bkg_1 = sep.Background(
-        img,
-        mask=bad,
-        maskthresh=0,
-        bw=bkg_param_1['bw'],
-        bh=bkg_param_1['bh'],
-        fw=bkg_param_1['fw'],
-        fh=bkg_param_1['fh'])
+    """Make object mask.
 
-    if verbose:
-        print("# BKG 1: Mean Sky / RMS Sky = %10.5f / %10.5f" %
-              (bkg_1.globalback, bkg_1.globalrms))
-
-    # Subtract a local sky, detect and deblend objects
-    obj_1, seg_1 = sep.extract(
-        img - bkg_1.back(),
-        det_param_1['thr'],
-        err=sig,
-        minarea=det_param_1['minarea'],
-        deblend_nthresh=det_param_1['deb_n'],
-        deblend_cont=det_param_1['deb_c'],
-        segmentation_map=True)
-    if verbose:
-        print("# DET 1: Detect %d objects" % len(obj_1))
-
-    # Detect all pixels above the threshold
-    bkg_2 = sep.Background(
-        img,
-        bw=bkg_param_2['bw'],
-        bh=bkg_param_2['bh'],
-        fw=bkg_param_2['fw'],
-        fh=bkg_param_2['fh'])
-
-    obj_2, seg_2 = sep.extract(
-        img - bkg_2.back(),
-        det_param_2['thr'],
-        err=sig,
-        minarea=det_param_2['minarea'],
-        deblend_nthresh=det_param_2['deb_n'],
-        deblend_cont=det_param_2['deb_c'],
-        segmentation_map=True)
-    if verbose:
-        print("# DET 2: Detect %d objects" % len(obj_2))
-
-    # Estimate the background for generating noise image
-    bkg_3 = sep.Background(
-        img,
-        mask=seg_2,
-        maskthresh=0,
-        bw=bkg_param_3['bw'],
-        bh=bkg_param_3['bh'],
-        fw=bkg_param_3['fw'],
-        fh=bkg_param_3['fh'])
-    if verbose:
-        print("# BKG 3: Mean Sky / RMS Sky = %10.5f / %10.5f" %
-              (bkg_3.globalback, bkg_3.globalrms))
-
-    if sig is None:
-        noise = np.random.normal(
-            loc=bkg_3.globalback, scale=bkg_3.globalrms, size=img.shape)
-    else:
-        sky_val = bkg_3.back()
-        sky_sig = bkg_3.rms()
-        sky_sig[sky_sig <= 0] = 1E-8
-        noise = np.random.normal(loc=sky_val, scale=sky_sig, size=img.shape)
-
-    # Replace all detected pixels with noise
-    img_noise_replace = copy.deepcopy(img)
-    img_noise_replace[seg_2 > 0] = noise[seg_2 > 0]
-
-    # Detect the faint objects left on the image
-    obj_3, seg_3 = sep.extract(
-        img_noise_replace,
-        det_param_3['thr'],
-        err=sig,
-        minarea=det_param_3['minarea'],
-        deblend_nthresh=det_param_3['deb_n'],
-        deblend_cont=det_param_3['deb_c'],
-        segmentation_map=True)
-    if verbose:
-        print("# DET 3: Detect %d objects" % len(obj_3))
-
-    # Index for the central object
-    if object_remove is None:
-        seg_1 = seg_remove_cen_obj(seg_1)
-        seg_2 = seg_remove_cen_obj(seg_2)
-        seg_3 = seg_remove_cen_obj(seg_3)
-    else:
-        # TODO: Make it work for an array of objects
-        seg_1 = seg_remove_obj(seg_1, object_remove[1], object_remove[0])
-        seg_2 = seg_remove_obj(seg_2, object_remove[1], object_remove[0])
-        seg_3 = seg_remove_obj(seg_3, object_remove[1], object_remove[0])
-
-    seg_mask_1 = seg_to_mask(seg_1, sigma=sig_msk_1, msk_thr=thr_msk_1)
-    seg_mask_2 = seg_to_mask(seg_2, sigma=sig_msk_2, msk_thr=thr_msk_2)
-    seg_mask_3 = seg_to_mask(seg_3, sigma=sig_msk_3, msk_thr=thr_msk_3)
-
-    img_mask = (seg_mask_1 | seg_mask_2 | seg_mask_3)
+    See `img_detect_passes` for the detections, and `img_clean_and_mask` to get
+    the cleaned image from the same passes. When `tile_size` is set, the passes
+    run on tiles in parallel, see `img_detect_passes_tiled`.
+    """
+    passes = _run_passes(
+        img, sig=sig, bad=bad,
+        bkg_param_1=bkg_param_1, det_param_1=det_param_1,
+        bkg_param_2=bkg_param_2, det_param_2=det_param_2,
+        bkg_param_3=bkg_param_3, det_param_3=det_param_3,
+        bkg_sub_2=True, tile_size=tile_size, halo=halo, n_proc=n_proc,
+        use_threads=use_threads, full_noise=diagnose, verbose=verbose)
+
+    img_mask, segs = passes_to_mask(
+        passes, sig_msk_1=sig_msk_1, sig_msk_2=sig_msk_2, sig_msk_3=sig_msk_3,
+        thr_msk_1=thr_msk_1, thr_msk_2=thr_msk_2, thr_msk_3=thr_msk_3,
+        object_remove=object_remove, grow_method=grow_method)
 
     if diagnose:
-        everything = {
-            'img': img,
-            'sig': sig,
-            "bkg_1": bkg_1,
-            "obj_1": obj_1,
-            "seg_1": seg_1,
-            "bkg_2": bkg_2,
-            "obj_2": obj_2,
-            "seg_2": seg_2,
-            "bkg_3": bkg_3,
-            "obj_3": obj_3,
-            "seg_3": seg_3,
-            "noise": noise
-        }
+        everything = dict(passes, seg_1=segs[0], seg_2=segs[1], seg_3=segs[2])
         if visual:
             return img_mask, everything, display.diagnose_image_mask(
                 img_mask, everything, **kwargs)
@@ -676,30 +1466,63 @@ def img_obj_mask(img, sig=None, bad=None,
 
 def mask_high_sb_pixels(img, pix=0.168, zeropoint=27.0,
                         mu_threshold_1=22.0, mu_threshold_2=23.0,
-                        mu_sig_1=8.0, mu_sig_2=1.0):
-    """Build a mask for all pixels above certain surface brightness level."""
-    np.seterr(invalid='ignore', divide='ignore')
-    msk_high_mu_1 = (zeropoint - 2.5 * np.log10(img / (pix ** 2))) < mu_threshold_1
-    msk_high_mu_2 = (zeropoint - 2.5 * np.log10(img / (pix ** 2))) < mu_threshold_2
+                        mu_sig_1=8.0, mu_sig_2=1.0, grow_method='gaussian'):
+    """Build a mask for all pixels above certain surface brightness level.
 
-    msk_high_mu_1_conv = seg_to_mask(msk_high_mu_1.astype(int), sigma=mu_sig_1,
-                                     msk_max=1000.0, msk_thr=0.01)
-    msk_high_mu_2_conv = seg_to_mask(msk_high_mu_2.astype(int), sigma=mu_sig_2,
-                                     msk_max=1000.0, msk_thr=0.01)
+    The two masks are grown with `segs_to_mask` using `grow_method`.
+    """
+    np.seterr(invalid='ignore', divide='ignore')
+    mu_img = zeropoint - 2.5 * np.log10(img / (pix ** 2))
+    msk_high_mu_1 = mu_img < mu_threshold_1
+    msk_high_mu_2 = mu_img < mu_threshold_2
 
-    msk_high_mu = ((msk_high_mu_1_conv > 0) | (msk_high_mu_2_conv > 0))
+    msk_high_mu = segs_to_mask([msk_high_mu_1, msk_high_mu_2], [mu_sig_1, mu_sig_2],
+                               msk_thrs=0.01, method=grow_method)
 
-    return msk_high_mu
+    return msk_high_mu > 0
 
 
 def img_replace_with_noise(img, msk, noise):
     """Replace the mask region with noise."""
-    img_clean = copy.deepcopy(img)
+    img_clean = _copy_image(img)
     img_clean[msk] = noise[msk]
 
     return img_clean
 
 
+def img_replace_with_sky_noise(img, msk, sky, rms, rng=None, copy_img=None):
+    """Replace the mask region with noise drawn only for these pixels.
+
+    Parameters
+    ----------
+    img: 2-D array
+        The image.
+    msk: 2-D array
+        Mask of the pixels to replace.
+    sky: float or 2-D array
+        Sky value, e.g. `sep.Background.back()`.
+    rms: float or 2-D array
+        Sky RMS, e.g. `sep.Background.rms()`.
+    rng: int or `numpy.random.Generator`, optional
+        Seed or generator, see `check_random_state`. Default: None
+    copy_img: bool, optional
+        Replace the pixels on a copy of the image. Default: None, copy unless
+        in the in-place memory mode, see `set_memory_mode`.
+
+    Return
+    ------
+        The image with the noise.
+    """
+    msk = np.asarray(msk) > 0
+    if copy_img is None:
+        img_clean = _copy_image(img)
+    else:
+        img_clean = copy.deepcopy(img) if copy_img else img
+    img_clean[msk] = draw_noise(sky, rms, mask=msk, rng=rng)
+
+    return img_clean
+
+
 def img_sigma_clipping(img, sig, ratio):
     """Return a mask for piexls above certain threshold."""
     return img > (ratio * sig)
@@ -710,7 +1533,449 @@ def _check_kwargs(kwargs, key, default):
     return kwargs[key] if (key in kwargs) else default
 
 
-def img_measure_background(img, use_sep=True, **kwargs):
+def _robust_sky(values, clip=3.0, n_iter=5):
+    """Median and sigma (from MAD) of pixel values, clipped around the median."""
+    for _ in range(n_iter):
+        med = np.median(values)
+        sig = 1.4826 * np.median(np.abs(values - med))
+        values_use = values[np.abs(values - med) <= clip * sig]
+        if len(values_use) == len(values) or len(values_use) == 0:
+            break
+        values = values_use
+
+    return float(med), float(sig)
+
+
+def _hist_stats(hist, lo, width, clip=3.0, n_iter=10):
+    """Clipped mean, median and sigma of many histograms with the same bins.
+
+    Like SExtractor, the histograms are clipped at 3 sigma around the median
+    until the range converges. The sums over the range of bins come from the
+    cumulative sums, so each iteration only needs the median search, and only
+    for the histograms that have not converged. The statistics are computed
+    in unit of bins.
+    """
+    n_hist, n_bins = hist.shape
+    hist = hist.T.astype(np.float64)
+    centers = (np.arange(n_bins) + 0.5)[:, None]
+
+    # Sum over the bins [i, j) is cum[j] - cum[i]
+    cums = []
+    for weight in (hist, hist * centers, hist * centers ** 2):
+        cum = np.zeros((n_bins + 1, n_hist))
+        for ii in range(n_bins):
+            np.add(cum[ii], weight[ii], out=cum[ii + 1])
+        cums.append(cum)
+
+    mean, med, sig = np.zeros(n_hist), np.zeros(n_hist), np.zeros(n_hist)
+    i_lo, i_hi = np.zeros(n_hist, dtype=int), np.full(n_hist, n_bins)
+    cols = np.arange(n_hist)
+    for _ in range(n_iter):
+        lo_use, hi_use = i_lo[cols], i_hi[cols]
+        n_pix, sum_1, sum_2 = [cum[hi_use, cols] - cum[lo_use, cols] for cum in cums]
+        n_pix = np.maximum(n_pix, 1.0)
+        mean[cols] = sum_1 / n_pix
+        sig[cols] = np.sqrt(np.maximum(sum_2 / n_pix - mean[cols] ** 2, 0.0))
+
+        # Median, interpolated inside the bin
+        half = cums[0][lo_use, cols] + n_pix / 2.0
+        idx = np.minimum(np.argmax(cums[0][1:, cols] >= half, axis=0), hi_use - 1)
+        med[cols] = idx + (half - cums[0][idx, cols]) / np.maximum(hist[idx, cols], 1.0)
+
+        # Only the histograms with a new range need another iteration
+        half_range = clip * np.maximum(sig[cols], 1.0)
+        lo_new = np.clip(np.ceil(med[cols] - half_range - 0.5), 0, n_bins - 1)
+        hi_new = np.clip(np.floor(med[cols] + half_range - 0.5) + 1, lo_new + 1, n_bins)
+        lo_new, hi_new = lo_new.astype(int), hi_new.astype(int)
+        i_lo[cols], i_hi[cols] = lo_new, hi_new
+        cols = cols[(lo_new != lo_use) | (hi_new != hi_use)]
+        if len(cols) == 0:
+            break
+
+    return lo + mean * width, lo + med * width, sig * width
+
+
+def _block_sum(arr, f_y, f_x):
+    """Sum over blocks of f_y x f_x elements, the ones on the edges can be smaller."""
+    n_y, n_x = -(-arr.shape[0] // f_y), -(-arr.shape[1] // f_x)
+    pad = [(0, n_y * f_y - arr.shape[0]), (0, n_x * f_x - arr.shape[1])]
+    if pad[0][1] or pad[1][1]:
+        arr = np.pad(arr, pad + [(0, 0)] * (arr.ndim - 2))
+
+    return arr.reshape((n_y, f_y, n_x, f_x) + arr.shape[2:]).sum(
+        axis=(1, 3), dtype=np.int32)
+
+
+def _filter_mesh(mesh, fw, fh):
+    """Median filter of a mesh map, like `sep.Background`.
+
+    Near the edges, the window shrinks symmetrically to stay inside the map,
+    so the meshes in the corners are not changed.
+    """
+    out = np.empty_like(mesh)
+    half = [np.minimum(np.minimum(np.arange(n_mesh), n_mesh - 1 - np.arange(n_mesh)),
+                       size // 2) for n_mesh, size in zip(mesh.shape, (fh, fw))]
+    for half_y in np.unique(half[0]):
+        for half_x in np.unique(half[1]):
+            use = np.ix_(half[0] == half_y, half[1] == half_x)
+            out[use] = ndimage.median_filter(
+                mesh, size=(2 * half_y + 1, 2 * half_x + 1), mode='nearest')[use]
+
+    return out
+
+
+class MeshBackground(object):
+    """Background from the meshes of a `BackgroundPyramid`.
+
+    It has the interface of `sep.Background`. The background and RMS images
+    are interpolated from the meshes with bicubic splines when requested, and
+    have the data type of the image by default.
+    """
+    def __init__(self, back_mesh, rms_mesh, y_cen, x_cen, shape, dtype=np.float32):
+        self.back_mesh, self.rms_mesh = back_mesh, rms_mesh
+        self.y_cen, self.x_cen = y_cen, x_cen
+        self.shape, self.dtype = shape, dtype
+        self.globalback = float(np.median(back_mesh))
+        self.globalrms = float(np.median(rms_mesh))
+
+    def _render(self, mesh, dtype=None):
+        """Interpolate a mesh map to the image.
+
+        The splines along x are evaluated on the rows of meshes first. The
+        image rows between two rows of meshes are then the product of the
+        powers of the distance and the coefficients of the splines along y.
+        """
+        from scipy.interpolate import CubicSpline
+
+        dtype = self.dtype if dtype is None else dtype
+        if len(self.x_cen) > 1:
+            mesh = CubicSpline(self.x_cen, mesh, axis=1, bc_type='natural')(
+                np.arange(self.shape[1]))
+        else:
+            mesh = np.repeat(mesh, self.shape[1], axis=1)
+
+        work = dtype if np.issubdtype(dtype, np.floating) else np.float64
+        out = np.empty(self.shape, dtype=work)
+        if len(self.y_cen) == 1:
+            out[:] = mesh
+            return out.astype(dtype, copy=False)
+
+        # Coefficients for the distance in unit of the mesh step
+        step = np.diff(self.y_cen)
+        coeff = CubicSpline(self.y_cen, mesh, axis=0, bc_type='natural').c
+        coeff *= step[None, :, None] ** np.arange(3, -1, -1)[:, None, None]
+        coeff = np.ascontiguousarray(coeff.transpose(1, 0, 2), dtype=work)
+
+        y_pix = np.arange(self.shape[0])
+        idx = np.clip(np.searchsorted(self.y_cen, y_pix, side='right') - 1,
+                      0, len(step) - 1)
+        dist = (y_pix - self.y_cen[idx]) / step[idx]
+        powers = np.stack([dist ** 3, dist ** 2, dist, np.ones_like(dist)],
+                          axis=1).astype(work)
+
+        bounds = np.searchsorted(idx, np.arange(len(step) + 1))
+        for ii in range(len(step)):
+            if bounds[ii + 1] > bounds[ii]:
+                rows = slice(bounds[ii], bounds[ii + 1])
+                np.dot(powers[rows], coeff[ii], out=out[rows])
+
+        return out.astype(dtype, copy=False)
+
+    def back(self, dtype=None):
+        """Background image."""
+        return self._render(self.back_mesh, dtype)
+
+    def rms(self, dtype=None):
+        """Background RMS image."""
+        return self._render(self.rms_mesh, dtype)
+
+    def subfrom(self, img):
+        """Subtract the background from an image in place."""
+        img -= self.back(dtype=img.dtype)
+
+
+class BackgroundPyramid(object):
+    """Background meshes of any size from one pass over the image.
+
+    The image is read once to build a histogram of the pixel values in each
+    `base_size` x `base_size` block. The histogram of a larger mesh is the sum
+    of the histograms of its blocks, so the background of any mesh that is a
+    multiple of the base size only costs the clipped statistics of the meshes,
+    without reading the image again.
+
+    The statistics follow SExtractor and `sep.Background`: the histogram is
+    clipped at 3 sigma around the median, the background is 2.5 * median - 1.5
+    * mean (or the median for crowded meshes), the meshes with more than half
+    of the pixels masked are replaced by the nearest good ones, and the mesh
+    maps are median filtered before the spline interpolation.
+
+    The histograms cover `hist_range` times the global sigma around the global
+    median, so the pixels outside are clipped from the start. With 128 bins,
+    the bins are 1/8 sigma wide, and the median is interpolated inside the
+    bin. The results agree with `sep.Background` to a few percent of the RMS.
+
+    Building the pyramid costs about as much as one `sep.Background`, and the
+    meshes of 60 pixels or more then take about a third of the time of
+    `sep.Background`. The same pyramid can only be used for the same image and
+    mask.
+
+    """
+    def __init__(self, img, mask=None, maskthresh=0.0, base_size=10, n_bins=128,
+                 hist_range=8.0):
+        """Constructor.
+
+        Parameters
+        ----------
+        img: 2-D array
+            The image.
+        mask: 2-D array, optional
+            Mask, the pixels with values above `maskthresh` are ignored.
+            Default: None
+        maskthresh: float, optional
+            Threshold of the mask. Default: 0.0
+        base_size: int, optional
+            Size of the finest mesh, in pixel. Default: 10
+        n_bins: int, optional
+            Number of bins of the histograms. Default: 128
+        hist_range: float, optional
+            Half width of the histograms, in unit of the global sigma.
+            Default: 8.0
+        """
+        img = np.asarray(img)
+        self.shape = img.shape
+        self.dtype = img.dtype if img.dtype.kind == 'f' else np.dtype(np.float32)
+        self.base_size = int(base_size)
+        self.n_bins = int(n_bins)
+        self._meshes = {}
+
+        if mask is not None:
+            mask = np.asarray(mask)
+
+        # Global sky and sigma from a subsample of the good pixels
+        step = max(img.size // 200000, 1)
+        sample = img.ravel()[::step]
+        if mask is not None:
+            sample = sample[mask.ravel()[::step] <= maskthresh]
+        sample = sample[np.isfinite(sample)]
+        if len(sample) == 0:
+            raise Exception("# All the pixels are masked!")
+        med, sig = _robust_sky(sample)
+        if sig <= 0:
+            sig = max(abs(med) * 1E-6, 1E-10)
+
+        self.hist_lo = med - hist_range * sig
+        self.hist_width = 2.0 * hist_range * sig / self.n_bins
+
+        # Histogram of each block, one strip of blocks at a time
+        size = self.base_size
+        n_y, n_x = -(-self.shape[0] // size), -(-self.shape[1] // size)
+        self.hist = np.zeros((n_y, n_x, self.n_bins),
+                             dtype=np.min_scalar_type(size * size))
+        self.n_good = np.zeros((n_y, n_x), dtype=np.int32)
+
+        x_offset = (np.arange(self.shape[1]) // size * self.n_bins)[None, :]
+        for iy in range(n_y):
+            strip = img[iy * size:(iy + 1) * size]
+            good = np.isfinite(strip)
+            if mask is not None:
+                good &= (mask[iy * size:(iy + 1) * size] <= maskthresh)
+            self.n_good[iy] = np.add.reduceat(
+                good.sum(axis=0), np.arange(0, self.shape[1], size))
+
+            idx = np.floor((strip - self.hist_lo) / self.hist_width)
+            good &= (idx >= 0) & (idx < self.n_bins)
+            self.hist[iy] = np.bincount(
+                (idx + x_offset)[good].astype(np.intp),
+                minlength=n_x * self.n_bins).reshape(n_x, self.n_bins)
+
+    def _factor(self, size):
+        """Number of blocks in a mesh."""
+        factor = max(int(round(size / self.base_size)), 1)
+        if factor * self.base_size != size:
+            warnings.warn("# Mesh size %d is not a multiple of %d, use %d instead" % (
+                size, self.base_size, factor * self.base_size))
+
+        return factor
+
+    def _block_size(self, n_pix):
+        """Number of pixels of the blocks along one axis."""
+        return np.diff(np.append(np.arange(0, n_pix, self.base_size), n_pix))
+
+    def _centers(self, n_pix, mesh_size):
+        """Centers of the meshes, the ones on the edge can be smaller."""
+        edges = np.append(np.arange(0, n_pix, mesh_size), n_pix)
+
+        return (edges[:-1] + edges[1:] - 1) / 2.0
+
+    def mesh(self, bw=20, bh=20):
+        """Background and RMS of the meshes, before the filtering.
+
+        Parameters
+        ----------
+        bw, bh: int, optional
+            Size of the meshes, in pixel. They are rounded to multiples of
+            the base size. Default: 20
+
+        Returns
+        -------
+        back_mesh, rms_mesh: 2-D arrays
+            Background and RMS of the meshes.
+        good: 2-D boolean array
+            Meshes with at least half of the pixels unmasked.
+        """
+        return self._mesh(self._factor(bh), self._factor(bw))
+
+    def _mesh(self, f_y, f_x):
+        """Meshes of f_y x f_x blocks, see `mesh`."""
+        n_pix = _block_sum(np.outer(self._block_size(self.shape[0]),
+                                    self._block_size(self.shape[1])), f_y, f_x)
+        good = _block_sum(self.n_good, f_y, f_x) >= 0.5 * n_pix
+        hist = _block_sum(self.hist, f_y, f_x).reshape(-1, self.n_bins)
+
+        back_mesh = np.zeros(good.size)
+        rms_mesh = np.zeros(good.size)
+        for start in range(0, good.size, 4096):
+            mean, med, sig = _hist_stats(
+                hist[start:start + 4096], self.hist_lo, self.hist_width)
+            crowded = np.abs(mean - med) >= 0.3 * sig
+            back_mesh[start:start + 4096] = np.where(
+                crowded, med, 2.5 * med - 1.5 * mean)
+            rms_mesh[start:start + 4096] = sig
+
+        return back_mesh.reshape(good.shape), rms_mesh.reshape(good.shape), good
+
+    def background(self, bw=20, bh=20, fw=3, fh=3):
+        """Background with the mesh and filter size, see `sep.Background`.
+
+        Parameters
+        ----------
+        bw, bh: int, optional
+            Size of the meshes, in pixel. They are rounded to multiples of
+            the base size. Default: 20
+        fw, fh: int, optional
+            Size of the median filter, in mesh. Default: 3
+
+        Return
+        ------
+            `MeshBackground` object.
+        """
+        f_y, f_x = self._factor(bh), self._factor(bw)
+        key = (f_x, f_y, int(fw), int(fh))
+        if key in self._meshes:
+            return self._meshes[key]
+
+        back_mesh, rms_mesh, good = self._mesh(f_y, f_x)
+        if not good.any():
+            raise Exception("# All the meshes are masked!")
+        if not good.all():
+            _, (iy, ix) = ndimage.distance_transform_edt(~good, return_indices=True)
+            back_mesh, rms_mesh = back_mesh[iy, ix], rms_mesh[iy, ix]
+
+        if fw > 1 or fh > 1:
+            back_mesh = _filter_mesh(back_mesh, fw, fh)
+            rms_mesh = _filter_mesh(rms_mesh, fw, fh)
+
+        self._meshes[key] = MeshBackground(
+            back_mesh, rms_mesh,
+            self._centers(self.shape[0], f_y * self.base_size),
+            self._centers(self.shape[1], f_x * self.base_size), self.shape,
+            dtype=self.dtype)
+
+        return self._meshes[key]
+
+
+# LRU cache of the photutils background maps, see `img_measure_background`
+_BACKGROUND_CACHE = collections.OrderedDict()
+_BACKGROUND_CACHE_CONFIG = {'max_bytes': 256 * 1024 ** 2}
+
+
+def set_background_cache(max_bytes=None):
+    """Set the memory limit of the cache of photutils background maps.
+
+    Each entry is a pair of float64 background and RMS maps, i.e. 16 bytes
+    per pixel: 256 MB keeps two 2000x2000 images, while a 4000x4000 image
+    (256 MB) is too large to be cached. The least recently used maps are
+    dropped first.
+
+    Parameters
+    ----------
+    max_bytes: int, optional
+        Maximum total size of the cached maps, in bytes. 0 turns the cache
+        off. Default: None, no change
+
+    Return
+    ------
+        The previous limit.
+    """
+    previous = _BACKGROUND_CACHE_CONFIG['max_bytes']
+    if max_bytes is not None:
+        _BACKGROUND_CACHE_CONFIG['max_bytes'] = max(int(max_bytes), 0)
+        _trim_background_cache()
+
+    return previous
+
+
+def _trim_background_cache():
+    """Drop the least recently used maps until the cache is within its limit."""
+    n_bytes = sum(back.nbytes + rms.nbytes for back, rms in _BACKGROUND_CACHE.values())
+    while n_bytes > _BACKGROUND_CACHE_CONFIG['max_bytes']:
+        back, rms = _BACKGROUND_CACHE.popitem(last=False)[1]
+        n_bytes -= back.nbytes + rms.nbytes
+
+
+def clear_background_cache():
+    """Remove all the photutils background maps from the cache."""
+    _BACKGROUND_CACHE.clear()
+
+
+def _fingerprint(arr):
+    """Fingerprint of the content of an array."""
+    if arr is None:
+        return None
+    arr = np.ascontiguousarray(arr)
+
+    return (arr.shape, arr.dtype.str, hashlib.sha1(arr).hexdigest())
+
+
+@functools.lru_cache(maxsize=32)
+def _photutils_estimators(bkg, rms, clip, sigma, maxiters):
+    """Sigma clipping, background and RMS estimators of photutils."""
+    if clip:
+        sigma_clip = SigmaClip(sigma=sigma, maxiters=maxiters)
+    else:
+        sigma_clip = None
+
+    if bkg == 'biweight':
+        from photutils import BiweightLocationBackground
+        bkg_estimator = BiweightLocationBackground()
+    elif bkg == 'sextractor':
+        from photutils import SExtractorBackground
+        bkg_estimator = SExtractorBackground()
+    elif bkg == 'mmm':
+        from photutils import MMMBackground
+        bkg_estimator = MMMBackground()
+    elif bkg == 'median':
+        from photutils import MedianBackground
+        bkg_estimator = MedianBackground()
+    else:
+        raise Exception("# Wrong choice of background estimator!")
+
+    if rms == 'biweight':
+        from photutils import BiweightScaleBackgroundRMS
+        rms_estimator = BiweightScaleBackgroundRMS()
+    elif rms == 'mad':
+        from photutils import MADStdBackgroundRMS
+        rms_estimator = MADStdBackgroundRMS()
+    elif rms == 'std':
+        from photutils import StdBackgroundRMS
+        rms_estimator = StdBackgroundRMS()
+    else:
+        raise Exception("# Wrong choice of RMS estimator!")
+
+    return sigma_clip, bkg_estimator, rms_estimator
+
+
+def img_measure_background(img, use_sep=True, pyramid=None, **kwargs):
     """Estimate sky background of an image.
 
     For SEP, available parameters are:
@@ -718,128 +1983,239 @@ def img_measure_background(img, use_sep=True, **kwargs):
         sep_kwargs = {'mask': None,
                       'bw': 20, 'bh': 20, 'fw': 3, 'fh':3, }
 
+    The same parameters work with a `BackgroundPyramid` of the image and the
+    mask passed as `pyramid`, which avoids another pass over the image for
+    each mesh size. With `pyramid=True`, a new one is built.
+
     For Photutils, available parameters are:
 
         phot_kwargs = {'bkg': 'median', 'rms': 'mad', 'mask': None,
                        'clip': True, 'sigma': 3.0, 'maxiters': 10,
                        'bw': 20, 'bh': 20, 'fw': 3, 'fh':3, }
+
+    The estimators of Photutils are reused for the same parameters, and the
+    background and RMS maps are kept in a LRU cache with the fingerprints of
+    the image and the mask, so measuring the same image again returns copies
+    of the maps. The cache holds up to 256 MB of maps by default, see
+    `set_background_cache` and `clear_background_cache`.
     """
-    if use_sep:
+    if pyramid is not None:
+        # Use the histograms of the blocks
+        if pyramid is True:
+            pyramid = BackgroundPyramid(
+                img, mask=_check_kwargs(kwargs, 'mask', None),
+                maskthresh=_check_kwargs(kwargs, 'maskthresh', 0.0))
+        bkg = pyramid.background(
+            bw=_check_kwargs(kwargs, 'bw', 20), bh=_check_kwargs(kwargs, 'bh', 20),
+            fw=_check_kwargs(kwargs, 'fw', 3), fh=_check_kwargs(kwargs, 'fh', 3))
+        return bkg.back(), bkg.rms()
+    elif use_sep:
         # Use SEP for background
         sep_back = sep.Background(img, **kwargs)
         return sep_back.back(), sep_back.rms()
     else:
         # Use the photutils.background instead
-        if _check_kwargs(kwargs, 'clip', True):
-            sigma_clip = SigmaClip(sigma=_check_kwargs(kwargs, 'sigma', 3.0),
-                                   maxiters=_check_kwargs(kwargs, 'maxiters', 3))
-        else:
-            sigma_clip = None
-
-        bkg = _check_kwargs(kwargs, 'bkg', 'sextractor')
-        rms = _check_kwargs(kwargs, 'rms', 'biweight')
-
-        if bkg == 'biweight':
-            from photutils import BiweightLocationBackground
-            bkg_estimator = BiweightLocationBackground()
-        elif bkg == 'sextractor':
-            from photutils import SExtractorBackground
-            bkg_estimator = SExtractorBackground()
-        elif bkg == 'mmm':
-            from photutils import MMMBackground
-            bkg_estimator = MMMBackground()
-        elif bkg == 'median':
-            from photutils import MedianBackground
-            bkg_estimator = MedianBackground()
-        else:
-            raise Exception("# Wrong choice of background estimator!")
-
-        if rms == 'biweight':
-            from photutils import BiweightScaleBackgroundRMS
-            rms_estimator = BiweightScaleBackgroundRMS()
-        elif rms == 'mad':
-            from photutils import MADStdBackgroundRMS
-            rms_estimator = MADStdBackgroundRMS()
-        elif rms == 'std':
-            from photutils import StdBackgroundRMS
-            rms_estimator = StdBackgroundRMS()
-        else:
-            raise Exception("# Wrong choice of RMS estimator!")
-
-        bw = kwargs['bw'] if ('bw' in kwargs) else 3
-        bh = kwargs['bh'] if ('bh' in kwargs) else 3
-        fw = kwargs['fw'] if ('fw' in kwargs) else 3
-        fh = kwargs['fh'] if ('fh' in kwargs) else 3
-
-        bkg = Background2D(img,
-                           (_check_kwargs(kwargs, 'bh', 100), _check_kwargs(kwargs, 'bw', 100)),
-                           filter_size=(_check_kwargs(kwargs, 'fh', 3), _check_kwargs(kwargs, 'fw', 3)),
-                           mask=_check_kwargs(kwargs, 'mask', None),
+        params = (_check_kwargs(kwargs, 'bkg', 'sextractor'),
+                  _check_kwargs(kwargs, 'rms', 'biweight'),
+                  bool(_check_kwargs(kwargs, 'clip', True)),
+                  float(_check_kwargs(kwargs, 'sigma', 3.0)),
+                  _check_kwargs(kwargs, 'maxiters', 3))
+        box_size = (_check_kwargs(kwargs, 'bh', 100), _check_kwargs(kwargs, 'bw', 100))
+        filter_size = (_check_kwargs(kwargs, 'fh', 3), _check_kwargs(kwargs, 'fw', 3))
+        mask = _check_kwargs(kwargs, 'mask', None)
+
+        # Only maps that fit in the cache are kept
+        use_cache = 16 * np.size(img) <= _BACKGROUND_CACHE_CONFIG['max_bytes']
+        if use_cache:
+            key = (_fingerprint(img), _fingerprint(mask), params, box_size, filter_size)
+            if key in _BACKGROUND_CACHE:
+                _BACKGROUND_CACHE.move_to_end(key)
+                back, rms = _BACKGROUND_CACHE[key]
+                return back.copy(), rms.copy()
+
+        sigma_clip, bkg_estimator, rms_estimator = _photutils_estimators(*params)
+        bkg = Background2D(img, box_size, filter_size=filter_size, mask=mask,
                            sigma_clip=sigma_clip,
                            bkg_estimator=bkg_estimator,
                            bkgrms_estimator=rms_estimator)
+        back, rms = bkg.background, bkg.background_rms
 
-        return bkg.background, bkg.background_rms
+        if use_cache:
+            _BACKGROUND_CACHE[key] = (back.copy(), rms.copy())
+            _trim_background_cache()
 
+        return back, rms
 
-def img_subtract_bright_star(img, star, x_col='x_pix', y_col='y_pix',
-                             gamma=5.0, alpha=6.0, sig=None,
-                             x_buffer=4, y_buffer=4, img_maxsize=300):
-    """Subtract a bright star from image using a Moffat model."""
-    # Use the SLSQP fitter
-    fitter_use = fitting.SLSQPLSQFitter()
 
-    # Image dimension
-    img_h, img_w = img.shape
+def moffat_profile(x_arr, y_arr, x_0, y_0, gamma, alpha):
+    """Moffat profile with unit amplitude, like `astropy.modeling.models.Moffat2D`."""
+    return (1.0 + ((x_arr - x_0) ** 2 + (y_arr - y_0) ** 2) / gamma ** 2) ** (-alpha)
 
-    # Only fit the stars on the image
-    if ((0 + x_buffer < int(star[x_col]) < img_w - x_buffer) and
-        (0 + y_buffer < int(star[y_col]) < img_h - y_buffer)):
-        # Get the center of the star
-        x_cen, y_cen = int(star[x_col]), int(star[y_col])
-
-        # If the image is too big, cut a part of it
-        if (img_h >= img_maxsize) or (img_w >= img_maxsize):
-            x_0 = int(x_cen - img_maxsize / 2.0) if (x_cen - img_maxsize / 2.0) > 0 else 0
-            x_1 = int(x_cen + img_maxsize / 2.0) if (x_cen + img_maxsize / 2.0) < img_w else (img_w - 1)
-            y_0 = int(y_cen - img_maxsize / 2.0) if (y_cen - img_maxsize / 2.0) > 0 else 0
-            y_1 = int(y_cen + img_maxsize / 2.0) if (y_cen + img_maxsize / 2.0) < img_h else (img_h - 1)
-            x_cen, y_cen = (x_cen - x_0), (y_cen - y_0)
-        else:
-            x_0, x_1 = 0, img_w + 1
-            y_0, y_1 = 0, img_h + 1
 
-        # Determine the weights for the fitting
-        img_use = copy.deepcopy(img[y_0:y_1, x_0:x_1])
+def _fit_star_stamp(task):
+    """Fit a Moffat model to one star on its stamp.
 
-        weights = (1.0 / sig[y_0:y_1, x_0:x_1]) if (sig is not None) else None
+    Return
+    ------
+        (amplitude, x_0, y_0, gamma, alpha) on the stamp, and whether the fit worked.
+    """
+    stamp, weights, x_cen, y_cen, gamma, alpha, x_buffer, y_buffer = task
+
+    y_arr, x_arr = np.mgrid[:stamp.shape[0], :stamp.shape[1]]
+    p_init = models.Moffat2D(x_0=x_cen, y_0=y_cen,
+                             amplitude=stamp[int(y_cen), int(x_cen)],
+                             gamma=gamma, alpha=alpha,
+                             bounds={'x_0': [x_cen - x_buffer, x_cen + x_buffer],
+                                     'y_0': [y_cen - y_buffer, y_cen + y_buffer]})
+    try:
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter('ignore')
+            best_fit = fitting.SLSQPLSQFitter()(
+                p_init, x_arr, y_arr, stamp, weights=weights, verblevel=0)
+        params = (best_fit.amplitude.value, best_fit.x_0.value, best_fit.y_0.value,
+                  best_fit.gamma.value, best_fit.alpha.value)
+        return params, bool(np.all(np.isfinite(params)))
+    except Exception:
+        return (np.nan, x_cen, y_cen, gamma, alpha), False
 
-        # X, Y grids
-        y_size, x_size = img_use.shape
-        y_arr, x_arr = np.mgrid[:y_size, :x_size]
 
-        # Initial the Moffat model
-        p_init = models.Moffat2D(x_0=x_cen, y_0=y_cen,
-                                 amplitude=(img_use[int(x_cen), int(y_cen)]),
-                                 gamma=gamma, alpha=alpha,
-                                 bounds={'x_0': [x_cen - x_buffer, x_cen + x_buffer],
-                                         'y_0': [y_cen - y_buffer, y_cen + y_buffer]})
+def img_subtract_bright_stars(img, stars, x_col='x_pix', y_col='y_pix',
+                              gamma=5.0, alpha=6.0, sig=None,
+                              x_buffer=4, y_buffer=4, stamp_size=300,
+                              fit_shape=True, n_proc=1, use_threads=False,
+                              return_params=False):
+    """Subtract many bright stars from an image using Moffat models.
 
-        try:
-            with np.errstate(all='ignore'):
-                best_fit = fitter_use(p_init, x_arr, y_arr, img_use, weights=weights,
-                                      verblevel=0)
+    Each star is fitted on a stamp of `stamp_size` pixels around it, on the
+    original image, so the fits are independent and can run in parallel. Then
+    all the models are subtracted from one output image, which is a copy of
+    the image, or the image itself in the in-place memory mode (see
+    `set_memory_mode`). Stars closer than the buffers to the edges are skipped.
 
-                img_new = copy.deepcopy(img)
-                img_new[y_0:y_1, x_0:x_1] -= best_fit(x_arr, y_arr)
+    Parameters
+    ----------
+    img: 2-D array
+        The image.
+    stars: table
+        Catalog of the stars, e.g. from `query.image_gaia_stars`.
+    x_col, y_col: str, optional
+        Columns of the pixel coordinates. Default: 'x_pix', 'y_pix'
+    gamma, alpha: float or 1-D array, optional
+        Shape of the Moffat model, or the initial guess when fitting it.
+        Default: 5.0, 6.0
+    sig: 2-D array, optional
+        Error image for the weights. Default: None
+    x_buffer, y_buffer: int, optional
+        Allowed shift of the center in the fit, and the minimum distance to
+        the edges. Default: 4
+    stamp_size: int, optional
+        Size of the stamps. Default: 300
+    fit_shape: bool, optional
+        Fit the center and the shape with `SLSQPLSQFitter`. When False, only
+        the amplitude is fitted, with the center from the catalog and the
+        given shape, which is a fast linear fit. Default: True
+    n_proc: int, optional
+        Number of processes or threads for the fits. Default: 1
+    use_threads: bool, optional
+        Use threads instead of processes. Default: False
+    return_params: bool, optional
+        Also return the parameters of the models. Default: False
+
+    Returns
+    -------
+    img_new: 2-D array
+        The image without the stars.
+    params: numpy structured array
+        Index in the catalog, amplitude, center on the image, shape and status
+        of each model, only with `return_params`.
+
+    """
+    img = prepare_image(img)
+    img_h, img_w = img.shape
 
-            return img_new
+    x_star = np.atleast_1d(np.asarray(stars[x_col], dtype=float))
+    y_star = np.atleast_1d(np.asarray(stars[y_col], dtype=float))
+    gamma_arr, alpha_arr = np.broadcast_to(gamma, x_star.shape), np.broadcast_to(alpha, x_star.shape)
 
-        except Exception:
-            warnings.warn('# Star fitting failed!')
-            return img
+    # Only fit the stars on the image
+    x_int, y_int = x_star.astype(int), y_star.astype(int)
+    index = np.flatnonzero((x_int > x_buffer) & (x_int < img_w - x_buffer) &
+                           (y_int > y_buffer) & (y_int < img_h - y_buffer))
+
+    half = int(stamp_size / 2)
+    boxes = [(slice(max(y_int[ii] - half, 0), min(y_int[ii] + half, img_h)),
+              slice(max(x_int[ii] - half, 0), min(x_int[ii] + half, img_w)))
+             for ii in index]
+
+    params = np.zeros(len(index), dtype=[
+        ('index', 'i8'), ('amplitude', 'f8'), ('x_0', 'f8'), ('y_0', 'f8'),
+        ('gamma', 'f8'), ('alpha', 'f8'), ('success', 'bool')])
+    params['index'] = index
+    params['gamma'], params['alpha'] = gamma_arr[index], alpha_arr[index]
+    params['x_0'], params['y_0'] = x_star[index], y_star[index]
+
+    if fit_shape:
+        tasks = [(img[box], None if sig is None else 1.0 / sig[box],
+                  x_int[ii] - box[1].start, y_int[ii] - box[0].start,
+                  gamma_arr[ii], alpha_arr[ii], x_buffer, y_buffer)
+                 for ii, box in zip(index, boxes)]
+        if n_proc <= 1 or len(tasks) <= 1:
+            results = [_fit_star_stamp(task) for task in tasks]
+        else:
+            import multiprocessing
+            from multiprocessing.pool import ThreadPool
+            pool = (ThreadPool if use_threads else multiprocessing.Pool)(n_proc)
+            try:
+                results = pool.map(_fit_star_stamp, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        for jj, (box, (values, success)) in enumerate(zip(boxes, results)):
+            params['amplitude'][jj], params['gamma'][jj], params['alpha'][jj] = (
+                values[0], values[3], values[4])
+            params['x_0'][jj] = values[1] + box[1].start
+            params['y_0'][jj] = values[2] + box[0].start
+            params['success'][jj] = success
+        if not np.all(params['success']):
+            warnings.warn('# Star fitting failed for %d stars!' % np.sum(~params['success']))
     else:
-        return img
+        # Weighted linear least-squares for the amplitude
+        for jj, box in enumerate(boxes):
+            y_arr, x_arr = np.ogrid[box[0], box[1]]
+            model = moffat_profile(x_arr, y_arr, params['x_0'][jj], params['y_0'][jj],
+                                   params['gamma'][jj], params['alpha'][jj])
+            weights = 1.0 if sig is None else 1.0 / sig[box] ** 2
+            params['amplitude'][jj] = (np.sum(weights * model * img[box]) /
+                                       np.sum(weights * model ** 2))
+        params['success'] = np.isfinite(params['amplitude'])
+
+    # Subtract all the models from one image
+    img_new = _copy_image(img)
+    for jj, box in enumerate(boxes):
+        if params['success'][jj]:
+            y_arr, x_arr = np.ogrid[box[0], box[1]]
+            img_new[box] -= params['amplitude'][jj] * moffat_profile(
+                x_arr, y_arr, params['x_0'][jj], params['y_0'][jj],
+                params['gamma'][jj], params['alpha'][jj])
+
+    if return_params:
+        return img_new, params
+
+    return img_new
+
+
+def img_subtract_bright_star(img, star, x_col='x_pix', y_col='y_pix',
+                             gamma=5.0, alpha=6.0, sig=None,
+                             x_buffer=4, y_buffer=4, img_maxsize=300):
+    """Subtract a bright star from image using a Moffat model.
+
+    See `img_subtract_bright_stars` to subtract many stars at once.
+    """
+    return img_subtract_bright_stars(
+        img, {x_col: [star[x_col]], y_col: [star[y_col]]}, x_col=x_col, y_col=y_col,
+        gamma=gamma, alpha=alpha, sig=sig, x_buffer=x_buffer, y_buffer=y_buffer,
+        stamp_size=img_maxsize)
 
 
 def get_psf_model(wcs_img, psfex_file, ra, dec, pixel=False):
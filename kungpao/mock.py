@@ -5,4 +5,294 @@
 import os
 import copy
 
-import numpy as np
\ No newline at end of file
+import numpy as np
+
+from scipy import fft
+from scipy.special import gamma
+
+from kungpao.model.component import b_n
+
+__all__ = ['sersic_total_flux', 'sersic_2d', 'sersic_stamp', 'PSFConvolver',
+           'add_stamp', 'render_sersic_galaxies']
+
+
+def sersic_total_flux(n, r_e, I_e, q=1.0):
+    """Total flux of a 2-D Sersic profile.
+
+    Parameters
+    ----------
+    n: float or numpy array
+        Sersic index.
+    r_e: float or numpy array
+        Effective radius along the major axis, in pixel.
+    I_e: float or numpy array
+        Intensity at the effective radius.
+    q: float or numpy array, optional
+        Axis ratio. Default: 1.0
+
+    Return
+    ------
+        Total flux.
+    """
+    bn = b_n(n)
+    return (2.0 * np.pi * n * q * I_e * r_e ** 2 * np.exp(bn) *
+            gamma(2.0 * n) / bn ** (2.0 * n))
+
+
+def _elliptical_radius(dx, dy, pa, q):
+    """Elliptical radius, with the position angle in degree."""
+    theta = pa * np.pi / 180.0
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+
+    return np.sqrt((dx * cos_t + dy * sin_t) ** 2 +
+                   ((dy * cos_t - dx * sin_t) / q) ** 2)
+
+
+def sersic_2d(x, y, x0, y0, n, r_e, I_e, q=1.0, pa=0.0):
+    """Intensity of a 2-D Sersic profile at the given positions.
+
+    Parameters
+    ----------
+    x, y: float or numpy array
+        Coordinates of the positions, in pixel.
+    x0, y0: float
+        Coordinates of the center.
+    n: float
+        Sersic index.
+    r_e: float
+        Effective radius along the major axis, in pixel.
+    I_e: float
+        Intensity at the effective radius.
+    q: float, optional
+        Axis ratio. Default: 1.0
+    pa: float, optional
+        Position angle of the major axis in degree, counter-clockwise from the
+        x-axis. Default: 0.0
+
+    Return
+    ------
+        Intensity at the positions.
+    """
+    rad = _elliptical_radius(x - x0, y - y0, pa, q)
+
+    return I_e * np.exp(-1.0 * b_n(n) * ((rad / r_e) ** (1.0 / n) - 1.0))
+
+
+def sersic_stamp(x0, y0, n, r_e, flux=None, I_e=None, q=1.0, pa=0.0,
+                 half_size=None, trunc=8.0, max_half_size=500, oversample=10,
+                 core_radius=3.0):
+    """Draw a 2-D Sersic model on a small stamp.
+
+    The value of each pixel is the intensity at its center, except for the
+    pixels within `core_radius` of the center, where the profile changes too
+    fast. These pixels are the average over `oversample` x `oversample`
+    sub-pixels, and the ones within 1 pixel use 5 times more sub-pixels in
+    each direction. The center of the pixel (i, j) is at x=j, y=i.
+
+    Parameters
+    ----------
+    x0, y0: float
+        Coordinates of the center on the large image, in pixel.
+    n: float
+        Sersic index.
+    r_e: float
+        Effective radius along the major axis, in pixel.
+    flux: float, optional
+        Total flux of the model. Either `flux` or `I_e` is needed.
+    I_e: float, optional
+        Intensity at the effective radius.
+    q: float, optional
+        Axis ratio. Default: 1.0
+    pa: float, optional
+        Position angle of the major axis in degree, counter-clockwise from the
+        x-axis. Default: 0.0
+    half_size: int, optional
+        Half size of the stamp. Default: `trunc` times r_e.
+    trunc: float, optional
+        Default half size of the stamp in unit of r_e. Default: 8.0
+    max_half_size: int, optional
+        Maximum half size of the stamp. Default: 500
+    oversample: int, optional
+        Oversampling factor of the central pixels. Default: 10
+    core_radius: float, optional
+        Radius of the oversampled region, in pixel. Default: 3.0
+
+    Returns
+    -------
+    stamp: 2-D array
+        The model on the stamp.
+    (x_min, y_min): tuple
+        Position of the lower-left pixel of the stamp on the large image.
+
+    """
+    if I_e is None:
+        if flux is None:
+            raise Exception("# Need either flux or I_e!")
+        I_e = flux / sersic_total_flux(n, r_e, 1.0, q=q)
+
+    if half_size is None:
+        half_size = int(min(max(np.ceil(trunc * r_e), 3 * core_radius), max_half_size))
+
+    x_cen, y_cen = int(np.round(x0)), int(np.round(y0))
+    x_min, y_min = x_cen - half_size, y_cen - half_size
+
+    y_arr, x_arr = np.mgrid[y_min:y_cen + half_size + 1, x_min:x_cen + half_size + 1]
+    stamp = sersic_2d(x_arr, y_arr, x0, y0, n, r_e, I_e, q=q, pa=pa)
+
+    # Average over sub-pixels near the center, with a finer grid for the
+    # pixels next to the center
+    if oversample > 1 and core_radius > 0:
+        dist = np.hypot(x_arr - x0, y_arr - y0)
+        for radius, factor in ((core_radius, oversample), (1.0, 5 * oversample)):
+            core = dist <= radius
+            offset = (np.arange(factor) + 0.5) / factor - 0.5
+            dy_sub, dx_sub = [arr.ravel() for arr in np.meshgrid(offset, offset, indexing='ij')]
+            stamp[core] = sersic_2d(
+                x_arr[core][:, None] + dx_sub[None, :], y_arr[core][:, None] + dy_sub[None, :],
+                x0, y0, n, r_e, I_e, q=q, pa=pa).mean(axis=1)
+
+    return stamp, (x_min, y_min)
+
+
+class PSFConvolver(object):
+    """Convolve images with a PSF using FFT.
+
+    The FFT of the zero-padded PSF is cached for each padded image shape, and
+    the images are padded to sizes that are fast for the FFT, so the FFT of the
+    kernel is only computed once for most of the stamps.
+
+    """
+    def __init__(self, psf, normalize=True):
+        """Constructor.
+
+        Parameters
+        ----------
+        psf: 2-D array
+            Image of the PSF.
+        normalize: bool, optional
+            Normalize the PSF so that its sum is 1. Default: True
+        """
+        psf = np.asarray(psf, dtype=float)
+        self.psf = psf / psf.sum() if normalize else psf
+        self._cache = {}
+
+    @property
+    def shape(self):
+        """Shape of the PSF."""
+        return self.psf.shape
+
+    def kernel_fft(self, shape):
+        """FFT of the PSF zero-padded to the shape."""
+        if shape not in self._cache:
+            self._cache[shape] = fft.rfft2(self.psf, s=shape)
+
+        return self._cache[shape]
+
+    def convolve(self, img, mode='full'):
+        """Convolve an image with the PSF.
+
+        Parameters
+        ----------
+        img: 2-D array
+            The image.
+        mode: str, optional
+            'full' returns the whole convolved image, which is larger than the
+            input image by the size of the PSF minus one. 'same' returns the
+            central part with the same shape as the input. Default: 'full'
+
+        Return
+        ------
+            The convolved image.
+        """
+        full_shape = tuple(s_i + s_p - 1 for s_i, s_p in zip(img.shape, self.psf.shape))
+        fft_shape = tuple(fft.next_fast_len(s, real=True) for s in full_shape)
+
+        conv = fft.irfft2(fft.rfft2(img, s=fft_shape) * self.kernel_fft(fft_shape),
+                          s=fft_shape)[:full_shape[0], :full_shape[1]]
+
+        if mode == 'same':
+            y_off, x_off = (self.psf.shape[0] - 1) // 2, (self.psf.shape[1] - 1) // 2
+            return conv[y_off:y_off + img.shape[0], x_off:x_off + img.shape[1]]
+
+        return conv
+
+
+def add_stamp(canvas, stamp, x_min, y_min):
+    """Add a stamp to the large image in place, ignoring the part outside.
+
+    Parameters
+    ----------
+    canvas: 2-D array
+        The large image.
+    stamp: 2-D array
+        The stamp.
+    x_min, y_min: int
+        Position of the lower-left pixel of the stamp on the large image.
+
+    Return
+    ------
+        The large image.
+    """
+    y_0, x_0 = max(y_min, 0), max(x_min, 0)
+    y_1 = min(y_min + stamp.shape[0], canvas.shape[0])
+    x_1 = min(x_min + stamp.shape[1], canvas.shape[1])
+
+    if y_1 > y_0 and x_1 > x_0:
+        canvas[y_0:y_1, x_0:x_1] += stamp[y_0 - y_min:y_1 - y_min, x_0 - x_min:x_1 - x_min]
+
+    return canvas
+
+
+def render_sersic_galaxies(canvas, x, y, n, r_e, flux, q=1.0, pa=0.0, psf=None,
+                           **stamp_kwargs):
+    """Render many Sersic galaxies into a large image.
+
+    Each galaxy is drawn on its own stamp, convolved with the PSF, and added to
+    the image, so the cost only depends on the size of the galaxies.
+
+    Parameters
+    ----------
+    canvas: 2-D array or tuple
+        The image to add the galaxies to, which is modified in place, or the
+        shape of a new empty image.
+    x, y: 1-D arrays
+        Coordinates of the centers, in pixel.
+    n: float or 1-D array
+        Sersic index.
+    r_e: float or 1-D array
+        Effective radius along the major axis, in pixel.
+    flux: float or 1-D array
+        Total flux.
+    q: float or 1-D array, optional
+        Axis ratio. Default: 1.0
+    pa: float or 1-D array, optional
+        Position angle in degree. Default: 0.0
+    psf: 2-D array or PSFConvolver object, optional
+        The PSF. Default: None, no convolution.
+    **stamp_kwargs:
+        Other parameters for `sersic_stamp`.
+
+    Return
+    ------
+        The image with the galaxies.
+    """
+    if isinstance(canvas, tuple):
+        canvas = np.zeros(canvas)
+
+    if psf is not None and not isinstance(psf, PSFConvolver):
+        psf = PSFConvolver(psf)
+
+    x, y, n, r_e, flux, q, pa = np.broadcast_arrays(
+        *[np.atleast_1d(arr).astype(float) for arr in (x, y, n, r_e, flux, q, pa)])
+
+    for ii in range(len(x)):
+        stamp, (x_min, y_min) = sersic_stamp(
+            x[ii], y[ii], n[ii], r_e[ii], flux=flux[ii], q=q[ii], pa=pa[ii],
+            **stamp_kwargs)
+        if psf is not None:
+            stamp = psf.convolve(stamp, mode='full')
+            x_min -= (psf.shape[1] - 1) // 2
+            y_min -= (psf.shape[0] - 1) // 2
+        add_stamp(canvas, stamp, x_min, y_min)
+
+    return canvas
@@ -0,0 +1,370 @@
+"""Fit the Sersic model to a large sample of 1-D profiles."""
+
+import os
+import re
+import glob
+import json
+import multiprocessing
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from kungpao.model.sersic_1d import (
+    norm_prof, map_fit_one_sersic, emcee_fit_one_sersic)
+
+__all__ = ['load_profiles', 'read_batch_results', 'batch_fit_sersic',
+           'batch_fit_sersic_dir']
+
+
+PARAM_NAMES = ['n', 'I0', 'Re']
+
+OUTPUT_COLUMNS = (['index', 'name', 'flag', 'norm', 'lnprob'] +
+                  [col for p in PARAM_NAMES for col in (p, p + '_err')])
+
+# Errors of a fit that failed on the profile itself. Other errors, e.g. a
+# wrong fitting option, are raised.
+_FIT_ERRORS = (RuntimeError, ValueError, np.linalg.LinAlgError)
+
+# A row of the output table: index, the quoted name, then the numbers
+_ROW = re.compile(r'^(\d+) ("(?:[^"\\]|\\.)*") (.*)$')
+
+# Profiles and fitting options of the worker processes.
+_WORKER = {}
+
+
+def load_profiles(prof_dir, pattern='*.txt'):
+    """Load a directory of 1-D profiles into stacked arrays.
+
+    Each file should contain three columns: radius, surface density, and its
+    uncertainty. It is read using `numpy.load` for `.npy` files, or
+    `numpy.loadtxt` otherwise. All profiles need to have the same number of
+    radial bins.
+
+    Parameters
+    ----------
+    prof_dir: str
+        Directory of the profile files.
+    pattern: str, optional
+        Pattern used to select the files. Default: '*.txt'
+
+    Returns
+    -------
+    rad, rho, err: 2-D arrays
+        Radius, profile, and uncertainty with the shape (N_gal, N_r).
+    names: list
+        Names of the profile files, in the same order as the arrays.
+
+    """
+    prof_files = sorted(glob.glob(os.path.join(prof_dir, pattern)))
+    if len(prof_files) == 0:
+        raise Exception("# Can not find any profile in %s" % prof_dir)
+
+    profs = []
+    for prof_file in prof_files:
+        if prof_file.endswith('.npy'):
+            prof = np.load(prof_file)
+        else:
+            prof = np.loadtxt(prof_file)
+        prof = np.asarray(prof, dtype=float)
+        # Make sure the shape is (3, N_r)
+        profs.append(prof.T if prof.shape[-1] == 3 else prof)
+
+    if len(set(prof.shape for prof in profs)) > 1:
+        raise Exception("# All profiles need to have the same radial bins!")
+
+    profs = np.stack(profs)
+
+    return (profs[:, 0, :], profs[:, 1, :], profs[:, 2, :],
+            [os.path.basename(prof_file) for prof_file in prof_files])
+
+
+def read_batch_results(output):
+    """Read the output file of `batch_fit_sersic`.
+
+    Parameters
+    ----------
+    output: str
+        Name of the output file.
+
+    Returns
+    -------
+    results: numpy structured array
+        One row per fitted profile.
+
+    """
+    rows = _read_complete_rows(output)
+
+    name_len = max([len(row[1]) for row in rows] + [1])
+    dtype = [(col, 'U%d' % name_len if col == 'name' else (
+        'i8' if col in ('index', 'flag') else 'f8')) for col in OUTPUT_COLUMNS]
+
+    return np.array([tuple(row) for row in rows], dtype=dtype)
+
+
+def _read_complete_rows(output):
+    """Read the complete rows in the output file, and skip an unfinished one."""
+    if not os.path.isfile(output):
+        return []
+
+    with open(output, 'r') as f:
+        lines = f.readlines()
+
+    # An interrupted run can leave a partial line at the end of the file
+    if lines and not lines[-1].endswith('\n'):
+        lines = lines[:-1]
+
+    rows = [_parse_row(line) for line in lines if not line.startswith('#')]
+
+    return [row for row in rows if row is not None and len(row) == len(OUTPUT_COLUMNS)]
+
+
+def _drop_partial_line(output):
+    """Truncate the output file after its last complete line."""
+    with open(output, 'rb+') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+
+
+def _parse_row(line):
+    """Split a row of the output table, the name is a JSON string."""
+    match = _ROW.match(line.rstrip('\n'))
+    if match is None:
+        return None
+
+    return [match.group(1), json.loads(match.group(2))] + match.group(3).split()
+
+
+def _format_row(index, name, flag, norm, lnprob, best, best_err):
+    """One row of the output table."""
+    values = [v for pair in zip(best, best_err) for v in pair]
+
+    return ('%d %s %d %.8e %.8e ' % (index, json.dumps(name, ensure_ascii=False),
+                                    flag, norm, lnprob) +
+            ' '.join('%.8e' % v for v in values) + '\n')
+
+
+def _share_array(arr):
+    """Copy an array into a shared memory block."""
+    arr = np.ascontiguousarray(arr, dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+    return shm, (shm.name, arr.shape)
+
+
+def _init_worker(specs, method, min_r, max_r, fit_kwargs):
+    """Attach the worker process to the shared profiles."""
+    for key, (name, shape) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER[key + '_shm'] = shm
+        _WORKER[key] = np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+    _WORKER['method'] = method
+    _WORKER['min_r'] = min_r
+    _WORKER['max_r'] = max_r
+    _WORKER['fit_kwargs'] = fit_kwargs
+
+
+def _fit_one(index):
+    """Fit one profile from the shared arrays."""
+    rad = _WORKER['rad']
+    rad = rad[index] if rad.ndim > 1 else rad
+    rho, err = _WORKER['rho'][index], _WORKER['err'][index]
+    min_r, max_r = _WORKER['min_r'], _WORKER['max_r']
+
+    try:
+        norm, _, _ = norm_prof(rad, rho, min_r=min_r, max_r=max_r)
+
+        if _WORKER['method'] == 'map':
+            results = map_fit_one_sersic(
+                rad, rho, err, min_r=min_r, max_r=max_r, **_WORKER['fit_kwargs'])
+            best, best_err, lnprob = results['best'], results['err'], results['lnprob']
+            flag = int(results['on_bound'].any())
+        else:
+            results, _ = emcee_fit_one_sersic(
+                rad, rho, err, min_r=min_r, max_r=max_r, verbose=False,
+                **_WORKER['fit_kwargs'])
+            best, lnprob = results['best'], np.max(results['lnprob'])
+            best_err = np.std(results['samples'], axis=0)
+            flag = 0
+    except _FIT_ERRORS as error:
+        return index, None, '%s: %s' % (type(error).__name__, error)
+
+    return index, (flag, norm, lnprob, best, best_err), None
+
+
+def batch_fit_sersic(rad, rho, err, output, names=None, method='map', n_proc=1,
+                     min_r=6.0, max_r=120.0, resume=True, chunksize=4, verbose=True,
+                     **fit_kwargs):
+    """Fit a single Sersic model to a stack of 1-D profiles.
+
+    The profiles are copied into shared memory once, and each worker of the
+    process pool only receives the indices of the profiles to fit. Results are
+    appended to an ASCII table, one row per profile, as soon as they are
+    available. The names are JSON strings. `flag` is 1 when a parameter of
+    the MAP fit is on the edge of the prior.
+
+    Profiles whose fit fails are not in the table; the error messages are
+    appended to `output + '.log'`. With `resume=True`, profiles already in
+    the output are skipped and the failed ones are fitted again, so an
+    interrupted run can be restarted with the same command.
+
+    Parameters
+    ----------
+    rad: 1-D or 2-D array
+        Radius array, either shared by all the profiles or with the shape
+        (N_gal, N_r).
+    rho: 2-D array
+        Surface mass density profiles with the shape (N_gal, N_r).
+    err: 2-D array
+        Uncertainties of the profiles with the shape (N_gal, N_r).
+    output: str
+        Name of the output file.
+    names: list, optional
+        Names of the profiles. Default: None, use the index.
+    method: str, optional
+        'map' for `map_fit_one_sersic`, or 'emcee' for `emcee_fit_one_sersic`.
+        Default: 'map'
+    n_proc: int, optional
+        Number of processes. Default: 1
+    min_r: float, optional
+        Minimal radii for fitting. Default=6.0
+    max_r: float, optional
+        Maximal radii for fitting. Default=120.0
+    resume: bool, optional
+        Skip the profiles that are already in the output file. Their names
+        need to be the same as in `names`, otherwise an error is raised.
+        Default: True
+    chunksize: int, optional
+        Number of profiles sent to a worker at a time. Default: 4
+    verbose: bool, optional
+        Print the progress. Default: True
+    **fit_kwargs:
+        Other parameters for the fitting function.
+
+    Returns
+    -------
+    results: numpy structured array
+        The content of the output file.
+
+    """
+    if method not in ('map', 'emcee'):
+        raise Exception("# Wrong choice of fitting method: [map|emcee]")
+
+    rho = np.atleast_2d(rho)
+    err = np.atleast_2d(err)
+    n_gal = rho.shape[0]
+    if names is None:
+        names = [str(ii) for ii in range(n_gal)]
+    names = [str(name) for name in names]
+    log_file = output + '.log'
+
+    # Skip the profiles that have been fitted
+    if resume:
+        done = set()
+        for row in _read_complete_rows(output):
+            index = int(row[0])
+            if index >= n_gal or names[index] != row[1]:
+                raise Exception(
+                    "# Profile %d is %s in %s, but %s in the input. The input has "
+                    "changed, use resume=False to start again" % (
+                        index, row[1], output, names[index] if index < n_gal else 'missing'))
+            done.add(index)
+        if os.path.isfile(output):
+            _drop_partial_line(output)
+    else:
+        done = set()
+        for old_file in (output, log_file):
+            if os.path.isfile(old_file):
+                os.remove(old_file)
+    todo = [ii for ii in range(n_gal) if ii not in done]
+
+    if verbose:
+        print("# Will fit %d profiles, %d already done" % (len(todo), len(done)))
+
+    new_file = not os.path.isfile(output) or os.path.getsize(output) == 0
+
+    arrays = {'rad': rad, 'rho': rho, 'err': err}
+    shms, specs = {}, {}
+    try:
+        for key, arr in arrays.items():
+            shms[key], specs[key] = _share_array(arr)
+
+        initargs = (specs, method, min_r, max_r, fit_kwargs)
+
+        with open(output, 'a') as out:
+            if new_file:
+                out.write('# ' + ' '.join(OUTPUT_COLUMNS) + '\n')
+                out.flush()
+
+            if n_proc > 1:
+                pool = multiprocessing.Pool(
+                    n_proc, initializer=_init_worker, initargs=initargs)
+                fits = pool.imap_unordered(_fit_one, todo, chunksize=chunksize)
+            else:
+                pool = None
+                _init_worker(*initargs)
+                fits = map(_fit_one, todo)
+
+            try:
+                n_fail = 0
+                for ii, (index, fit, error) in enumerate(fits):
+                    if fit is None:
+                        n_fail += 1
+                        with open(log_file, 'a') as log:
+                            log.write('%d %s %s\n' % (
+                                index, json.dumps(names[index], ensure_ascii=False), error))
+                    else:
+                        out.write(_format_row(index, names[index], *fit))
+                        out.flush()
+                    if verbose and (ii + 1) % 100 == 0:
+                        print("# Finished %d/%d profiles" % (ii + 1, len(todo)))
+                if verbose and n_fail > 0:
+                    print("# %d fits failed, see %s" % (n_fail, log_file))
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+    finally:
+        # Release the views of the shared memory before closing it
+        worker_shms = [_WORKER.pop(key + '_shm') for key in specs if key + '_shm' in _WORKER]
+        _WORKER.clear()
+        for shm in worker_shms:
+            shm.close()
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    return read_batch_results(output)
+
+
+def batch_fit_sersic_dir(prof_dir, output, pattern='*.txt', **kwargs):
+    """Fit a single Sersic model to a directory of 1-D profiles.
+
+    See `load_profiles` for the format of the profiles, and `batch_fit_sersic`
+    for the available parameters.
+
+    Parameters
+    ----------
+    prof_dir: str
+        Directory of the profile files.
+    output: str
+        Name of the output file.
+    pattern: str, optional
+        Pattern used to select the files. Default: '*.txt'
+
+    Returns
+    -------
+    results: numpy structured array
+        The content of the output file.
+
+    """
+    rad, rho, err, names = load_profiles(prof_dir, pattern=pattern)
+
+    # Use a 1-D radius array when all the profiles share the same one
+    if np.all(rad == rad[0]):
+        rad = rad[0]
+
+    return batch_fit_sersic(rad, rho, err, output, names=names, **kwargs)
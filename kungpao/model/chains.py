@@ -0,0 +1,243 @@
+"""Storage and summary of MCMC chains."""
+
+import os
+
+import numpy as np
+
+from emcee.backends import Backend
+
+__all__ = ['ChainStore', 'chain_summary', 'run_until_converged']
+
+
+class ChainStore(Backend):
+    """Backend for `emcee.EnsembleSampler` that stores a compact chain.
+
+    The chain is kept in a reduced precision (float32 by default), and can
+    be written into a memory-mapped `.npy` file instead of being kept in
+    memory. The ln(probability) is always stored in float64. Thinning is done
+    by `emcee` through the `thin_by` argument of `run_mcmc`, so only the
+    thinned steps are written into the store.
+
+    """
+    def __init__(self, filename=None, dtype=np.float32):
+        """Constructor.
+
+        Parameters
+        ----------
+        filename : str, optional
+            Name of the `.npy` file to store the chain in, with the shape
+            (n_step, n_walker, n_dim). Default: None, keep it in memory.
+        dtype : numpy dtype, optional
+            Data type of the stored chain. Default: np.float32
+        """
+        super(ChainStore, self).__init__(dtype=dtype)
+        self.filename = filename
+
+    def reset(self, nwalkers, ndim):
+        """Clear the state of the chain and empty the backend.
+
+        Parameters
+        ----------
+        nwalkers : int
+            The size of the ensemble.
+        ndim : int
+            The number of dimensions.
+        """
+        super(ChainStore, self).reset(nwalkers, ndim)
+        self.accepted = np.zeros(self.nwalkers, dtype=float)
+        self.log_prob = np.empty((0, self.nwalkers), dtype=float)
+        self.chain = self._new_chain(0)
+
+    def grow(self, ngrow, blobs):
+        """Expand the storage space by some number of samples.
+
+        Parameters
+        ----------
+        ngrow : int
+            The number of steps to grow the chain.
+        blobs : array
+            The current array of blobs.
+        """
+        self._check_blobs(blobs)
+        n_step = self.iteration + ngrow
+        if n_step <= len(self.chain):
+            return
+
+        self.chain = self._new_chain(n_step, old=self.chain[:self.iteration])
+
+        log_prob = np.empty((n_step, self.nwalkers), dtype=float)
+        log_prob[:self.iteration] = self.log_prob[:self.iteration]
+        self.log_prob = log_prob
+
+        if blobs is not None:
+            dt = np.dtype((blobs.dtype, blobs.shape[1:]))
+            new_blobs = np.empty((n_step, self.nwalkers), dtype=dt)
+            if self.blobs is not None:
+                new_blobs[:self.iteration] = self.blobs[:self.iteration]
+            self.blobs = new_blobs
+
+    def trim(self):
+        """Drop the allocated steps that have not been sampled.
+
+        `emcee` allocates all the steps of a run at once, so a run that stops
+        early, e.g. `run_until_converged`, leaves empty steps at the end of
+        the chain. After trimming, the chain file only has the sampled steps.
+        """
+        n_step = self.iteration
+        if n_step == len(self.chain):
+            return
+
+        self.chain = self._new_chain(n_step, old=self.chain[:n_step])
+        self.log_prob = self.log_prob[:n_step].copy()
+        if self.blobs is not None:
+            self.blobs = self.blobs[:n_step].copy()
+
+    def _new_chain(self, n_step, old=None):
+        """Allocate the array for the chain, and copy the old steps into it."""
+        shape = (n_step, self.nwalkers, self.ndim)
+        if self.filename is None:
+            chain = np.empty(shape, dtype=self.dtype)
+            if old is not None:
+                chain[:len(old)] = old
+            return chain
+
+        # Write the new file next to the old one, and copy the old chain
+        # before the new file replaces it.
+        temp_file = self.filename + '.tmp.npy'
+        chain = np.lib.format.open_memmap(
+            temp_file, mode='w+', dtype=self.dtype, shape=shape)
+        if old is not None:
+            chain[:len(old)] = old
+        chain.flush()
+        os.replace(temp_file, self.filename)
+
+        return chain
+
+    def summary(self, frac=0.1, percentiles=(16, 50, 84)):
+        """Summary statistics of the stored chain. See `chain_summary`."""
+        return chain_summary(self.get_chain(), self.get_log_prob(),
+                             frac=frac, percentiles=percentiles)
+
+
+def chain_summary(chain, lnprob, frac=0.1, percentiles=(16, 50, 84)):
+    """Summary statistics of a chain without flattening it.
+
+    Parameters
+    ----------
+    chain : array
+        MCMC chain with the shape (n_step, n_walker, n_dim).
+    lnprob : array
+        ln(probability) of the chain with the shape (n_step, n_walker).
+    frac : float, optional
+        Fraction of the last steps used to get the mean parameters.
+        Default: 0.1
+    percentiles : list, optional
+        Percentiles of the marginalized distributions. Default: (16, 50, 84)
+
+    Return
+    ------
+    summary : dict
+        The best parameters ('best') and the ln(probability) ('lnprob_best'),
+        the mean parameters of the last steps ('mean'), and the percentiles of
+        the parameters ('percentiles', with the shape (n_percentile, n_dim)).
+
+    """
+    n_step, _, n_dim = chain.shape
+
+    # Best parameter using the best log(prob)
+    ind_step, ind_walker = np.unravel_index(np.argmax(lnprob), lnprob.shape)
+    best = np.asarray(chain[ind_step, ind_walker, :], dtype=float)
+
+    # Best parameters using the mean of the last few samples
+    n_last = int(n_step * frac)
+    n_last = n_last if n_last > 0 else n_step
+    mean = chain[-n_last:].mean(axis=(0, 1), dtype=float)
+
+    # Only one parameter is copied at a time
+    pcts = np.array([np.percentile(chain[:, :, ii], percentiles)
+                     for ii in range(n_dim)]).T
+
+    return {'best': best, 'lnprob_best': float(lnprob[ind_step, ind_walker]),
+            'mean': mean, 'percentiles': pcts}
+
+
+def run_until_converged(sampler, initial, n_max, n_eff=1000, check_every=25,
+                        tau_factor=10.0, min_acceptance=0.05, thin=1,
+                        progress=False):
+    """Run an `emcee.EnsembleSampler` until the chain has converged.
+
+    Every `check_every` stored steps, the integrated autocorrelation time tau
+    and the mean acceptance fraction of the chain are estimated. The sampling
+    stops when the chain is longer than `tau_factor` times the largest tau,
+    the effective sample size, n_walker * n_step / tau, reaches `n_eff`, and
+    the acceptance fraction is above `min_acceptance`. Otherwise it stops
+    after `n_max` steps. A `ChainStore` backend is trimmed to the sampled
+    steps when the run stops early.
+
+    Parameters
+    ----------
+    sampler : emcee.EnsembleSampler object
+        The sampler.
+    initial : array
+        Initial positions of the walkers, with the shape (n_walker, n_dim).
+    n_max : int
+        Maximum number of steps, a multiple of `thin`.
+    n_eff : int, optional
+        Target effective sample size. Default: 1000
+    check_every : int, optional
+        Number of stored steps between two checks. Default: 25
+    tau_factor : float, optional
+        Minimum length of the chain in units of tau. Default: 10.0
+    min_acceptance : float, optional
+        Minimum mean acceptance fraction. Default: 0.05
+    thin : int, optional
+        Only store every `thin` steps of the chain. Default: 1
+    progress : bool, optional
+        Show the progress bar. Default: False
+
+    Return
+    ------
+    state : emcee.State object
+        The last state of the sampler.
+    diagnostics : dict
+        Whether the chain has converged ('converged'), the number of steps
+        ('n_step'), tau of each parameter in steps ('tau'), the effective
+        sample size ('n_eff'), the mean acceptance fraction ('acceptance'),
+        and the same values at each check ('history', an array with the
+        columns n_step, max(tau), n_eff, acceptance).
+
+    """
+    def _check():
+        n_step = sampler.iteration
+        tau = sampler.get_autocorr_time(tol=0, quiet=True)
+        tau_max = np.max(tau)
+        ess = sampler.nwalkers * n_step / tau_max
+        acceptance = np.mean(sampler.acceptance_fraction)
+        history.append((n_step * thin, tau_max * thin, ess, acceptance))
+        converged = bool(np.isfinite(tau_max) and n_step >= tau_factor * tau_max and
+                         ess >= n_eff and acceptance >= min_acceptance)
+        return converged, tau * thin, float(ess), float(acceptance)
+
+    if thin < 1 or n_max < thin or n_max % thin:
+        raise Exception("# n_max needs to be a multiple of thin!")
+
+    history = []
+    converged = False
+    state = None
+    for state in sampler.sample(initial, iterations=n_max // thin,
+                                thin_by=thin, store=True, progress=progress):
+        if sampler.iteration % check_every == 0:
+            converged, tau, ess, acceptance = _check()
+            if converged:
+                break
+
+    if not history or history[-1][0] != sampler.iteration * thin:
+        converged, tau, ess, acceptance = _check()
+
+    # Drop the steps allocated for a longer run from a `ChainStore`
+    if isinstance(sampler.backend, ChainStore):
+        sampler.backend.trim()
+
+    return state, {'converged': converged, 'n_step': sampler.iteration * thin,
+                   'tau': tau, 'n_eff': ess, 'acceptance': acceptance,
+                   'history': np.array(history)}
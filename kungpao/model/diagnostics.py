@@ -0,0 +1,383 @@
+"""Diagnostics and fast plots of MCMC chains."""
+
+import numpy as np
+
+import matplotlib.pyplot as plt
+from matplotlib.gridspec import GridSpec
+
+from scipy import fft
+
+__all__ = ['autocorr_function', 'autocorr_time', 'gelman_rubin', 'chain_diagnostics',
+           'thin_samples', 'plot_corner_fast', 'plot_trace_bands', 'save_qa_figures']
+
+ORG = plt.get_cmap('OrRd')
+BLU = plt.get_cmap('PuBu')
+
+
+def autocorr_function(chains):
+    """Normalized autocorrelation function of each walker and parameter.
+
+    Parameters
+    ----------
+    chains: array
+        MCMC chains with the shape (n_walker, n_step, n_dim).
+
+    Return
+    ------
+        Autocorrelation function with the same shape as the chains, computed
+        by FFT along the steps for all the walkers and parameters at once.
+    """
+    chains = np.asarray(chains, dtype=float)
+    n_step = chains.shape[1]
+    n_fft = fft.next_fast_len(2 * n_step, real=True)
+
+    dev = chains - chains.mean(axis=1, keepdims=True)
+    power = fft.rfft(dev, n=n_fft, axis=1)
+    acf = fft.irfft(power * np.conjugate(power), n=n_fft, axis=1)[:, :n_step]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return acf / acf[:, :1]
+
+
+def autocorr_time(chains, c=5.0):
+    """Integrated autocorrelation time of each parameter.
+
+    Uses the walker-averaged autocorrelation function and the automatic
+    windowing of Sokal (1989), following `emcee.autocorr.integrated_time`.
+
+    Parameters
+    ----------
+    chains: array
+        MCMC chains with the shape (n_walker, n_step, n_dim).
+    c: float, optional
+        Step size for the window search. Default: 5.0
+
+    Return
+    ------
+        Autocorrelation time in steps with the shape (n_dim,).
+    """
+    acf = np.nanmean(autocorr_function(chains), axis=0)
+    taus = 2.0 * np.cumsum(acf, axis=0) - 1.0
+
+    # First step M with M >= c * tau(M) for each parameter
+    inside = np.arange(len(taus))[:, None] < c * taus
+    window = np.where(inside.all(axis=0), len(taus) - 1, np.argmin(inside, axis=0))
+
+    return taus[window, np.arange(taus.shape[1])]
+
+
+def gelman_rubin(chains, split=True):
+    """Gelman-Rubin potential scale reduction factor R-hat of each parameter.
+
+    Parameters
+    ----------
+    chains: array
+        MCMC chains with the shape (n_walker, n_step, n_dim).
+    split: bool, optional
+        Split each walker into two halves, which is also sensitive to trends
+        within the walkers. Default: True
+
+    Return
+    ------
+        R-hat with the shape (n_dim,).
+    """
+    chains = np.asarray(chains, dtype=float)
+    if split:
+        n_half = chains.shape[1] // 2
+        chains = np.concatenate(
+            [chains[:, :n_half], chains[:, chains.shape[1] - n_half:]], axis=0)
+
+    n_step = chains.shape[1]
+    within = chains.var(axis=1, ddof=1).mean(axis=0)
+    between = n_step * chains.mean(axis=1).var(axis=0, ddof=1)
+    var_hat = (n_step - 1.0) / n_step * within + between / n_step
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(var_hat / within)
+
+
+def chain_diagnostics(chains, lnprob=None, percentiles=(16, 50, 84), c=5.0):
+    """Summary statistics and convergence diagnostics of a set of chains.
+
+    Parameters
+    ----------
+    chains: array
+        MCMC chains with the shape (n_walker, n_step, n_dim).
+    lnprob: array, optional
+        ln(probability) with the shape (n_walker, n_step). Default: None
+    percentiles: list, optional
+        Percentiles of the parameters. Default: (16, 50, 84)
+    c: float, optional
+        Step size for the window search of `autocorr_time`. Default: 5.0
+
+    Return
+    ------
+    diagnostics: dict
+        Mean and standard deviation ('mean', 'std'), percentiles ('percentiles',
+        with the shape (n_percentile, n_dim)), R-hat ('r_hat'), autocorrelation
+        time in steps ('tau'), and effective sample size ('n_eff') of each
+        parameter. With `lnprob`, also the best parameters ('best').
+    """
+    chains = np.asarray(chains)
+    n_walker, n_step, n_dim = chains.shape
+    flat = chains.reshape(-1, n_dim)
+
+    tau = autocorr_time(chains, c=c)
+    diag = {'mean': flat.mean(axis=0, dtype=float),
+            'std': flat.std(axis=0, dtype=float),
+            'percentiles': np.percentile(flat, percentiles, axis=0),
+            'r_hat': gelman_rubin(chains),
+            'tau': tau,
+            'n_eff': n_walker * n_step / tau}
+
+    if lnprob is not None:
+        ind = np.unravel_index(np.argmax(lnprob), np.shape(lnprob))
+        diag['best'] = np.asarray(chains[ind], dtype=float)
+
+    return diag
+
+
+def thin_samples(samples, max_samples=20000, rng=None):
+    """Randomly select at most `max_samples` samples.
+
+    Parameters
+    ----------
+    samples: 2-D array
+        Samples with the shape (n_sample, n_dim).
+    max_samples: int, optional
+        Maximum number of samples. Default: 20000
+    rng: numpy.random.Generator or int, optional
+        Random number generator or seed. Default: None
+
+    Return
+    ------
+        The samples, or a random subset of them without replacement.
+    """
+    if max_samples is None or len(samples) <= max_samples:
+        return samples
+
+    rng = np.random.default_rng(rng)
+    return samples[np.sort(rng.choice(len(samples), max_samples, replace=False))]
+
+
+def plot_corner_fast(samples, labels, max_samples=20000, rng=None, fontsize=26,
+                     labelsize=20, **corner_kwargs):
+    """Corner plot of a random subset of the samples.
+
+    The samples are thinned to `max_samples` and only shown as histograms and
+    filled contours, which keeps the time and memory independent of the
+    length of the chains.
+
+    Parameters
+    ----------
+    samples: 2-D array
+        Samples with the shape (n_sample, n_dim).
+    labels: list
+        Labels of the parameters.
+    max_samples: int, optional
+        Maximum number of samples to use. Default: 20000
+    rng: numpy.random.Generator or int, optional
+        Random number generator or seed for the thinning. Default: None
+    **corner_kwargs:
+        Other parameters for `corner.corner`.
+
+    Return
+    ------
+        The figure.
+    """
+    import corner
+
+    kwargs = {'bins': 40, 'color': ORG(0.7), 'smooth': 2, 'labels': labels,
+              'label_kwargs': {'fontsize': fontsize},
+              'quantiles': [0.16, 0.5, 0.84], 'levels': [0.16, 0.50, 0.84],
+              'plot_contours': True, 'fill_contours': True, 'plot_datapoints': False,
+              'show_titles': True, 'title_kwargs': {"fontsize": labelsize},
+              'hist_kwargs': {"histtype": 'stepfilled', "alpha": 0.5, "edgecolor": "none"},
+              'use_math_text': True}
+    kwargs.update(corner_kwargs)
+
+    return corner.corner(
+        thin_samples(np.asarray(samples, dtype=float), max_samples, rng=rng), **kwargs)
+
+
+def _trace_quantiles(chain, quantiles, max_steps):
+    """Quantiles of the walkers at each step, binned to at most `max_steps`.
+
+    Return the step at the center of each bin and the quantiles with the shape
+    (n_quantile, n_bin).
+    """
+    n_walker, n_step = chain.shape
+    bin_size = int(np.ceil(n_step / float(max_steps)))
+    n_bin = n_step // bin_size
+    binned = chain[:, :n_bin * bin_size].reshape(n_walker, n_bin, bin_size)
+    binned = binned.transpose(1, 0, 2).reshape(n_bin, -1)
+
+    steps = (np.arange(n_bin) + 0.5) * bin_size
+
+    return steps, np.quantile(binned, quantiles, axis=1)
+
+
+def _plot_trace(ax, chain, color_map, max_walkers, max_steps, quantiles, alpha):
+    """Plot the walkers of one parameter, as lines or as quantile bands."""
+    n_walker, n_step = chain.shape
+    if n_walker <= max_walkers:
+        step = max(n_step // max_steps, 1)
+        steps = np.arange(0, n_step, step)
+        ax.plot(steps, chain[:, ::step].T, alpha=alpha, color=color_map(0.8),
+                drawstyle='steps')
+        return
+
+    steps, bands = _trace_quantiles(chain, quantiles, max_steps)
+    n_band = len(quantiles) // 2
+    for ii in range(n_band):
+        ax.fill_between(steps, bands[ii], bands[-ii - 1], step='mid', linewidth=0,
+                        color=color_map(0.4 + 0.5 * (ii + 1) / n_band), alpha=0.6)
+    if len(quantiles) % 2 == 1:
+        ax.plot(steps, bands[n_band], color=color_map(1.0), drawstyle='steps-mid',
+                linewidth=1.5)
+
+
+def plot_trace_bands(chains, labels, best=None, burnin=None, max_walkers=20,
+                     max_steps=500, quantiles=(0.025, 0.16, 0.5, 0.84, 0.975),
+                     n_bins=80, alpha=0.3, figsize=None):
+    """Trace plot that aggregates the walkers.
+
+    With more than `max_walkers` walkers, each step is summarized by the
+    quantiles of the walkers, shown as shaded bands. Long chains are binned to
+    at most `max_steps` steps, and the posterior is shown as a precomputed
+    histogram, so the number of plotted points does not grow with the chains.
+
+    Parameters
+    ----------
+    chains: array
+        MCMC chains with the shape (n_walker, n_step, n_dim).
+    labels: list
+        Labels of the parameters.
+    best: 1-D array, optional
+        Parameters to highlight. Default: None
+    burnin: array, optional
+        Chains of the burn-in stage with the same layout. Default: None
+    max_walkers: int, optional
+        Maximum number of walkers to plot individually. Default: 20
+    max_steps: int, optional
+        Maximum number of steps to plot. Default: 500
+    quantiles: list, optional
+        Quantiles of the bands, in increasing order. Default: (0.025, 0.16, 0.5, 0.84, 0.975)
+    n_bins: int, optional
+        Number of bins of the posterior histograms. Default: 80
+    alpha: float, optional
+        Transparency of the individual walkers. Default: 0.3
+    figsize: tuple, optional
+        Size of the figure. Default: None
+
+    Return
+    ------
+        The figure.
+    """
+    chains = np.asarray(chains)
+    n_param = len(labels)
+    n_col = 5 if burnin is not None else 3
+    fig = plt.figure(figsize=figsize if figsize is not None else (2 * n_col + 2, 3 * n_param))
+    fig.subplots_adjust(hspace=0.0, wspace=0.0, bottom=0.08, top=0.93,
+                        left=0.08, right=0.92)
+    gs = GridSpec(n_param, n_col)
+
+    for ii, label in enumerate(labels):
+        chain = chains[:, :, ii]
+        y_min, y_max = np.min(chain), np.max(chain)
+        if burnin is not None:
+            y_min = min(y_min, np.min(burnin[:, :, ii]))
+            y_max = max(y_max, np.max(burnin[:, :, ii]))
+        if y_max <= y_min:
+            y_min, y_max = y_min - 0.5, y_max + 0.5
+
+        ax1 = fig.add_subplot(gs[ii, n_col - 3:n_col - 1])
+        _plot_trace(ax1, chain, ORG, max_walkers, max_steps, quantiles, alpha)
+        ax1.set_xlim(0, chain.shape[1])
+        ax1.set_ylim(y_min, y_max)
+        ax1.tick_params(labelleft=False)
+
+        # Posterior histogram
+        ax2 = fig.add_subplot(gs[ii, -1])
+        counts, edges = np.histogram(chain, bins=np.linspace(y_min, y_max, n_bins + 1))
+        ax2.hist(edges[:-1], bins=edges, weights=counts, orientation='horizontal',
+                 alpha=0.7, color=ORG(0.9), edgecolor='none')
+        ax2.set_ylim(y_min, y_max)
+        ax2.xaxis.set_visible(False)
+        ax2.yaxis.tick_right()
+
+        if burnin is not None:
+            ax3 = fig.add_subplot(gs[ii, :2])
+            _plot_trace(ax3, burnin[:, :, ii], BLU, max_walkers, max_steps, quantiles, alpha)
+            ax3.set_xlim(0, burnin.shape[1])
+            ax3.set_ylim(y_min, y_max)
+            ax3.tick_params(labelleft=False)
+            ax3.set_ylabel(label)
+        else:
+            ax1.set_ylabel(label)
+
+        if best is not None:
+            for ax in [ax1, ax2]:
+                ax.axhline(best[ii], linestyle='--', linewidth=2, color=BLU(1.0), alpha=0.8)
+
+        if ii != n_param - 1:
+            ax1.tick_params(labelbottom=False)
+            if burnin is not None:
+                ax3.tick_params(labelbottom=False)
+
+        if ii == 0:
+            ax1.set_title(r"$\mathrm{Sampling}$")
+            ax2.set_title(r"$\mathrm{Posterior}$")
+            if burnin is not None:
+                ax3.set_title(r"$\mathrm{Burnin}$")
+
+    return fig
+
+
+def save_qa_figures(results, prefix, labels=None, burnin=None, max_samples=20000,
+                    dpi=80, **trace_kwargs):
+    """Save the corner and trace plots of a MCMC fit, and close the figures.
+
+    Meant for batch jobs that make the figures of many fits.
+
+    Parameters
+    ----------
+    results: dict
+        Results of `emcee_fit_one_sersic`, with the chains ('chains').
+    prefix: str
+        Prefix of the output files. The figures are saved as
+        `prefix_corner.png` and `prefix_trace.png`.
+    labels: list, optional
+        Labels of the parameters. Default: None, use the parameter index.
+    burnin: dict, optional
+        Results of the burn-in stage. Default: None
+    max_samples: int, optional
+        Maximum number of samples in the corner plot. Default: 20000
+    dpi: int, optional
+        Resolution of the figures. Default: 80
+    **trace_kwargs:
+        Other parameters for `plot_trace_bands`.
+
+    Return
+    ------
+        Names of the two figures.
+    """
+    chains = results['chains']
+    n_dim = chains.shape[-1]
+    if labels is None:
+        labels = [r'$\theta_{%d}$' % ii for ii in range(n_dim)]
+
+    fig_corner = plot_corner_fast(
+        chains.reshape(-1, n_dim), labels, max_samples=max_samples,
+        truths=results.get('best', None))
+    fig_trace = plot_trace_bands(
+        chains, labels, best=results.get('best', None),
+        burnin=None if burnin is None else burnin['chains'], **trace_kwargs)
+
+    files = []
+    for fig, suffix in [(fig_corner, 'corner'), (fig_trace, 'trace')]:
+        files.append('%s_%s.png' % (prefix, suffix))
+        fig.savefig(files[-1], dpi=dpi)
+        plt.close(fig)
+
+    return files
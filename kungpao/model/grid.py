@@ -0,0 +1,210 @@
+"""Grid-based posterior of the single Sersic model for 1-D profiles."""
+
+import numpy as np
+
+from scipy.special import log_ndtr, logsumexp, ndtri
+
+from kungpao.model.component import Sersic
+
+__all__ = ['SersicGrid']
+
+
+class SersicGrid(object):
+    """Posterior of the single Sersic model evaluated on a (n, Re) grid.
+
+    For a fixed radius array, the shapes of the Sersic profiles with I0 = 1 are
+    computed once for every (n, Re) pair of the grid. The profile is linear in
+    I0, so with a flat prior on I0 > 0 it can be marginalized analytically:
+
+        ln L(n, Re) = -0.5 * (C - A^2 / B) - 0.5 * ln(B) + ln(Phi(A / sqrt(B)))
+
+    where A = sum(w * rho * S), B = sum(w * S^2), C = sum(w * rho^2), w is the
+    inverse variance, and Phi is the normal CDF. For a stack of profiles, A and
+    B are just two matrix products. The prior on (n, Re) is flat on the grid
+    points, e.g. a log-spaced `re_grid` means a flat prior on log(Re).
+
+    Profiles are normalized in the same way as `sersic_1d.norm_prof`, so I0
+    is in unit of the median of the profile within the fitting range.
+
+    """
+    def __init__(self, rad, n_grid=None, re_grid=None, min_r=6.0, max_r=120.0):
+        """Constructor.
+
+        Parameters
+        ----------
+        rad: list or 1-D array
+            Radius array shared by all the profiles.
+        n_grid: 1-D array, optional
+            Grid of Sersic index. Default: 141 values between 1.0 and 8.0
+        re_grid: 1-D array, optional
+            Grid of effective radius. Default: 200 log-spaced values between
+            min_r and max_r.
+        min_r: float, optional
+            Minimal radii for fitting. Default=6.0
+        max_r: float, optional
+            Maximal radii for fitting. Default=120.0
+        """
+        self.rad = np.asarray(rad, dtype=float)
+        self.flag = (self.rad >= min_r) & (self.rad <= max_r)
+
+        self.n_grid = (np.linspace(1.0, 8.0, 141) if n_grid is None
+                       else np.asarray(n_grid, dtype=float))
+        self.re_grid = (np.logspace(np.log10(min_r), np.log10(max_r), 200)
+                        if re_grid is None else np.asarray(re_grid, dtype=float))
+
+        # Templates with the shape (n_n * n_re, n_rad_used)
+        n_mesh, re_mesh = np.meshgrid(self.n_grid, self.re_grid, indexing='ij')
+        self.templates = Sersic(
+            self.rad[self.flag], n_mesh.reshape(-1, 1), 1.0, re_mesh.reshape(-1, 1))
+        self.templates_sq = self.templates ** 2
+
+    @property
+    def shape(self):
+        """Shape of the (n, Re) grid."""
+        return (len(self.n_grid), len(self.re_grid))
+
+    def normalize(self, rho, err):
+        """Normalize a stack of profiles in the same way as `norm_prof`."""
+        rho = np.atleast_2d(np.asarray(rho, dtype=float))
+        err = np.atleast_2d(np.asarray(err, dtype=float))
+        norm = np.nanmedian(rho[:, self.flag], axis=1)
+
+        return rho / norm[:, None], err / norm[:, None], norm
+
+    def ln_likelihood(self, rho_norm, err_norm):
+        """ln(likelihood) on the grid, after marginalizing I0.
+
+        Parameters
+        ----------
+        rho_norm: 2-D array
+            Normalized profiles with the shape (N, n_rad).
+        err_norm: 2-D array
+            Normalized uncertainties with the shape (N, n_rad).
+
+        Returns
+        -------
+        ln_like: 2-D array
+            ln(likelihood) with the shape (N, n_n * n_re).
+        i0_best: 2-D array
+            Best-fit I0 at each grid point.
+        i0_var: 2-D array
+            Variance of I0 at each grid point.
+
+        """
+        rho_use = rho_norm[:, self.flag]
+        w_use = 1.0 / err_norm[:, self.flag] ** 2
+
+        a_mat = np.dot(w_use * rho_use, self.templates.T)
+        b_mat = np.dot(w_use, self.templates_sq.T)
+        c_vec = np.sum(w_use * rho_use ** 2, axis=1)
+
+        i0_best = a_mat / b_mat
+        ln_like = (-0.5 * (c_vec[:, None] - a_mat * i0_best) -
+                   0.5 * np.log(b_mat) + log_ndtr(a_mat / np.sqrt(b_mat)))
+
+        return ln_like, i0_best, 1.0 / b_mat
+
+    def fit(self, rho, err, percentiles=(16, 50, 84), return_posterior=False):
+        """Posterior summaries for one or a stack of profiles.
+
+        Parameters
+        ----------
+        rho: 1-D or 2-D array
+            Surface mass density profile(s), with the shape (n_rad,) or
+            (N, n_rad).
+        err: 1-D or 2-D array
+            Uncertainties of the profile(s).
+        percentiles: list, optional
+            Percentiles of the marginalized distributions. Default: (16, 50, 84)
+        return_posterior: bool, optional
+            Also return the posterior on the (n, Re) grid. Default: False
+
+        Returns
+        -------
+        results: dict
+            Best (MAP) parameters [n, I0, Re] ('best'), mean and standard
+            deviation of the parameters ('mean', 'std'), the percentiles
+            ('percentiles', with the shape (n_percentile, 3)), the normalization
+            factor ('norm'), and the posterior ('posterior', with the grid
+            shape). For a stack of profiles, all the values have an extra
+            first dimension. The percentiles of I0 use a Gaussian approximation.
+
+        """
+        single = np.ndim(rho) == 1
+        rho_norm, err_norm, norm = self.normalize(rho, err)
+        n_prof = rho_norm.shape[0]
+
+        ln_like, i0_best, i0_var = self.ln_likelihood(rho_norm, err_norm)
+        ln_post = ln_like - logsumexp(ln_like, axis=1)[:, None]
+        post = np.exp(ln_post)
+
+        # MAP on the grid
+        ind_best = np.argmax(ln_post, axis=1)
+        ind_n, ind_re = np.unravel_index(ind_best, self.shape)
+        best = np.stack([self.n_grid[ind_n], i0_best[np.arange(n_prof), ind_best],
+                         self.re_grid[ind_re]], axis=1)
+
+        # Marginalized distributions
+        post_grid = post.reshape((n_prof,) + self.shape)
+        post_n, post_re = post_grid.sum(axis=2), post_grid.sum(axis=1)
+
+        n_mean = np.dot(post_n, self.n_grid)
+        re_mean = np.dot(post_re, self.re_grid)
+        i0_mean = np.sum(post * i0_best, axis=1)
+
+        n_std = np.sqrt(np.maximum(np.dot(post_n, self.n_grid ** 2) - n_mean ** 2, 0.0))
+        re_std = np.sqrt(np.maximum(np.dot(post_re, self.re_grid ** 2) - re_mean ** 2, 0.0))
+        i0_std = np.sqrt(np.maximum(
+            np.sum(post * (i0_var + i0_best ** 2), axis=1) - i0_mean ** 2, 0.0))
+
+        mean = np.stack([n_mean, i0_mean, re_mean], axis=1)
+        std = np.stack([n_std, i0_std, re_std], axis=1)
+
+        quantiles = np.asarray(percentiles, dtype=float) / 100.0
+        pcts = np.stack([
+            _grid_percentiles(self.n_grid, post_n, quantiles),
+            i0_mean[:, None] + i0_std[:, None] * ndtri(quantiles)[None, :],
+            _grid_percentiles(self.re_grid, post_re, quantiles)], axis=2)
+
+        results = {'best': best, 'mean': mean, 'std': std,
+                   'percentiles': pcts, 'norm': norm}
+        if return_posterior:
+            results['posterior'] = post_grid
+
+        if single:
+            return {key: val[0] for key, val in results.items()}
+
+        return results
+
+
+def _grid_percentiles(grid, pdf, quantiles):
+    """Percentiles of marginalized distributions on a grid.
+
+    Parameters
+    ----------
+    grid: 1-D array
+        The grid, with K values.
+    pdf: 2-D array
+        Normalized probabilities with the shape (N, K).
+    quantiles: 1-D array
+        Quantiles between 0 and 1.
+
+    Returns
+    -------
+        Array with the shape (N, n_quantile).
+
+    """
+    cdf = np.cumsum(pdf, axis=1)
+    n_grid = len(grid)
+
+    values = []
+    for q in quantiles:
+        # Linear interpolation of the CDF
+        upp = np.clip((cdf < q).sum(axis=1), 1, n_grid - 1)
+        low = upp - 1
+        cdf_low = np.take_along_axis(cdf, low[:, None], 1)[:, 0]
+        cdf_upp = np.take_along_axis(cdf, upp[:, None], 1)[:, 0]
+        frac = np.clip((q - cdf_low) / np.maximum(cdf_upp - cdf_low, 1e-300), 0.0, 1.0)
+        values.append(grid[low] + frac * (grid[upp] - grid[low]))
+
+    return np.stack(values, axis=1)
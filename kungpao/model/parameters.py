@@ -53,6 +53,17 @@ class ProfileParams(object):
         # Distributions of priors
         self._distr = [param['distr'] for _, param in self.cfg_ini.items()]
 
+        # Arrays of prior parameters, so that all the parameters can be
+        # evaluated at once
+        self._flat = np.array([t == 'flat' for t in self._types])
+        self._student = ~self._flat
+        self._flat_low = np.array([d.low for d in self._distr])[self._flat]
+        self._flat_upp = np.array([d.upp for d in self._distr])[self._flat]
+        self._student_loc = np.array([d.loc for d in self._distr])[self._student]
+        self._student_scale = np.array([d.scale for d in self._distr])[self._student]
+        self._student_df = np.array(
+            [getattr(d, 'df', 1) for d in self._distr], dtype=float)[self._student]
+
     def check(self):
         """Check if the parameter is in the right format"""
         for label, param in self.cfg_ini.items():
@@ -128,8 +139,7 @@ class ProfileParams(object):
             Random samples following the prior distributions.
 
         """
-        return np.asarray(
-            [self.transform(np.random.randn(self.n_param) * level + 0.5) for i in range(nsamples)])
+        return self.transform(np.random.randn(nsamples, self.n_param) * level + 0.5)
 
     def lnprior(self, theta, nested=False):
         """Public version of _ln_prior.
@@ -137,20 +147,21 @@ class ProfileParams(object):
         Parameters
         ----------
         theta : list or array
-            A set of parameter values.
+            A set of parameter values, or an array with the shape (N, n_param)
+            for N sets of parameters.
         nested : bool, optional
             True is using nested sampling instead. Will return 0 for any finite ln(prior).
 
         Return
         ------
-        ln_prior : float
-            Sum of the ln(prior)
+        ln_prior : float or array
+            Sum of the ln(prior). An array with the shape (N,) for 2-D input.
 
         """
         lnp = self._lnprior(theta)
 
-        if nested and np.isfinite(lnp):
-            return 0.0
+        if nested:
+            return np.where(np.isfinite(lnp), 0.0, lnp)[()]
 
         return lnp
 
@@ -159,10 +170,9 @@ class ProfileParams(object):
 
         Parameters
         ----------
-        theta_cuba : list or array
-            A set of parameter values in the unit hyper-cube.
-        nested : bool, optional
-            True is using nested sampling instead. Will return 0 for any finite ln(prior).
+        theta_cube : list or array
+            A set of parameter values in the unit hyper-cube, or an array with
+            the shape (N, n_param).
 
         Return
         ------
@@ -170,7 +180,16 @@ class ProfileParams(object):
             Parameters values.
 
         """
-        return np.array([d.unit_transform(u) for (u, d) in zip(theta_cube, self._distr)])
+        theta_cube = np.asarray(theta_cube, dtype=float)
+        theta = np.empty_like(theta_cube)
+
+        theta[..., self._flat] = priors.tophat_ppf(
+            theta_cube[..., self._flat], self._flat_low, self._flat_upp)
+        theta[..., self._student] = priors.student_ppf(
+            theta_cube[..., self._student], self._student_loc,
+            self._student_scale, self._student_df)
+
+        return theta
 
     def _lnprior(self, theta):
         """Return a scalar which is the ln of the product of the prior
@@ -179,15 +198,24 @@ class ProfileParams(object):
         Parameters
         ----------
         theta : list or array
-            A set of parameter values.
+            A set of parameter values, or an array with the shape (N, n_param).
 
         Return
         ------
-        ln_prior : float
+        ln_prior : float or array
             Sum of the ln(prior)
 
         """
-        return np.sum([d.lnp(p) for (p, d) in zip(theta, self._distr)])
+        theta = np.asarray(theta, dtype=float)
+        lnp = np.empty_like(theta)
+
+        lnp[..., self._flat] = priors.tophat_lnp(
+            theta[..., self._flat], self._flat_low, self._flat_upp)
+        lnp[..., self._student] = priors.student_lnp(
+            theta[..., self._student], self._student_loc,
+            self._student_scale, self._student_df)
+
+        return lnp.sum(axis=-1)
 
     def get_ini(self):
         """Return an array of initial values for parameters"""
@@ -4,8 +4,51 @@ import numpy as np
 
 from scipy.stats import t
 from scipy.stats import uniform
+from scipy.special import gammaln, stdtr, stdtrit
 
-__all__ = ['StudentT', 'TopHat']
+__all__ = ['StudentT', 'TopHat', 'tophat_lnp', 'tophat_ppf', 'tophat_cdf',
+           'student_lnp', 'student_ppf', 'student_cdf']
+
+
+def tophat_lnp(x, low, upp):
+    """ln(PDF) of the flat distribution between low and upp.
+
+    All the inputs follow the Numpy broadcasting rules, so `x` can be an array
+    with the shape (N, n_param) when `low` and `upp` have the shape (n_param,).
+    """
+    x = np.asarray(x, dtype=float)
+    return np.where((x >= low) & (x <= upp), -np.log(upp - low), -np.inf)[()]
+
+
+def tophat_ppf(u, low, upp):
+    """Inverse of the CDF of the flat distribution between low and upp."""
+    u = np.asarray(u, dtype=float)
+    return np.where((u >= 0.0) & (u <= 1.0), low + u * (upp - low), np.nan)[()]
+
+
+def tophat_cdf(x, low, upp):
+    """CDF of the flat distribution between low and upp."""
+    return np.clip((np.asarray(x, dtype=float) - low) / (upp - low), 0.0, 1.0)[()]
+
+
+def student_lnp(x, loc, scale, df):
+    """ln(PDF) of the Student-t distribution."""
+    z = (np.asarray(x, dtype=float) - loc) / scale
+    return (gammaln(0.5 * (df + 1.0)) - gammaln(0.5 * df) -
+            0.5 * np.log(df * np.pi) - np.log(scale) -
+            0.5 * (df + 1.0) * np.log1p(z ** 2 / df))
+
+
+def student_ppf(u, loc, scale, df):
+    """Inverse of the CDF of the Student-t distribution."""
+    # Use the symmetry of the distribution, stdtrit does not handle u=0 well
+    u = np.asarray(u, dtype=float)
+    return loc + scale * np.sign(u - 0.5) * stdtrit(df, np.maximum(u, 1.0 - u))
+
+
+def student_cdf(x, loc, scale, df):
+    """CDF of the Student-t distribution."""
+    return stdtr(df, (np.asarray(x, dtype=float) - loc) / scale)
 
 
 class TopHat(object):
@@ -31,7 +74,7 @@ class TopHat(object):
 
     def get_mean(self):
         """Get the mean value of the distribution. Can be used as initial values."""
-        return self.distr.mean(loc=self.loc, scale=self.scale)
+        return 0.5 * (self._low + self._upp)
 
     def lnp(self, x):
         """Compute the value of the probability desnity function at x and
@@ -47,7 +90,7 @@ class TopHat(object):
         lnp : float or numpy array
             The natural log of the prior probability at x
         """
-        return self.distr.logpdf(x, loc=self.loc, scale=self.scale)
+        return tophat_lnp(x, self._low, self._upp)
 
     def unit_transform(self, x):
         """Go from a value of the CDF (between 0 and 1) to the corresponding
@@ -63,7 +106,7 @@ class TopHat(object):
             The parameter value corresponding to the value of the CDF given by `unit_arr`.
 
         """
-        return self.distr.ppf(x, loc=self.loc, scale=self.scale)
+        return tophat_ppf(x, self._low, self._upp)
 
     def inverse_unit_transform(self, x):
         """Go from the parameter value to the unit coordinate using the cdf.
@@ -78,7 +121,7 @@ class TopHat(object):
             The corresponding value in unit coordinate.
 
         """
-        return self.distr.cdf(x, loc=self.loc, scale=self.scale)
+        return tophat_cdf(x, self._low, self._upp)
 
     def sample(self, nsample):
         """Sample the distribution.
@@ -94,7 +137,7 @@ class TopHat(object):
             `nsample` values that follow the distribution.
 
         """
-        return self.distr.rvs(loc=self.loc, scale=self.scale, size=nsample)
+        return np.random.uniform(self._low, self._upp, size=nsample)
 
     @property
     def low(self):
@@ -148,7 +191,8 @@ class StudentT(object):
 
     def get_mean(self):
         """Get the mean value of the distribution. Can be used as initial values."""
-        return self.distr.mean(loc=self.loc, scale=self.scale, df=self.df)
+        # The mean is not defined for df <= 1
+        return self._loc if self._df > 1 else np.nan
 
     def lnp(self, x):
         """Compute the value of the probability desnity function at x and
@@ -164,7 +208,7 @@ class StudentT(object):
         lnp : float or numpy array
             The natural log of the prior probability at x
         """
-        return self.distr.logpdf(x, loc=self.loc, scale=self.scale, df=self.df)
+        return student_lnp(x, self._loc, self._scale, self._df)
 
     def unit_transform(self, x):
         """Go from a value of the CDF (between 0 and 1) to the corresponding
@@ -180,7 +224,7 @@ class StudentT(object):
             The parameter value corresponding to the value of the CDF given by `unit_arr`.
 
         """
-        return self.distr.ppf(x, loc=self.loc, scale=self.scale, df=self.df)
+        return student_ppf(x, self._loc, self._scale, self._df)
 
     def inverse_unit_transform(self, x):
         """Go from the parameter value to the unit coordinate using the cdf.
@@ -195,7 +239,7 @@ class StudentT(object):
             The corresponding value in unit coordinate.
 
         """
-        return self.distr.cdf(x, loc=self.loc, scale=self.scale, df=self.df)
+        return student_cdf(x, self._loc, self._scale, self._df)
 
     def sample(self, nsample, limit=True):
         """Sample the distribution.
@@ -214,16 +258,12 @@ class StudentT(object):
 
         """
         if not limit:
-            return self.distr.rvs(
-                loc=self.loc, scale=self.scale, df=self.df, size=nsample)
-        else:
-            sample = []
-            while len(sample) < nsample:
-                rv = self.distr.rvs(df=self.df, loc=self.loc, scale=self.scale)
-                if self.low < rv <= self.upp:
-                    sample.append(rv)
-
-            return np.asarray(sample)
+            return self._loc + self._scale * np.random.standard_t(self._df, size=nsample)
+
+        # Truncated distribution: uniformly sample the CDF within the range
+        cdf_low, cdf_upp = self.inverse_unit_transform([self.low, self.upp])
+
+        return self.unit_transform(np.random.uniform(cdf_low, cdf_upp, size=nsample))
 
     @property
     def scale(self):
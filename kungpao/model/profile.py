@@ -0,0 +1,203 @@
+"""Composable 1-D profile models with multiple components."""
+
+import numpy as np
+
+from kungpao.model.component import b_n
+
+__all__ = ['SersicComponent', 'ExponentialComponent', 'ProfileModel']
+
+
+class SersicComponent(object):
+    """Sersic component: I_e * exp(-b_n * ((R / R_e) ** (1 / n) - 1)).
+
+    The parameters are (n, I0, Re), where I0 is the intensity at Re.
+
+    """
+    names = ['n', 'I0', 'Re']
+    labels = [r'$n_{\rm Ser}$', r'$I_{0}$', r'$R_{\rm e}$']
+    amplitude = 1
+
+    def __init__(self, name=''):
+        self.name = name
+
+    def shape(self, grid, shape_params):
+        """Profile with unit amplitude.
+
+        Parameters
+        ----------
+        grid: dict
+            Radius grid, with the radius ('rad') and its natural log ('log_rad').
+        shape_params: 2-D array
+            Parameters (n, Re) with the shape (N, 2).
+
+        Return
+        ------
+            Profiles with the shape (N, n_rad).
+        """
+        n, r_e = shape_params[:, 0:1], shape_params[:, 1:2]
+        return np.exp(-b_n(n) * (np.exp((grid['log_rad'] - np.log(r_e)) / n) - 1.0))
+
+    def default_config(self, rad, rho_norm, min_r, max_r):
+        """Default flat priors for a normalized profile."""
+        rho_use = rho_norm[(rad >= min_r) & (rad <= max_r)]
+        return [
+            {'ini': 2.0, 'min': 0.5, 'max': 8.0, 'sig': 1.0},
+            {'ini': np.median(rho_use), 'min': 0.0, 'max': rho_use.max(),
+             'sig': np.std(rho_use)},
+            {'ini': np.sqrt(min_r * max_r), 'min': min_r / 10.0, 'max': max_r, 'sig': 20.0}]
+
+
+class ExponentialComponent(object):
+    """Exponential component: I0 * exp(-R / h).
+
+    The parameters are (I0, h), where I0 is the central intensity.
+
+    """
+    names = ['I0', 'h']
+    labels = [r'$I_{0}$', r'$h$']
+    amplitude = 0
+
+    def __init__(self, name=''):
+        self.name = name
+
+    def shape(self, grid, shape_params):
+        """Profile with unit amplitude, see `SersicComponent.shape`."""
+        return np.exp(-grid['rad'] / shape_params[:, 0:1])
+
+    def default_config(self, rad, rho_norm, min_r, max_r):
+        """Default flat priors for a normalized profile."""
+        rho_use = rho_norm[(rad >= min_r) & (rad <= max_r)]
+        return [
+            {'ini': rho_use.max(), 'min': 0.0, 'max': 10.0 * rho_use.max(),
+             'sig': np.std(rho_use)},
+            {'ini': np.sqrt(min_r * max_r) / 2.0, 'min': min_r / 10.0, 'max': max_r,
+             'sig': 10.0}]
+
+
+class ProfileModel(object):
+    """Sum of 1-D profile components.
+
+    The parameters of the components are concatenated in the same order as
+    the components, e.g. [n_1, I0_1, Re_1, I0_2, h_2] for a Sersic and an
+    exponential component. When there is more than one component, the
+    parameter names get the name of the component, or its index, as suffix.
+
+    Each component is the amplitude times a profile of the other parameters.
+    These profiles are cached for each radius grid, together with the log of
+    the radius, and are only computed again for the models whose non-amplitude
+    parameters have changed.
+
+    """
+    def __init__(self, components, max_grids=8):
+        """Constructor.
+
+        Parameters
+        ----------
+        components: list
+            Component objects, e.g. [SersicComponent(), ExponentialComponent()].
+        max_grids: int, optional
+            Number of radius grids to keep in the cache. Default: 8
+        """
+        self.components = list(components)
+        self.max_grids = max_grids
+        self._grids = {}
+
+        self.slices, self.names, self.labels = [], [], []
+        start = 0
+        for ii, comp in enumerate(self.components):
+            self.slices.append(slice(start, start + len(comp.names)))
+            start += len(comp.names)
+            suffix = ''
+            if len(self.components) > 1:
+                suffix = '_' + (comp.name if comp.name else str(ii + 1))
+            self.names += [name + suffix for name in comp.names]
+            self.labels += [label + suffix.replace('_', ' ') for label in comp.labels]
+
+        self.n_param = start
+
+    def _grid(self, rad):
+        """Get the cache of a radius grid."""
+        rad = np.asarray(rad, dtype=float)
+        key = (rad.shape, hash(rad.tobytes()))
+        if key not in self._grids:
+            if len(self._grids) >= self.max_grids:
+                self._grids.pop(next(iter(self._grids)))
+            with np.errstate(divide='ignore'):
+                self._grids[key] = {'rad': rad, 'log_rad': np.log(rad),
+                                    'shapes': [None] * len(self.components)}
+
+        return self._grids[key]
+
+    def _shape(self, grid, ii, shape_params):
+        """Profiles of one component, reusing the cached ones when possible."""
+        cached = grid['shapes'][ii]
+        if cached is not None and cached[0].shape == shape_params.shape:
+            same = np.all(cached[0] == shape_params, axis=1)
+            if same.all():
+                return cached[1]
+            values = cached[1].copy()
+            values[~same] = self.components[ii].shape(grid, shape_params[~same])
+        else:
+            values = self.components[ii].shape(grid, shape_params)
+
+        grid['shapes'][ii] = (shape_params.copy(), values)
+
+        return values
+
+    def __call__(self, rad, theta):
+        """Evaluate the models.
+
+        Parameters
+        ----------
+        rad: 1-D array
+            Radius array.
+        theta: 1-D or 2-D array
+            Parameters with the shape (n_param,) or (N, n_param).
+
+        Return
+        ------
+            Profiles with the shape (n_rad,) or (N, n_rad).
+        """
+        theta = np.asarray(theta, dtype=float)
+        theta_2d = np.atleast_2d(theta)
+        grid = self._grid(rad)
+
+        model = 0.0
+        for ii, (comp, block) in enumerate(zip(self.components, self.slices)):
+            params = theta_2d[:, block]
+            shape_params = np.delete(params, comp.amplitude, axis=1)
+            model = model + (params[:, comp.amplitude:comp.amplitude + 1] *
+                             self._shape(grid, ii, shape_params))
+
+        return model if theta.ndim > 1 else model[0]
+
+    def param_config(self, rad, rho_norm, min_r=6.0, max_r=120.0):
+        """Default parameter configuration for `ProfileParams`.
+
+        Parameters
+        ----------
+        rad: 1-D array
+            Radius array.
+        rho_norm: 1-D array
+            Normalized profile, see `sersic_1d.config_params`.
+        min_r: float, optional
+            Minimal radii for fitting. Default=6.0
+        max_r: float, optional
+            Maximal radii for fitting. Default=120.0
+
+        Return
+        ------
+            Dictionary of flat priors for all the parameters.
+        """
+        rad, rho_norm = np.asarray(rad, dtype=float), np.asarray(rho_norm, dtype=float)
+
+        configs = []
+        for comp in self.components:
+            configs += comp.default_config(rad, rho_norm, min_r, max_r)
+
+        param_config = {}
+        for name, label, config in zip(self.names, self.labels, configs):
+            config.update({'name': name, 'label': label, 'type': 'flat'})
+            param_config[name] = config
+
+        return param_config
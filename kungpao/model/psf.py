@@ -0,0 +1,173 @@
+"""Convolution of 1-D profiles with a circular PSF."""
+
+import copy
+
+import numpy as np
+
+from scipy.special import i0e
+
+from kungpao.model.component import Sersic, Sersic_jacobian
+
+__all__ = ['PSFOperator1D']
+
+# numpy>=2.0 renamed trapz to trapezoid
+_trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
+class PSFOperator1D(object):
+    """Linear operator that convolves a circular 1-D profile with a circular PSF.
+
+    For a circularly symmetric profile f(r), the PSF-convolved profile is
+
+        g(R) = int_0^inf f(r) K(R, r) r dr,  K(R, r) = int_0^2pi p(d) dtheta
+
+    where d^2 = R^2 + r^2 - 2 R r cos(theta). The model only needs to be
+    evaluated on a fixed set of radii `r_fine`: log-spaced from a very small
+    radius, so that the central cusp of a high-index Sersic profile is
+    resolved, and with steps no larger than `max_step` at large radii. Between
+    these radii the profile is linearly interpolated, and the integral over
+    each interval is precomputed on a much denser grid that resolves the PSF.
+    After that, convolving a profile is one matrix-vector product:
+    g(rad) = matrix . f(r_fine). With the default settings, PSF-convolved
+    Sersic profiles with 1 < n < 8 are accurate to about 0.5%.
+
+    """
+    def __init__(self, rad, psf_sigma=None, psf_profile=None, d_log=0.1,
+                 r_min=None, max_step=None, n_sub=16, n_theta=128):
+        """Constructor.
+
+        Parameters
+        ----------
+        rad: list or 1-D array
+            Radius array of the observed profile.
+        psf_sigma: float, optional
+            Sigma of a circular Gaussian PSF, in the same unit as `rad`.
+        psf_profile: tuple of two 1-D arrays, optional
+            (radius, intensity) of a circular PSF. Used when `psf_sigma` is None.
+            The PSF does not need to be normalized.
+        d_log: float, optional
+            Step of `r_fine` in natural log of radius. Default: 0.1
+        r_min: float, optional
+            Smallest radius of `r_fine`. The profile is assumed to be constant
+            within it. Default: 1E-4 of the PSF size.
+        max_step: float, optional
+            Largest step of `r_fine`. Default: half of the PSF size.
+        n_sub: int, optional
+            Number of sub-steps per interval used to build the matrix. Default: 16
+        n_theta: int, optional
+            Number of angles used for a non-Gaussian PSF. Default: 128
+        """
+        if psf_sigma is None and psf_profile is None:
+            raise Exception("# Need either psf_sigma or psf_profile!")
+
+        self.rad = np.asarray(rad, dtype=float)
+        self.psf_sigma = psf_sigma
+
+        if psf_sigma is not None:
+            psf_size = float(psf_sigma)
+        else:
+            psf_rad, psf_val = (np.asarray(arr, dtype=float) for arr in psf_profile)
+            # Normalize the PSF so that 2 * pi * int p(r) r dr = 1
+            psf_val = psf_val / (2.0 * np.pi * _trapezoid(psf_val * psf_rad, psf_rad))
+            self.psf_profile = (psf_rad, psf_val)
+            psf_size = np.sqrt(
+                _trapezoid(psf_val * psf_rad ** 3, psf_rad) /
+                _trapezoid(psf_val * psf_rad, psf_rad) / 2.0)
+
+        # Radii to evaluate the intrinsic profile
+        r_min = 1E-4 * psf_size if r_min is None else r_min
+        max_step = 0.5 * psf_size if max_step is None else max_step
+        r_max = self.rad.max() + 10.0 * psf_size
+        r_break = min(max(max_step / np.expm1(d_log), r_min), r_max)
+        r_log = np.exp(np.arange(np.log(r_min), np.log(r_break), d_log))
+        r_lin = np.linspace(r_break, r_max, int(np.ceil((r_max - r_break) / max_step)) + 1)
+        self.r_fine = np.concatenate([r_log, r_lin])
+
+        # Dense grid for the integration, and the linear interpolation from
+        # r_fine to it
+        r_dense = np.concatenate(
+            [np.linspace(0.0, r_min, n_sub + 1)[:-1]] +
+            [np.linspace(r_0, r_1, n_sub + 1)[:-1]
+             for r_0, r_1 in zip(self.r_fine[:-1], self.r_fine[1:])] + [self.r_fine[-1:]])
+        interp = _interp_matrix(self.r_fine, r_dense)
+
+        # Trapezoidal weights of the dense grid
+        weights = np.zeros_like(r_dense)
+        steps = np.diff(r_dense)
+        weights[:-1] += 0.5 * steps
+        weights[1:] += 0.5 * steps
+
+        if psf_sigma is not None:
+            kernel = self._gaussian_kernel(self.rad[:, None], r_dense[None, :])
+        else:
+            kernel = self._profile_kernel(self.rad, r_dense, n_theta)
+
+        self.matrix = np.dot(kernel * (r_dense * weights)[None, :], interp)
+
+    def _gaussian_kernel(self, rad, r_dense):
+        """Angle-integrated kernel of a Gaussian PSF."""
+        var = self.psf_sigma ** 2
+        return (np.exp(-(rad - r_dense) ** 2 / (2.0 * var)) *
+                i0e(rad * r_dense / var) / var)
+
+    def _profile_kernel(self, rad, r_dense, n_theta):
+        """Angle-integrated kernel of a tabulated PSF."""
+        psf_rad, psf_val = self.psf_profile
+        theta = (np.arange(n_theta) + 0.5) * (np.pi / n_theta)
+
+        kernel = np.zeros((len(rad), len(r_dense)))
+        for cos_t in np.cos(theta):
+            dist = np.sqrt(np.maximum(
+                rad[:, None] ** 2 + r_dense[None, :] ** 2 -
+                2.0 * rad[:, None] * r_dense[None, :] * cos_t, 0.0))
+            kernel += np.interp(dist, psf_rad, psf_val, right=0.0)
+
+        # Symmetric in theta, so only [0, pi] is used
+        return kernel * (2.0 * np.pi / n_theta)
+
+    def convolve(self, prof_fine):
+        """Convolve intrinsic profile(s) evaluated at `r_fine`.
+
+        Parameters
+        ----------
+        prof_fine: 1-D or 2-D array
+            Intrinsic profile(s) with the shape (n_fine,) or (N, n_fine).
+
+        Return
+        ------
+            Convolved profile(s) at `rad`.
+        """
+        return np.dot(prof_fine, self.matrix.T)
+
+    def sersic(self, n, I_e, r_e):
+        """PSF-convolved Sersic profile at `rad`.
+
+        The parameters can be arrays with the shape (N, 1) to get N profiles.
+        """
+        return self.convolve(Sersic(self.r_fine, n, I_e, r_e))
+
+    def sersic_jacobian(self, n, I_e, r_e):
+        """Derivatives of the PSF-convolved Sersic profile, see `Sersic_jacobian`."""
+        return np.dot(self.matrix, Sersic_jacobian(self.r_fine, n, I_e, r_e))
+
+    def select(self, flag):
+        """New operator for a subset of `rad`, e.g. the fitting range."""
+        new = copy.copy(self)
+        new.rad = self.rad[flag]
+        new.matrix = self.matrix[flag]
+
+        return new
+
+
+def _interp_matrix(x_node, x_new):
+    """Matrix of the linear interpolation from x_node to x_new."""
+    ind = np.clip(np.searchsorted(x_node, x_new, side='right') - 1, 0, len(x_node) - 2)
+    # Constant outside the nodes
+    frac = np.clip((x_new - x_node[ind]) / (x_node[ind + 1] - x_node[ind]), 0.0, 1.0)
+
+    matrix = np.zeros((len(x_new), len(x_node)))
+    rows = np.arange(len(x_new))
+    matrix[rows, ind] = 1.0 - frac
+    matrix[rows, ind + 1] = frac
+
+    return matrix
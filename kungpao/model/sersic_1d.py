@@ -1,7 +1,6 @@
 """Fit single Sersic 1-D profile"""
 
 import numpy as np
-from numpy.random import multivariate_normal
 
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
@@ -12,8 +11,11 @@ from scipy.optimize import curve_fit
 import corner
 import emcee
 
-from kungpao.model.component import Sersic
+from kungpao.model.component import Sersic, Sersic_jacobian
 from kungpao.model.parameters import ProfileParams
+from kungpao.model.chains import ChainStore, chain_summary, run_until_converged
+from kungpao.model.pool import LnProbPool
+from kungpao.model.diagnostics import thin_samples, plot_corner_fast, plot_trace_bands
 
 ORG = plt.get_cmap('OrRd')
 ORG_2 = plt.get_cmap('YlOrRd')
@@ -42,9 +44,9 @@ rcParams.update({'axes.titlepad': '10.0'})
 rcParams.update({'font.size': 25})
 
 
-__all__ = ['lnlike_prof', 'norm_prof', 'config_params', 'ln_probability',
-           'prof_curvefit', 'update_params', 'reinitialize_ball_covar',
-           'emcee_fit_one_sersic', 'organize_results', 'plot_mcmc_corner',
+__all__ = ['lnlike_prof', 'norm_prof', 'config_params', 'sersic_param_config', 'ln_probability',
+           'BatchLnProbability', 'prof_curvefit', 'update_params', 'reinitialize_ball_covar',
+           'map_fit_one_sersic', 'emcee_fit_one_sersic', 'dynesty_fit_one_sersic', 'organize_results', 'plot_mcmc_corner',
            'plot_mcmc_trace', 'display_model_1d']
 
 
@@ -222,7 +224,143 @@ def ln_probability(theta, params, rad, rho, err, nested=False):
     return ln_prior + lnlike_prof(theta, rad, rho, err)
 
 
-def prof_curvefit(func, rad, rho, err, params, min_r=6.0, max_r=120.0):
+class BatchLnProbability(object):
+    """Ln(probability) of the single Sersic model for an ensemble of walkers.
+
+    The radial mask, the inverse variance and the normalization term of the
+    likelihood are computed once. Calling the object with an array of shape
+    (n_walkers, n_param) returns all the ln(probability) in one pass, which
+    can be used with `emcee.EnsembleSampler(vectorize=True)`. A single set of
+    parameters still returns a float, so it also works with a `pool`.
+
+    """
+    def __init__(self, params, rad, rho, err, min_r=6.0, max_r=120.0, nested=False,
+                 psf=None, model=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        params: ProfileParams object
+            Object for model parameters.
+        rad: list or 1-D array
+            Radius array.
+        rho: list or 1-D array
+            Surface mass density profile.
+        err: list or 1-D array
+            Uncertainties of surface mass density profile.
+        min_r: float, optional
+            Minimal radii for fitting. Default=6.0
+        max_r: float, optional
+            Maximal radii for fitting. Default=120.0
+        nested: bool, optional
+            Using dynamical nested sampling or not. Default:False.
+        psf: PSFOperator1D object, optional
+            Convolve the model with the PSF. Should be built for `rad`.
+            Default: None
+        model: ProfileModel object, optional
+            Model of the profile. The parameters should follow the order of
+            the model parameters. Default: None, single Sersic model.
+        """
+        rad = np.asarray(rad, dtype=float)
+        flag = (rad >= min_r) & (rad <= max_r)
+
+        var = np.asarray(err, dtype=float)[flag] ** 2
+
+        self.params = params
+        self.nested = nested
+        self.rad = rad[flag]
+        self.psf = None if psf is None else _check_psf(psf, rad).select(flag)
+        self.model = model
+        self.rho = np.asarray(rho, dtype=float)[flag]
+        self.ivar = 1.0 / var
+        self.ln_norm = np.log(2 * np.pi * var.sum())
+
+    def lnlike(self, theta):
+        """LnLikelihood of the model profiles.
+
+        Parameters
+        ----------
+        theta: 2-D array
+            Model parameters with the shape (N, n_param), e.g. [n, I0, Re]
+            for the single Sersic model.
+
+        Returns
+        -------
+            The ln(likelihood) of the N model profiles.
+
+        """
+        theta = np.atleast_2d(theta)
+        rad = self.rad if self.psf is None else self.psf.r_fine
+        if self.model is None:
+            model = Sersic(rad, theta[:, 0:1], theta[:, 1:2], theta[:, 2:3])
+        else:
+            model = self.model(rad, theta)
+        if self.psf is not None:
+            model = self.psf.convolve(model)
+        chi2 = ((model - self.rho) ** 2 * self.ivar).sum(axis=1)
+
+        lnlike = -0.5 * (chi2 + self.ln_norm)
+
+        return np.where(np.isfinite(lnlike), lnlike, -np.inf)
+
+    def __call__(self, theta):
+        """The ln(probability) of one or a set of model parameters."""
+        theta = np.asarray(theta, dtype=float)
+        theta_2d = np.atleast_2d(theta)
+
+        lnprob = np.atleast_1d(self.params.lnprior(theta_2d, nested=self.nested))
+        valid = np.isfinite(lnprob)
+        lnprob[~valid] = -np.inf
+        if valid.any():
+            lnprob[valid] += self.lnlike(theta_2d[valid])
+
+        return lnprob if theta.ndim > 1 else lnprob[0]
+
+
+def _check_psf(psf, rad):
+    """Make sure the PSF operator is built for the radius array."""
+    if len(psf.rad) != len(rad) or not np.allclose(psf.rad, rad):
+        raise Exception("# The PSF operator is built for a different radius array!")
+
+    return psf
+
+
+def _sersic_model(psf, rad, min_r, max_r, model=None):
+    """Model and Jacobian functions for `prof_curvefit`, with or without PSF."""
+    if model is not None:
+        return _profile_model(psf, rad, min_r, max_r, model)
+
+    if psf is None:
+        return Sersic, Sersic_jacobian
+
+    rad = np.asarray(rad, dtype=float)
+    psf_use = _check_psf(psf, rad).select((rad >= min_r) & (rad <= max_r))
+
+    def func(_, n, I_e, r_e):
+        return psf_use.sersic(n, I_e, r_e)
+
+    def jac(_, n, I_e, r_e):
+        return psf_use.sersic_jacobian(n, I_e, r_e)
+
+    return func, jac
+
+
+def _profile_model(psf, rad, min_r, max_r, model):
+    """Model function of a `ProfileModel` for `prof_curvefit`, without Jacobian."""
+    if psf is None:
+        def func(rad_use, *theta):
+            return model(rad_use, np.asarray(theta))
+    else:
+        rad = np.asarray(rad, dtype=float)
+        psf_use = _check_psf(psf, rad).select((rad >= min_r) & (rad <= max_r))
+
+        def func(_, *theta):
+            return psf_use.convolve(model(psf_use.r_fine, np.asarray(theta)))
+
+    return func, None
+
+
+def prof_curvefit(func, rad, rho, err, params, min_r=6.0, max_r=120.0, jac=None):
     """Get the best fit result using scipy.curvefit.
 
     Parameters
@@ -241,6 +379,9 @@ def prof_curvefit(func, rad, rho, err, params, min_r=6.0, max_r=120.0):
         Minimal radii for fitting. Default=6.0
     max_r: float, optional
         Maximal radii for fitting. Default=120.0
+    jac: function, optional
+        Analytic Jacobian of the function, e.g. Sersic_jacobian. When None,
+        the derivatives are estimated using finite differences. Default: None
 
     Returns
     -------
@@ -255,12 +396,12 @@ def prof_curvefit(func, rad, rho, err, params, min_r=6.0, max_r=120.0):
     best_curvefit, cov_curvefit = curve_fit(
         func, rad[flag], rho[flag], p0=params.get_ini(),
         bounds=(params.get_low(), params.get_upp()),
-        sigma=err[flag], absolute_sigma=False)
+        sigma=err[flag], absolute_sigma=False, jac=jac)
 
     return best_curvefit, cov_curvefit
 
 
-def update_params(pbest, pcov, nsig=5.0):
+def update_params(pbest, pcov, nsig=5.0, params=None):
     """Update the parameter constraint based on the best-fit result from curvefit.
 
     Parameters
@@ -272,6 +413,9 @@ def update_params(pbest, pcov, nsig=5.0):
     nsig: float, optional
         N-sigma value to define the fitting range of parameters.
         Default: 5.
+    params: ProfileParams object, optional
+        The original parameters, used to get the names and labels.
+        Default: None, the single Sersic model.
 
     Returns
     -------
@@ -283,29 +427,25 @@ def update_params(pbest, pcov, nsig=5.0):
     # diagonal terms
     perr = np.sqrt(np.diag(pcov))
 
-    param_config = {
-        'n': {
-            'name': 'n', 'label':r'$n_{\rm Ser}$', 'ini': pbest[0],
-            'min': pbest[0] - nsig * perr[0], 'max': pbest[0] + nsig * perr[0],
-            'type': 'flat', 'sig': perr[0]
-        },
-        'I0': {
-            'name': 'I0', 'label':r'$I_{0}$', 'ini': pbest[1],
-            'min': pbest[1] - nsig * perr[1], 'max': pbest[1] + nsig * perr[1],
-            'type': 'flat', 'sig': perr[1]
-        },
-        'Re': {
-            'name': 'Re', 'label':r'$R_{\rm e}$', 'ini': pbest[2],
-            'min': pbest[2] - nsig * perr[2], 'max': pbest[2] + nsig * perr[2],
-            'type': 'flat', 'sig': perr[2]
+    if params is None:
+        names = ['n', 'I0', 'Re']
+        labels = [r'$n_{\rm Ser}$', r'$I_{0}$', r'$R_{\rm e}$']
+    else:
+        names, labels = params.names, params.labels
+
+    param_config = {}
+    for name, label, best, err in zip(names, labels, pbest, perr):
+        param_config[name] = {
+            'name': name, 'label': label, 'ini': best,
+            'min': best - nsig * err, 'max': best + nsig * err,
+            'type': 'flat', 'sig': err
         }
-    }
 
     return ProfileParams(param_config)
 
 
 def reinitialize_ball_covar(pos, prob, threshold=50.0, center=None,
-                            disp_floor=0.0, **extras):
+                            disp_floor=0.0, rng=None, **extras):
     """Estimate the parameter covariance matrix from the positions of a
     fraction of the current ensemble and sample positions from the multivariate
     gaussian corresponding to that covariance matrix.  If ``center`` is not
@@ -328,6 +468,8 @@ def reinitialize_ball_covar(pos, prob, threshold=50.0, center=None,
         parameter.  The newly generated values will be clipped to these limits.
         If the result consists only of the limit then a vector of small random
         numbers will be added to the result.
+    :param rng: optional
+        A ``numpy.random.Generator`` or a seed, used for all the random numbers.
     :returns pnew:
         New positions for the sampler, ndarray of shape (nwalker, ndim)
 
@@ -336,6 +478,7 @@ def reinitialize_ball_covar(pos, prob, threshold=50.0, center=None,
     This is from `prospect.fitting.ensemble` by Ben Johnson:
         https://github.com/bd-j/prospector/blob/master/prospect/fitting/ensemble.py
     """
+    rng = np.random.default_rng(rng)
     pos = np.atleast_2d(pos)
     nwalkers = prob.shape[0]
     good = prob > np.percentile(prob, threshold)
@@ -345,33 +488,31 @@ def reinitialize_ball_covar(pos, prob, threshold=50.0, center=None,
 
     Sigma = np.cov(pos[good, :].T)
     Sigma[np.diag_indices_from(Sigma)] += disp_floor**2
-    pnew = resample_until_valid(multivariate_normal, center, Sigma,
-                                nwalkers, **extras)
+    pnew = resample_until_valid(rng.multivariate_normal, center, Sigma,
+                                nwalkers, rng=rng, **extras)
 
     return pnew
 
 
-def clip_ball(pos, limits, disp):
+def clip_ball(pos, limits, disp, rng=None):
     """Clip to limits.  If all samples below (above) limit, add (subtract) a
     uniform random number (scaled by ``disp``) to the limit.
     """
-    npos = pos.shape[0]
     pos = np.clip(pos, limits[0], limits[1])
 
-    for i, p in enumerate(pos.T):
-        u = np.unique(p)
-        if len(u) == 1:
-            tiny = disp[i] * np.random.uniform(0, disp[i], npos)
-            if u == limits[0, i]:
-                pos[:, i] += tiny
-            if u == limits[1, i]:
-                pos[:, i] -= tiny
+    # Parameters with all the samples stuck at one of the limits
+    at_low = np.all(pos == limits[0], axis=0)
+    at_upp = np.all(pos == limits[1], axis=0)
+    if at_low.any() or at_upp.any():
+        rng = np.random.default_rng(rng)
+        tiny = disp * rng.uniform(0, 1, pos.shape) * disp
+        pos += tiny * at_low - tiny * at_upp
 
     return pos
 
 
 def resample_until_valid(sampling_function, center, sigma, nwalkers,
-                         limits=None, maxiter=1e3, prior_check=None):
+                         limits=None, maxiter=1e3, prior_check=None, rng=None):
     """Sample from the sampling function, with optional clipping to prior
     bounds and resampling in the case of parameter positions that are outside
     complicated custom priors.
@@ -389,12 +530,14 @@ def resample_until_valid(sampling_function, center, sigma, nwalkers,
     :param limits: (optional)
         Simple limits on the parameters, passed to ``clip_ball``.
     :param prior_check: (optional)
-        An object that has a ``prior_product()`` method which returns the prior
-        ln(probability) for a given parameter position.
+        An object that has a ``lnprior()`` method which returns the prior
+        ln(probability) for an array of parameter positions.
     :param maxiter:
         Maximum number of iterations to try resampling before giving up and
         returning a set of parameter positions at least one of which is not
         within the prior.
+    :param rng: (optional)
+        A ``numpy.random.Generator`` or a seed, passed to ``clip_ball``.
     :returns pnew:
         New parameter positions, ndarray of shape (nwalkers, ndim)
 
@@ -402,52 +545,263 @@ def resample_until_valid(sampling_function, center, sigma, nwalkers,
     -----
     This is from `prospect.fitting.ensemble` by Ben Johnson:
         https://github.com/bd-j/prospector/blob/master/prospect/fitting/ensemble.py
+
+    All the invalid positions are redrawn together. After the first draw, more
+    samples than needed are drawn based on the fraction of valid ones so far,
+    so only a few iterations are needed even for a restrictive prior.
     """
-    invalid = np.ones(nwalkers, dtype=bool)
+    rng = np.random.default_rng(rng)
+    diag = np.diag(sigma) if np.ndim(sigma) > 1 else sigma
+
     pnew = np.zeros([nwalkers, len(center)])
+    n_valid, n_draw_total, n_valid_total = 0, 0, 0
+
+    for _ in range(int(maxiter)):
+        n_need = nwalkers - n_valid
+        n_draw = n_need
+        if n_draw_total > 0:
+            # Draw more samples than needed based on the fraction of valid ones
+            frac = max(n_valid_total / n_draw_total, 0.01)
+            n_draw = min(int(np.ceil(1.2 * n_need / frac)), 100 * nwalkers)
 
-    for i in range(int(maxiter)):
-        # replace invalid elements with new samples
-        tmp = sampling_function(center, sigma, size=invalid.sum())
-        pnew[invalid, :] = tmp
+        tmp = np.atleast_2d(sampling_function(center, sigma, size=n_draw))
         if limits is not None:
             # clip to simple limits
-            if sigma.ndim > 1:
-                diag = np.diag(sigma)
-            else:
-                diag = sigma
-            pnew = clip_ball(pnew, limits, diag)
-
-        if prior_check is not None:
-            # check the prior
-            lnp = np.array([prior_check.lnprior(pos, nested=False) for pos in pnew])
-            invalid = ~np.isfinite(lnp)
-            if invalid.sum() == 0:
-                # everything is valid, return
-                return pnew
-        else:
+            tmp = clip_ball(tmp, limits, diag, rng=rng)
+
+        if prior_check is None:
             # No prior check, return on first iteration
+            return tmp
+
+        # check the prior of all the new samples at once
+        valid = np.isfinite(np.atleast_1d(prior_check.lnprior(tmp, nested=False)))
+        n_draw_total += n_draw
+        n_valid_total += valid.sum()
+
+        good = tmp[valid][:n_need]
+        pnew[n_valid:n_valid + len(good)] = good
+        n_valid += len(good)
+        if n_valid == nwalkers:
+            # everything is valid, return
             return pnew
+
     # reached maxiter, return whatever exists so far
+    pnew[n_valid:] = tmp[~valid][:nwalkers - n_valid]
     print("initial position resampler hit ``maxiter``")
 
     return pnew
 
 
+def sersic_param_config(rad, rho_norm, min_r=6.0, max_r=120.0):
+    """Flat priors of a single Sersic model whose I0 range contains I_e.
+
+    The I0 range of `config_params` starts at the 84th percentile of the
+    profile, which is often above the intensity at the effective radius. Here
+    I0 is between 0 and the maximum of the profile within the fitting range,
+    the same as `SersicComponent.default_config`.
+
+    Parameters
+    ----------
+    rad: list or 1-D array
+        Radius array.
+    rho_norm: 1-D array
+        Normalized surface density profile.
+    min_r: float, optional
+        Minimal radii for fitting. Default: 6.0
+    max_r: float, optional
+        Maximal radii for fitting. Default: 120.0
+
+    Returns
+    -------
+    param_config: dict
+        Dictionary for parameters, see `config_params`.
+
+    """
+    rad = np.asarray(rad)
+    rho_use = np.asarray(rho_norm)[(rad >= min_r) & (rad <= max_r)]
+
+    return {
+        'n': {
+            'name': 'n', 'label': r'$n_{\rm Ser}$', 'ini': 3.0,
+            'min': 1.0, 'max': 8.0, 'type': 'flat', 'sig': 1.0
+        },
+        'I0': {
+            'name': 'I0', 'label': r'$I_{0}$', 'ini': np.median(rho_use),
+            'min': 0.0, 'max': rho_use.max(), 'type': 'flat', 'sig': np.std(rho_use)
+        },
+        'Re': {
+            'name': 'Re', 'label': r'$R_{\rm e}$', 'ini': np.sqrt(min_r * max_r),
+            'min': min_r, 'max': max_r, 'type': 'flat', 'sig': 20.
+        }
+    }
+
+
+def map_fit_one_sersic(rad, rho, err, min_r=6.0, max_r=120.0, param_config=None,
+                       verbose=False, psf=None, bound_tol=1E-3):
+    """Fast maximum a posteriori fit of a single Sersic model to a 1-D profile.
+
+    The best-fit parameters are from `prof_curvefit` using the analytic
+    Jacobian. As the default priors are flat, this is also the MAP solution.
+    The posterior covariance matrix uses the Laplace approximation, i.e. the
+    inverse of the Fisher matrix J^T C^-1 J at the best-fit parameters.
+
+    The Laplace approximation is not valid when the best-fit parameters sit
+    on the edge of the prior. These parameters are flagged in `on_bound`, and
+    the covariance matrix and uncertainties are NaN.
+
+    Parameters
+    ----------
+    rad: list or 1-D array
+        Radius array.
+    rho: list or 1-D array
+        Surface mass density profile.
+    err: list or 1-D array
+        Uncertainties of surface mass density profile.
+    min_r: float, optional
+        Minimal radii for fitting. Default=6.0
+    max_r: float, optional
+        Maximal radii for fitting. Default=120.0
+    param_config: dict, optional
+        Dictionary for parameters, see `config_params`.
+        Default: None, use `sersic_param_config`.
+    verbose: bool, optional
+        Print the best-fit results. Default: False
+    psf: PSFOperator1D object, optional
+        Fit the PSF-convolved Sersic model. Should be built for `rad`, see
+        `kungpao.model.psf`. Default: None
+    bound_tol: float, optional
+        Parameters closer to the edge of the prior than this fraction of the
+        prior range are on the bound. Default: 1E-3
+
+    Returns
+    -------
+    results: dict
+        Best-fit parameters, covariance matrix, uncertainties, and ln(prob) of
+        the normalized profile. The normalization factor is in `norm`, and the
+        parameters on the edge of the prior are flagged in `on_bound`.
+
+    """
+    rad = np.asarray(rad, dtype=float)
+
+    norm, _, _ = norm_prof(rad, rho, min_r=min_r, max_r=max_r)
+    if param_config is None:
+        param_config = sersic_param_config(
+            rad, np.asarray(rho).flatten() / norm, min_r=min_r, max_r=max_r)
+    rho_norm, err_norm, params = config_params(
+        rad, rho, err, min_r=min_r, max_r=max_r, param_config=param_config)
+
+    model_func, model_jac = _sersic_model(psf, rad, min_r, max_r)
+    pbest, pcov = prof_curvefit(
+        model_func, rad, rho_norm, err_norm, params, min_r=min_r, max_r=max_r,
+        jac=model_jac)
+
+    # Parameters pinned to the edge of the prior
+    low, upp = params.get_low(), params.get_upp()
+    tol = bound_tol * (upp - low)
+    on_bound = (pbest - low <= tol) | (upp - pbest <= tol)
+
+    if on_bound.any():
+        cov = np.full((params.n_param, params.n_param), np.nan)
+    else:
+        # Laplace approximation of the posterior around the best-fit parameters
+        flag = (rad >= min_r) & (rad <= max_r)
+        jac = model_jac(rad[flag], *pbest) / err_norm[flag][:, np.newaxis]
+        cov = np.linalg.pinv(np.dot(jac.T, jac))
+
+    ln_prob = BatchLnProbability(
+        params, rad, rho_norm, err_norm, min_r=min_r, max_r=max_r, psf=psf)
+
+    if verbose:
+        print("Best-fit Sersic parameters:", pbest)
+        print("Error of Sersic parameters:", np.sqrt(np.diag(cov)))
+        if on_bound.any():
+            print("# Parameters on the edge of the prior:",
+                  np.asarray(params.names)[on_bound])
+
+    return {'best': pbest, 'cov': cov, 'err': np.sqrt(np.diag(cov)),
+            'lnprob': ln_prob(pbest), 'norm': norm, 'on_bound': on_bound,
+            'best_curvefit': pbest, 'cov_curvefit': pcov}
+
+
 def emcee_fit_one_sersic(rad, rho, err, min_r=6.0, max_r=120.0, pool=None,
                          n_walkers=128, n_burnin=100, n_samples=100, output=None,
-                         moves_burnin=None, moves_final=None, verbose=True):
+                         moves_burnin=None, moves_final=None, verbose=True,
+                         thin=1, chain_dtype=np.float32, chain_file=None,
+                         early_stop=False, n_eff=(500, 2000), check_every=25,
+                         psf=None, rng=None, model=None, param_config=None):
     """Fit a single Sersic model to a 1-D profile.
 
     Parameters
     ----------
+    rad: list or 1-D array
+        Radius array.
+    rho: list or 1-D array
+        Surface mass density profile.
+    err: list or 1-D array
+        Uncertainties of surface mass density profile.
+    min_r: float, optional
+        Minimal radii for fitting. Default=6.0
+    max_r: float, optional
+        Maximal radii for fitting. Default=120.0
+    pool: pool object, optional
+        Pool used by emcee to evaluate the walkers. A `LnProbPool` only sends
+        the profile to the workers once. Default: None
+    n_walkers: int, optional
+        Number of walkers. Default: 128
+    n_burnin: int, optional
+        Number of steps of the burn-in stage. Default: 100
+    n_samples: int, optional
+        Number of steps of the final sampling stage. Default: 100
+    output: str, optional
+        Name of the `.npz` file to save the results. Default: None
+    moves_burnin: emcee.moves object, optional
+        Moves used in the burn-in stage. Default: DESnookerMove
+    moves_final: emcee.moves object, optional
+        Moves used in the final sampling stage. Default: StretchMove(a=4)
+    verbose: bool, optional
+        Print the results and show the progress. Default: True
+    thin: int, optional
+        Only store every `thin` steps of the chains. `n_burnin` and
+        `n_samples` need to be multiples of it. Default: 1
+    chain_dtype: numpy dtype, optional
+        Data type of the stored chains. Default: np.float32
+    chain_file: str, optional
+        Name of the `.npy` file to store the chain of the final sampling
+        stage. Default: None, keep it in memory.
+    early_stop: bool, optional
+        Stop each stage once the effective sample size reaches the target,
+        see `run_until_converged`. `n_burnin` and `n_samples` are then the
+        maximum number of steps. Default: False
+    n_eff: tuple, optional
+        Target effective sample sizes of the burn-in and the final sampling
+        stage. Default: (500, 2000)
+    check_every: int, optional
+        Number of stored steps between two convergence checks. Default: 25
+    psf: PSFOperator1D object, optional
+        Fit the PSF-convolved Sersic model. Should be built for `rad`, see
+        `kungpao.model.psf`. Default: None
+    rng: numpy.random.Generator or int, optional
+        Random number generator or seed used to re-initialize the walkers
+        after the burn-in stage. Default: None
+    model: ProfileModel object, optional
+        Fit a multi-component model instead of the single Sersic model, see
+        `kungpao.model.profile`. Default: None
+    param_config: dict, optional
+        Dictionary for parameters, see `config_params`. Default: None, use
+        the default of the single Sersic model or of the `model`.
 
     Returns
     -------
+    results: dict
+        Results of the final sampling stage, see `organize_results`. With
+        `early_stop=True`, the convergence diagnostics are in 'convergence'.
+    burnin: dict
+        Results of the burn-in stage.
 
     """
-    # 3 parameters for a single Sersic model
-    n_dim = 3
+    # Only whole thinned steps are run, so no step is dropped silently
+    if thin < 1 or n_burnin < thin or n_samples < thin or n_burnin % thin or n_samples % thin:
+        raise Exception("# n_burnin and n_samples need to be multiples of thin!")
 
     # Decide the behaviour of the sampler
     if moves_burnin is None:
@@ -457,19 +811,27 @@ def emcee_fit_one_sersic(rad, rho, err, min_r=6.0, max_r=120.0, pool=None,
 
     # Normalize the input profile and uncertainty, decide the fitting range, and
     # setup the initial parameter ranges for fitting.
+    if model is not None and param_config is None:
+        norm, _, _ = norm_prof(rad, rho, min_r=min_r, max_r=max_r)
+        param_config = model.param_config(
+            rad, np.asarray(rho) / norm, min_r=min_r, max_r=max_r)
     rho_norm, err_norm, params = config_params(
-        rad, rho, err, min_r=min_r, max_r=max_r)
+        rad, rho, err, min_r=min_r, max_r=max_r, param_config=param_config)
+    n_dim = params.n_param
 
     # Fit the Sersic profile using scipy.curvefit() to get the simple
     # best-fit parameters (pbest) and the associated covariance matrix (pcov)
     # The later can be used to estimate parameter errors.
-    pbest, pcov = prof_curvefit(Sersic, rad, rho_norm, err_norm, params)
+    model_func, model_jac = _sersic_model(psf, rad, min_r, max_r, model=model)
+    pbest, pcov = prof_curvefit(
+        model_func, rad, rho_norm, err_norm, params, min_r=min_r, max_r=max_r,
+        jac=model_jac)
     if verbose:
         print("Best-fit Sersic parameters from curvefit:", pbest)
         print("Error of Sersic parameters from curvefit:", np.sqrt(np.diag(pcov)))
 
     # Update the parameter ranges based on the best-fit result
-    params_update = update_params(pbest, pcov, nsig=5.0)
+    params_update = update_params(pbest, pcov, nsig=5.0, params=params)
 
     # Initial postioins of each walker
     params_ini = params_update.sample(nsamples=n_walkers)
@@ -478,46 +840,78 @@ def emcee_fit_one_sersic(rad, rho, err, min_r=6.0, max_r=120.0, pool=None,
     params_limits = np.array([params_update.low, params_update.upp])
 
     # Config the ensemble sampler
-    args = [params_update, rad, rho_norm, err_norm]
+    # Without a pool, all the walkers are evaluated together in one call.
+    # A LnProbPool gets the data once, then each call only sends the walkers.
+    ln_prob = BatchLnProbability(
+        params_update, rad, rho_norm, err_norm, min_r=min_r, max_r=max_r, psf=psf,
+        model=model)
+    if isinstance(pool, LnProbPool):
+        pool.load(ln_prob)
+        ln_prob, pool = pool, None
+    vectorize = pool is None
+
     sampler_burnin = emcee.EnsembleSampler(
-        n_walkers, n_dim, ln_probability, moves=moves_burnin, args=args, pool=pool)
+        n_walkers, n_dim, ln_prob, moves=moves_burnin, pool=pool,
+        vectorize=vectorize, backend=ChainStore(dtype=chain_dtype))
 
     # Run burn-in step
     if verbose:
         print("# Running burn-in step...")
-    burnin_results = sampler_burnin.run_mcmc(
-        params_ini, n_burnin, store=True, progress=True)
+    if early_stop:
+        burnin_results, burnin_diag = run_until_converged(
+            sampler_burnin, params_ini, n_burnin, n_eff=n_eff[0],
+            check_every=check_every, thin=thin, progress=verbose)
+    else:
+        burnin_results = sampler_burnin.run_mcmc(
+            params_ini, n_burnin // thin, thin_by=thin, store=True,
+            progress=verbose)
 
     burnin = organize_results(
         burnin_results, sampler_burnin, n_dim, output=None,
         verbose=verbose, frac=0.1)
+    if early_stop:
+        burnin['convergence'] = burnin_diag
 
     # Find best walker position
     burnin_pos, burnin_prob, _ = burnin_results
-    burnin_best = sampler_burnin.flatlnprobability.argmax()
 
     # Get the new initial positions for walkers
-    initial_center = sampler_burnin.flatchain[burnin_best, :]
+    initial_center = burnin['best']
 
     new_ini = reinitialize_ball_covar(
         burnin_pos, burnin_prob, center=initial_center,
         limits=params_limits, disp_floor=0.1,
-        prior_check=params_update, threshold=30)
+        prior_check=params_update, threshold=30, rng=rng)
 
     # Config the ensemble sampler
     if verbose:
         print("# Running final sampling step...")
     sampler_final = emcee.EnsembleSampler(
-        n_walkers, n_dim, ln_probability, moves=moves_final, args=args, pool=pool)
+        n_walkers, n_dim, ln_prob, moves=moves_final, pool=pool,
+        vectorize=vectorize,
+        backend=ChainStore(filename=chain_file, dtype=chain_dtype))
 
     # Run the final sampling step
-    sample_results = sampler_final.run_mcmc(
-        new_ini, n_samples, store=True, progress=True)
+    if early_stop:
+        sample_results, final_diag = run_until_converged(
+            sampler_final, new_ini, n_samples, n_eff=n_eff[1],
+            check_every=check_every, thin=thin, progress=verbose)
+    else:
+        sample_results = sampler_final.run_mcmc(
+            new_ini, n_samples // thin, thin_by=thin, store=True,
+            progress=verbose)
 
     # Organize results
     results = organize_results(
         sample_results, sampler_final, n_dim, output=output,
         verbose=verbose, frac=0.1)
+    if early_stop:
+        results['convergence'] = final_diag
+        if verbose:
+            print("# Burn-in stage: %d steps, converged: %s" % (
+                burnin_diag['n_step'], burnin_diag['converged']))
+            print("# Final stage: %d steps, converged: %s" % (
+                final_diag['n_step'], final_diag['converged']))
 
     # Add in the curve-fit results
     results['best_curvefit'] = pbest
@@ -527,6 +921,111 @@ def emcee_fit_one_sersic(rad, rho, err, min_r=6.0, max_r=120.0, pool=None,
     return results, burnin
 
 
+def dynesty_fit_one_sersic(rad, rho, err, min_r=6.0, max_r=120.0, param_config=None,
+                           nlive=500, dlogz=0.1, dynamic=False, pool=None,
+                           queue_size=None, verbose=True, psf=None, **sampler_kwargs):
+    """Fit a single Sersic model to a 1-D profile using nested sampling.
+
+    The prior volume is sampled by `dynesty` using `ProfileParams.transform`
+    and the likelihood of `BatchLnProbability`. Besides the posterior samples,
+    it returns the Bayesian evidence that can be used for model comparison.
+
+    Parameters
+    ----------
+    rad: list or 1-D array
+        Radius array.
+    rho: list or 1-D array
+        Surface mass density profile.
+    err: list or 1-D array
+        Uncertainties of surface mass density profile.
+    min_r: float, optional
+        Minimal radii for fitting. Default=6.0
+    max_r: float, optional
+        Maximal radii for fitting. Default=120.0
+    param_config: dict, optional
+        Dictionary for parameters, see `config_params`.
+        Default: None, use `sersic_param_config`.
+    nlive: int, optional
+        Number of live points. Default: 500
+    dlogz: float, optional
+        Stopping criterion on the remaining evidence. Default: 0.1
+    dynamic: bool, optional
+        Use the dynamic nested sampler. Default: False
+    pool: pool object, optional
+        Pool used by dynesty. Default: None
+    queue_size: int, optional
+        Number of points evaluated in parallel with the pool. Default: None
+    verbose: bool, optional
+        Print the results and show the progress. Default: True
+    psf: PSFOperator1D object, optional
+        Fit the PSF-convolved Sersic model. Should be built for `rad`, see
+        `kungpao.model.psf`. Default: None
+    **sampler_kwargs:
+        Other parameters for the dynesty sampler.
+
+    Returns
+    -------
+    results: dict
+        Equal-weight posterior samples ('samples'), the weighted samples and
+        their weights ('samples_weighted', 'weights'), ln(evidence) and its
+        uncertainty ('logz', 'logz_err'), best and mean parameters ('best',
+        'mean'), percentiles of the parameters ('percentiles'), and the raw
+        `dynesty` results ('dynesty').
+
+    """
+    import dynesty
+    from dynesty import utils as dyfunc
+
+    if param_config is None:
+        norm, _, _ = norm_prof(rad, rho, min_r=min_r, max_r=max_r)
+        param_config = sersic_param_config(
+            rad, np.asarray(rho).flatten() / norm, min_r=min_r, max_r=max_r)
+    rho_norm, err_norm, params = config_params(
+        rad, rho, err, min_r=min_r, max_r=max_r, param_config=param_config)
+
+    ln_like = BatchLnProbability(
+        params, rad, rho_norm, err_norm, min_r=min_r, max_r=max_r, nested=True,
+        psf=psf)
+
+    if dynamic:
+        sampler = dynesty.DynamicNestedSampler(
+            ln_like, params.transform, params.n_param, pool=pool,
+            queue_size=queue_size, **sampler_kwargs)
+        sampler.run_nested(nlive_init=nlive, dlogz_init=dlogz, print_progress=verbose)
+    else:
+        sampler = dynesty.NestedSampler(
+            ln_like, params.transform, params.n_param, nlive=nlive, pool=pool,
+            queue_size=queue_size, **sampler_kwargs)
+        sampler.run_nested(dlogz=dlogz, print_progress=verbose)
+
+    results = sampler.results
+
+    weights = np.exp(results.logwt - results.logz[-1])
+    samples = dyfunc.resample_equal(results.samples, weights)
+    best = results.samples[np.argmax(results.logl)]
+    mean, _ = dyfunc.mean_and_cov(results.samples, weights)
+    pcts = np.percentile(samples, [16, 50, 84], axis=0)
+
+    if verbose:
+        print("#------------------------------------------------------")
+        print("#  ln(Evidence): %11.5f +/- %8.5f" % (results.logz[-1], results.logzerr[-1]))
+        print("#  Best ln(Likelihood): %11.5f" % np.max(results.logl))
+        print(best)
+        print("#------------------------------------------------------")
+        print("#  Best parameters (mean):")
+        print(mean)
+        print("#------------------------------------------------------")
+        for low, med, upp in pcts.T:
+            print((med, upp - med, med - low))
+        print("#------------------------------------------------------")
+
+    return {'samples': samples, 'samples_weighted': results.samples,
+            'weights': weights, 'lnlike': results.logl,
+            'logz': results.logz[-1], 'logz_err': results.logzerr[-1],
+            'best': best, 'mean': mean, 'percentiles': pcts,
+            'dynesty': results}
+
+
 def samples_stats(samples):
     """1D marginalized parameter constraints."""
     return map(lambda v: (v[1], v[2] - v[1], v[1] - v[0]),
@@ -536,30 +1035,57 @@ def samples_stats(samples):
 def organize_results(results, sampler, ndims, output=None, verbose=True, frac=0.1):
     """Organize the MCMC run results.
 
+    The summary statistics are computed from the chain stored by the sampler
+    without making flattened copies of it, see `chain_summary`.
+
     Parameters
     ----------
+    results: emcee.State object
+        The final state of the sampler.
+    sampler: emcee.EnsembleSampler object
+        The sampler.
+    ndims: int
+        Number of parameters.
+    output: str, optional
+        Name of the `.npz` file to save the results. The flattened samples
+        are not saved, as they are the chains reshaped to (n_walker * n_step,
+        n_dim) in the step-major order: `chains.swapaxes(0, 1).reshape(-1, n_dim)`.
+        Default: None
+    verbose: bool, optional
+        Print the results. Default: True
+    frac: float, optional
+        Fraction of the last steps used to get the mean parameters.
+        Default: 0.1
+
+    Returns
+    -------
+    results: dict
+        The chains ('chains', with the shape (n_walker, n_step, n_dim)), the
+        flattened samples ('samples'), ln(probability) ('lnprob', with the shape
+        (n_walker, n_step)), best and mean parameters ('best', 'mean'),
+        percentiles of the parameters ('percentiles'), the final positions of
+        the walkers ('position'), and the acceptance fractions ('acceptance').
+        The chains and samples are views of the stored chain.
+
     """
     position, lnprob, _ = results
 
-    samples = sampler.chain[:, :, :].reshape((-1, ndims))
-    chains = sampler.chain
-    lnprob = sampler.lnprobability
+    # (n_step, n_walker, n_dim) array, no copy is made here.
+    chain = sampler.get_chain()
+    lnprob = sampler.get_log_prob()
+    assert chain.shape[-1] == ndims
 
-    params_stats = samples_stats(samples)
+    summary = chain_summary(chain, lnprob, frac=frac)
 
-    # Best parameter using the best log(prob)
-    ind_1, ind_2 = np.unravel_index(np.argmax(lnprob, axis=None), lnprob.shape)
-    best = chains[ind_2, ind_1, :]
-
-    # Best parameters using the mean of the last few samples
-    _, n_step, n_dim = chains.shape
-    mean = np.nanmean(
-        chains[:, -int(n_step * frac):, :].reshape([-1, n_dim]), axis=0)
+    samples = sampler.get_chain(flat=True)
+    chains = np.swapaxes(chain, 0, 1)
+    best, mean = summary['best'], summary['mean']
 
     if output:
         np.savez(output,
-                 samples=samples, lnprob=np.array(lnprob),
+                 lnprob=lnprob.T,
                  best=np.array(best), mean=np.asarray(mean),
+                 percentiles=summary['percentiles'],
                  chains=chains,
                  position=np.asarray(position),
                  acceptance=np.array(sampler.acceptance_fraction))
@@ -569,27 +1095,32 @@ def organize_results(results, sampler, ndims, output=None, verbose=True, frac=0.
         print("#  Mean acceptance fraction",
               np.mean(sampler.acceptance_fraction))
         print("#------------------------------------------------------")
-        print("#  Best ln(Probability): %11.5f" % np.max(lnprob))
+        print("#  Best ln(Probability): %11.5f" % summary['lnprob_best'])
         print(best)
         print("#------------------------------------------------------")
         print("#  Best parameters (mean):")
         print(mean)
         print("#------------------------------------------------------")
-        for param_stats in params_stats:
-            print(param_stats)
+        for low, med, upp in summary['percentiles'].T:
+            print((med, upp - med, med - low))
         print("#------------------------------------------------------")
 
-    return {'samples': samples, 'lnprob': np.array(lnprob),
+    return {'samples': samples, 'lnprob': lnprob.T,
             'best': np.array(best), 'mean': np.asarray(mean),
+            'percentiles': summary['percentiles'],
             'chains': chains, 'position': np.asarray(position),
             'acceptance': np.array(sampler.acceptance_fraction)
            }
 
 
-def plot_mcmc_corner(mcmc_samples, mcmc_labels, fontsize=26, labelsize=20, **corner_kwargs):
-    """Corner plots for MCMC samples."""
+def plot_mcmc_corner(mcmc_samples, mcmc_labels, fontsize=26, labelsize=20,
+                     max_samples=None, **corner_kwargs):
+    """Corner plots for MCMC samples.
+
+    With `max_samples`, only a random subset of the samples is used.
+    """
     fig = corner.corner(
-        mcmc_samples,
+        thin_samples(mcmc_samples, max_samples),
         bins=40, color=ORG(0.7),
         smooth=2, labels=mcmc_labels,
         label_kwargs={'fontsize': fontsize},
@@ -738,23 +1269,31 @@ def plot_mcmc_trace(mcmc_chains, mcmc_labels, mcmc_best=None, figsize=None,
     return fig
 
 
-def visual_emcee(results, burnin=None, fontsize=20, alpha=0.3):
-    """Visualize the emcee result."""
-    params_label = [r'$n_{\rm Ser}$', r'$I_{0}$', r'$R_{\rm e}$']
+def visual_emcee(results, burnin=None, fontsize=20, alpha=0.3, labels=None,
+                 max_samples=20000, max_walkers=20):
+    """Visualize the emcee result.
+
+    The corner plot uses at most `max_samples` samples, and the trace plot
+    shows quantile bands instead of individual walkers when there are more
+    than `max_walkers` walkers, see `kungpao.model.diagnostics`.
+    """
+    n_dim = results['chains'].shape[-1]
+    if labels is None:
+        labels = ([r'$n_{\rm Ser}$', r'$I_{0}$', r'$R_{\rm e}$'] if n_dim == 3
+                  else [r'$\theta_{%d}$' % ii for ii in range(n_dim)])
 
     from matplotlib import rcParams
-    rcParams.update({'font.size': 20})
+    rcParams.update({'font.size': fontsize})
 
-    mod_corner = plot_mcmc_corner(
-        results['chains'].reshape([-1, 3]), params_label,
+    mod_corner = plot_corner_fast(
+        results['chains'].reshape([-1, n_dim]), labels, max_samples=max_samples,
         truths=results['best_curvefit'], truth_color='skyblue',
-        fontsize=26, labelsize=22,
-        **{'title_fmt': '.2f', 'ranges': None, 'plot_datapoints': False})
+        fontsize=26, labelsize=22, title_fmt='.2f')
 
-    mod_trace = plot_mcmc_trace(
-        results['chains'], params_label,
-        mcmc_best=results['best_curvefit'], mcmc_burnin=burnin['chains'],
-        burnin_alpha=alpha, trace_alpha=alpha, figsize=(8, 6))
+    mod_trace = plot_trace_bands(
+        results['chains'], labels, best=results['best_curvefit'],
+        burnin=None if burnin is None else burnin['chains'],
+        max_walkers=max_walkers, alpha=alpha, figsize=(8, 6))
 
     return mod_corner, mod_trace
 
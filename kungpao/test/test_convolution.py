@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from scipy import ndimage
+
+from kungpao.convolution import Convolver, convolve_image, get_convolver
+
+
+def test_convolver_methods():
+    """All the methods agree with ndimage, in float32."""
+    rng = np.random.default_rng(2)
+    img = rng.normal(size=(300, 420))
+    kernels = [rng.random((5, 5)), rng.random((4, 7)),
+               np.outer(rng.random(9), rng.random(6))]
+
+    for kernel in kernels:
+        expect = ndimage.convolve(img, kernel, mode='reflect')
+        for method in ('direct', 'fft', 'overlap-save'):
+            conv = Convolver(kernel=kernel, method=method, block_size=64, workers=2)
+            result = conv(img)
+            assert result.dtype == np.float32
+            assert np.allclose(result, expect, atol=1E-4 * np.abs(expect).max())
+
+    expect = ndimage.gaussian_filter(img, 2.5)
+    for method in ('auto', 'separable', 'overlap-save'):
+        assert np.allclose(convolve_image(img, sigma=2.5, method=method, block_size=64),
+                           expect, atol=1E-5)
+
+    # Separable kernels are found, and the convolvers are reused
+    assert Convolver(kernel=kernels[2]).method == 'separable'
+    assert get_convolver(sigma=2.5) is get_convolver(sigma=(2.5, 2.5))
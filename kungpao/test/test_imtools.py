@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import warnings
+
+import numpy as np
+
+from kungpao.mock import render_sersic_galaxies
+
+
+def _mock_image(size=200, n_gal=15, seed=3):
+    """Noisy image with a central galaxy and random neighbours."""
+    rng = np.random.default_rng(seed)
+    # Keep the neighbours away from the central galaxy
+    rad = rng.uniform(0.3 * size, 0.45 * size, n_gal)
+    phi = rng.uniform(0.0, 2.0 * np.pi, n_gal)
+    x = np.append(size / 2.0, size / 2.0 + rad * np.cos(phi))
+    y = np.append(size / 2.0, size / 2.0 + rad * np.sin(phi))
+    flux = np.append(5000.0, rng.uniform(200.0, 1000.0, n_gal))
+    r_e = np.append(8.0, rng.uniform(1.0, 3.0, n_gal))
+    img = render_sersic_galaxies((size, size), x, y, 1.5, r_e, flux)
+
+    return img + rng.normal(scale=0.1, size=img.shape), np.full(img.shape, 0.1)
+
+
+def test_img_clean_and_mask():
+    """One run of the passes gives the same products as the separate calls."""
+    from kungpao import imtools
+
+    img, sig = _mock_image()
+
+    np.random.seed(1)
+    img_clean, img_mask, passes = imtools.img_clean_and_mask(img, sig=sig)
+    np.random.seed(1)
+    assert np.array_equal(imtools.img_obj_mask(img, sig=sig), img_mask)
+
+    np.random.seed(1)
+    img_clean_2, _, _ = imtools.img_clean_and_mask(img, sig=sig, bkg_sub_2=False)
+    np.random.seed(1)
+    assert np.array_equal(imtools.img_clean_up(img, sig=sig), img_clean_2)
+
+    # The central galaxy is kept
+    assert img_mask[100, 100] == 0
+    assert img_clean[100, 100] == img[100, 100]
+    assert len(passes['obj_1']) > 5
+
+
+def test_scalar_error():
+    """A constant error is passed to SEP as a scalar."""
+    from kungpao import imtools
+    from kungpao.detection import sep_detection, detect_high_sb_objects
+
+    img, _ = _mock_image()
+    sig = 0.1
+    assert imtools.prepare_image(sig) == sig
+
+    objs, seg = sep_detection(img, 3.0, err=sig, return_bkg=False)
+    assert len(objs) > 5 and seg.shape == img.shape
+
+    objs, msk, _ = detect_high_sb_objects(img, 1.0, threshold=5.0, min_area=10)
+    assert len(objs) > 0 and msk.shape == img.shape
+
+    _, img_mask, _ = imtools.img_clean_and_mask(img, sig=sig)
+    assert img_mask.any()
+
+
+def test_img_detect_passes_tiled():
+    """The tiled passes match the untiled ones away from the tile boundaries."""
+    from kungpao import imtools
+
+    img, sig = _mock_image(size=400, n_gal=60)
+
+    np.random.seed(1)
+    img_mask = imtools.img_obj_mask(img, sig=sig)
+    img_mask_tiled = imtools.img_obj_mask(img, sig=sig, tile_size=200, halo=64, n_proc=2)
+    assert np.mean(img_mask == img_mask_tiled) > 0.99
+
+    # The thread pool is reached from all the entry points
+    img_mask_threads = imtools.img_obj_mask(img, sig=sig, tile_size=200, halo=64,
+                                            n_proc=2, use_threads=True)
+    assert np.array_equal(img_mask_threads, img_mask_tiled)
+    img_clean = imtools.img_clean_up(img, sig=sig, tile_size=200, halo=64, n_proc=2,
+                                     use_threads=True)
+    assert img_clean.shape == img.shape
+
+    # The central galaxy covers four tiles, but keeps one label
+    passes = imtools.img_detect_passes_tiled(img, sig=sig, tile_size=200, halo=64,
+                                             n_proc=1, rng=2)
+    seg = passes['seg_1']
+    assert len(np.unique(seg[190:210, 190:210])) == 1
+    assert np.array_equal(np.unique(seg), np.arange(seg.max() + 1))
+
+
+def test_segs_to_mask():
+    """Fast mask growth compared to the Gaussian smoothing."""
+    from scipy import ndimage
+    from kungpao import imtools
+
+    # A single pixel grows into a disk
+    seg = np.zeros((41, 45), dtype=np.int32)
+    seg[20, 22] = 3
+    disk = ndimage.distance_transform_edt(seg == 0) <= 6.5
+    grown = imtools.grow_mask(seg, 6.5, n_rect=6)
+    assert not np.any(grown & ~disk)
+    assert grown.sum() > 0.9 * disk.sum()
+
+    # Same growth at the edges and corners, where the disk is cut
+    y_arr, x_arr = np.mgrid[-5:6, -5:6]
+    in_disk = x_arr ** 2 + y_arr ** 2 <= 25
+    rects = np.zeros_like(in_disk)
+    for h_x, h_y in [(5, 0), (4, 2), (2, 4), (0, 5)]:
+        rects |= (np.abs(x_arr) <= h_x) & (np.abs(y_arr) <= h_y)
+    for pos in [(0, 0), (0, 29), (24, 0), (24, 29), (24, 13), (11, 29), (12, 14)]:
+        seed = np.zeros((25, 30), dtype=bool)
+        seed[pos] = True
+        grown = imtools.grow_mask(seed, 5.0)
+        assert np.array_equal(grown, ndimage.binary_dilation(seed, rects))
+        assert not np.any(grown & ~ndimage.binary_dilation(seed, in_disk))
+
+    img, sig = _mock_image()
+    passes = imtools.img_detect_passes(img, sig=sig, rng=1)
+    segs = [passes['seg_1'], passes['seg_2']]
+
+    msk_old = [ndimage.gaussian_filter((seg > 0) * 1000.0, sigma) > 10.0
+               for seg, sigma in zip(segs, (3.0, 5.0))]
+    msk_gauss = imtools.segs_to_mask(segs, [3.0, 5.0])
+    assert np.array_equal(msk_gauss, msk_old[0] | msk_old[1])
+
+    msk_dilate = imtools.segs_to_mask(segs, [3.0, 5.0], method='dilate')
+    assert msk_dilate.dtype == np.uint8
+    assert np.mean(msk_dilate == msk_gauss) > 0.97
+
+
+def test_segmentation_map():
+    """Per-label operations match the full-image versions."""
+    from kungpao import imtools
+
+    seg = np.zeros((50, 60), dtype=np.int32)
+    seg[5:10, 5:12] = 1
+    seg[20:30, 25:35] = 2
+    seg[40:45, 50:55] = 4
+    seg_map = imtools.SegmentationMap(seg)
+
+    assert list(seg_map.labels) == [1, 2, 4]
+    assert seg_map.center_label() == 2
+    assert np.array_equal(seg_map.index(2), imtools.seg_index_cen_obj(seg))
+    assert len(seg_map.pixels(4)[0]) == 25
+
+    mask = np.zeros(seg.shape, dtype=bool)
+    mask[20:25] = True
+    assert np.isclose(seg_map.overlap(mask)[2], 0.5)
+    assert np.allclose(seg_map.overlap(mask, labels=[1, 2]), [0.0, 0.5])
+
+    img = np.ones(seg.shape)
+    seg_map.replace(img, np.zeros(seg.shape), [1, 4])
+    assert img.sum() == seg.size - 35 - 25
+
+    seg_map.remove(seg_map.center_label())
+    assert np.array_equal(seg_map.seg, imtools.seg_remove_cen_obj(seg))
+    assert np.array_equal(seg_map.relabel(), [1, 4])
+    assert seg_map.seg.max() == 2 and seg_map.npix[2] == 25
+
+
+def test_sky_noise():
+    """Noise is only drawn for the masked pixels, and is reproducible."""
+    from kungpao import imtools
+
+    img = np.zeros((300, 300))
+    msk = np.zeros(img.shape, dtype=bool)
+    msk[100:200, 50:250] = True
+    sky = np.full(img.shape, 2.0)
+
+    noise = imtools.draw_noise(sky, 0.5, mask=msk, rng=3)
+    assert noise.dtype == np.float32 and noise.shape == (msk.sum(),)
+    assert np.isclose(noise.mean(), 2.0, atol=0.01)
+    assert np.isclose(noise.std(), 0.5, rtol=0.02)
+
+    img_new = imtools.img_replace_with_sky_noise(img, msk, sky, 0.5, rng=3)
+    assert np.array_equal(img_new[msk], noise)
+    assert np.all(img_new[~msk] == 0.0) and np.all(img == 0.0)
+
+
+def test_memory_mode():
+    """Float32, in-place mode gives the same mask from big-endian data."""
+    from kungpao import imtools
+
+    img, sig = _mock_image()
+    img_mask = imtools.img_obj_mask(img, sig=sig)
+
+    with imtools.memory_mode(float32=True, in_place=True):
+        img_clean, img_mask_32, _ = imtools.img_clean_and_mask(
+            img.astype('>f8'), sig=sig.astype('>f8'), rng=1)
+
+        seg = np.ones((5, 5), dtype=np.int32)
+        assert imtools.seg_remove_cen_obj(seg) is seg
+        assert seg.max() == 0
+
+    assert img_clean.dtype == np.float32
+    assert np.mean(img_mask == img_mask_32) > 0.99
+    # Back to the default mode
+    seg = np.ones((5, 5), dtype=np.int32)
+    assert imtools.seg_remove_cen_obj(seg).max() == 0 and seg.max() == 1
+
+
+def test_subtract_bright_stars():
+    """Subtract many Moffat stars from one image."""
+    from kungpao import imtools
+
+    rng = np.random.default_rng(2)
+    x, y = rng.uniform(30, 270, 8), rng.uniform(30, 270, 8)
+    amp = rng.uniform(50.0, 500.0, 8)
+
+    y_arr, x_arr = np.mgrid[:300, :300]
+    stars = sum(a * imtools.moffat_profile(x_arr, y_arr, xx, yy, 3.0, 2.5)
+                for a, xx, yy in zip(amp, x, y))
+    noise = rng.normal(scale=0.5, size=stars.shape)
+    img = stars + noise
+    catalog = {'x_pix': np.append(x, -10.0), 'y_pix': np.append(y, 10.0)}
+
+    # Only fit the amplitudes
+    img_new, params = imtools.img_subtract_bright_stars(
+        img, catalog, gamma=3.0, alpha=2.5, fit_shape=False, stamp_size=600,
+        return_params=True)
+    assert len(params) == 8 and np.all(params['success'])
+    assert np.allclose(params['amplitude'], amp, rtol=1e-2)
+    assert np.std(img_new - noise) < 0.05
+    assert np.std(img - stars - noise) < 1e-10
+
+    # Fit the shapes in parallel
+    img_fit = imtools.img_subtract_bright_stars(
+        img, catalog, gamma=4.0, alpha=3.0, stamp_size=100, n_proc=2)
+    assert np.std(img_fit - noise) < 0.2 * np.std(stars)
+
+
+def test_background_pyramid():
+    """Meshes from the pyramid agree with `sep.Background`."""
+    import sep
+    from kungpao import imtools
+
+    img, _ = _mock_image(size=400, n_gal=40)
+    y_arr, x_arr = np.mgrid[:400, :400]
+    img = (img + 0.05 * np.sin(x_arr / 80.0) + y_arr / 4000.0).astype(np.float32)
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[50:120, 250:330] = True
+
+    pyramid = imtools.BackgroundPyramid(img, mask=mask)
+    for bw, fw in [(20, 3), (60, 5), (150, 3)]:
+        bkg = pyramid.background(bw=bw, bh=bw, fw=fw, fh=fw)
+        bkg_sep = sep.Background(img, mask=mask, bw=bw, bh=bw, fw=fw, fh=fw)
+        assert bkg.back().dtype == np.float32
+        # The noise is 0.1
+        diff = np.abs(bkg.back() - bkg_sep.back())
+        assert np.median(diff) < 0.005 and np.percentile(diff, 99) < 0.025
+        assert np.allclose(bkg.rms(), bkg_sep.rms(), rtol=0.1)
+        assert pyramid.background(bw=bw, bh=bw, fw=fw, fh=fw) is bkg
+
+    back, rms = imtools.img_measure_background(img, pyramid=pyramid, bw=60, bh=60,
+                                               fw=5, fh=5)
+    assert np.array_equal(back, pyramid.background(60, 60, 5, 5).back())
+
+    # One warning for each mesh size that is not a multiple of the base size
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        pyramid.background(bw=25, bh=33)
+    assert len(caught) == 2
+
+
+def test_background_cache(monkeypatch):
+    """The photutils background of the same image is only measured once."""
+    from kungpao import imtools
+
+    n_calls, original = [], imtools.Background2D
+
+    def background_2d(*args, **kwargs):
+        n_calls.append(1)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(imtools, 'Background2D', background_2d)
+    imtools.clear_background_cache()
+
+    img, _ = _mock_image()
+    kwargs = {'use_sep': False, 'bkg': 'median', 'rms': 'mad', 'bw': 50, 'bh': 50}
+    back, rms = imtools.img_measure_background(img, **kwargs)
+    back[:] = 0.0
+    back_2, rms_2 = imtools.img_measure_background(img.copy(), **kwargs)
+    assert len(n_calls) == 1
+    assert np.array_equal(rms, rms_2) and not np.all(back_2 == 0.0)
+
+    imtools.img_measure_background(img + 1.0, **kwargs)
+    imtools.img_measure_background(img, fw=5, fh=5, **kwargs)
+    assert len(n_calls) == 3
+
+    previous = imtools.set_background_cache(0)
+    imtools.img_measure_background(img, **kwargs)
+    assert len(n_calls) == 4
+
+    # Room for one pair of maps, the older one is dropped
+    imtools.set_background_cache(16 * img.size)
+    imtools.img_measure_background(img + 1.0, **kwargs)
+    imtools.img_measure_background(img + 1.0, **kwargs)
+    assert len(n_calls) == 5
+    imtools.img_measure_background(img, **kwargs)
+    imtools.img_measure_background(img + 1.0, **kwargs)
+    assert len(n_calls) == 7
+    imtools.set_background_cache(previous)
+
+    # Sigma clipping until convergence
+    imtools.img_measure_background(img, maxiters=None, **kwargs)
+    assert len(n_calls) == 8
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from kungpao.mock import PSFConvolver, sersic_stamp, render_sersic_galaxies
+
+
+def test_render_sersic_galaxies():
+    """Flux and centroid of rendered galaxies are preserved."""
+    stamp, _ = sersic_stamp(50.3, 40.7, 1.0, 3.0, flux=1000.0, trunc=30)
+    assert np.isclose(stamp.sum(), 1000.0, rtol=1e-2)
+
+    y_psf, x_psf = np.mgrid[-12:13, -12:13]
+    psf = PSFConvolver(np.exp(-(x_psf ** 2 + y_psf ** 2) / 8.0))
+
+    img = render_sersic_galaxies(
+        (101, 101), [50.3, 20.0], [40.7, 80.0], 1.0, 3.0, [1000.0, 0.0],
+        psf=psf, trunc=30)
+    y_arr, x_arr = np.mgrid[:101, :101]
+
+    assert np.isclose(img.sum(), stamp.sum())
+    assert np.isclose((img * x_arr).sum() / img.sum(), 50.3, atol=1e-3)
+    assert np.isclose((img * y_arr).sum() / img.sum(), 40.7, atol=1e-3)
+
+    # Galaxy close to the edge
+    img_edge = render_sersic_galaxies((101, 101), [2.0], [99.0], 4.0, 5.0, 1000.0, psf=psf)
+    assert np.isfinite(img_edge).all() and img_edge.sum() < 1000.0
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from kungpao.model.component import Sersic, Sersic_jacobian, b_n, b_n_exact, db_n_dn
+
+
+def test_b_n():
+    """Compare the fast b_n solver to the exact one."""
+    n_arr = np.array([1.0, 2.0, 4.0, 8.0])
+
+    assert np.allclose(b_n(n_arr), b_n_exact(n_arr), rtol=1e-6)
+    assert np.isclose(b_n(0.5), np.log(2.0))
+    assert b_n(np.ones((3, 2))).shape == (3, 2)
+
+    rad = np.linspace(1.0, 100.0, 50)
+    assert np.allclose(Sersic(rad, 4.0, 1.0, 10.0),
+                       Sersic(rad, 4.0, 1.0, 10.0, exact=True), rtol=1e-6)
+
+
+def test_sersic_jacobian():
+    """Compare the analytic Jacobian to finite differences."""
+    rad = np.logspace(0, 2.2, 40)
+    theta = np.array([2.5, 50.0, 15.0])
+    step = 1e-6 * theta
+
+    jac_num = np.empty((len(rad), 3))
+    for i in range(3):
+        dtheta = np.zeros(3)
+        dtheta[i] = step[i]
+        jac_num[:, i] = (Sersic(rad, *(theta + dtheta)) -
+                         Sersic(rad, *(theta - dtheta))) / (2.0 * step[i])
+
+    assert np.allclose(Sersic_jacobian(rad, *theta), jac_num, rtol=1e-6)
+
+    # The derivative of n is finite at the center
+    with np.errstate(all='raise'):
+        jac_0 = Sersic_jacobian([0.0, 1.0, 2.0], 2.0, 1.0, 3.0)
+    assert np.all(np.isfinite(jac_0))
+    assert np.isclose(jac_0[0, 0], db_n_dn(2.0) * Sersic(0.0, 2.0, 1.0, 3.0))
+    assert np.isclose(db_n_dn(2.5), (b_n(2.5 + 1e-4) - b_n(2.5 - 1e-4)) / 2e-4)
+
+
+def test_map_fit():
+    """The MAP fit should recover the parameters of a mock profile."""
+    from kungpao.model.sersic_1d import map_fit_one_sersic, sersic_param_config
+
+    rad = np.logspace(0, 2.2, 40)
+    rho = Sersic(rad, 2.5, 50.0, 15.0)
+    err = 0.05 * rho
+
+    results = map_fit_one_sersic(rad, rho, err)
+    best = results['best'] * np.array([1.0, results['norm'], 1.0])
+
+    assert np.allclose(best, [2.5, 50.0, 15.0], rtol=1e-3)
+    assert not results['on_bound'].any()
+    assert np.all(np.isfinite(results['err'])) and np.all(results['err'] > 0)
+
+    # I_e is above the I0 prior, so there is no covariance matrix
+    param_config = sersic_param_config(rad, rho / results['norm'])
+    param_config['I0']['max'] = 0.5 * 50.0 / results['norm']
+    results = map_fit_one_sersic(rad, rho, err, param_config=param_config)
+
+    assert results['on_bound'][1]
+    assert np.all(np.isnan(results['cov']))
+
+
+def test_batch_ln_probability():
+    """The batched ln(probability) should match the one-walker version."""
+    from kungpao.model.sersic_1d import (
+        config_params, ln_probability, BatchLnProbability)
+
+    rad = np.logspace(0, 2.2, 40)
+    rho = Sersic(rad, 3.5, 50.0, 15.0)
+    err = 0.05 * rho
+
+    rho_norm, err_norm, params = config_params(rad, rho, err)
+    ln_prob = BatchLnProbability(params, rad, rho_norm, err_norm)
+
+    theta = params.sample(nsamples=20)
+    lnp_loop = np.array(
+        [ln_probability(t, params, rad, rho_norm, err_norm) for t in theta])
+
+    assert np.allclose(ln_prob(theta), lnp_loop)
+    assert np.isclose(ln_prob(theta[0]), lnp_loop[0])
+
+
+def test_priors():
+    """Compare the closed-form priors to scipy.stats."""
+    from scipy import stats
+    from kungpao.model.priors import TopHat, StudentT
+
+    x_arr = np.linspace(-2.0, 10.0, 101)
+    u_arr = np.linspace(0.0, 1.0, 11)
+
+    for prior, distr in [(TopHat(low=1.0, upp=8.0), stats.uniform(1.0, 7.0)),
+                         (StudentT(loc=3.0, scale=0.5), stats.t(1, 3.0, 0.5))]:
+        assert np.allclose(prior.lnp(x_arr), distr.logpdf(x_arr))
+        assert np.allclose(prior.unit_transform(u_arr), distr.ppf(u_arr))
+        assert np.allclose(prior.inverse_unit_transform(x_arr), distr.cdf(x_arr))
+
+    sample = StudentT(loc=3.0, scale=0.5).sample(1000, limit=True)
+    assert len(sample) == 1000
+    assert sample.min() >= 1.0 and sample.max() <= 5.0
+
+
+def test_psf_operator():
+    """Gaussian convolved with a Gaussian PSF is still a Gaussian."""
+    from kungpao.model.psf import PSFOperator1D
+
+    sig_psf, sig_prof = 1.5, 2.0
+    sig_conv = np.hypot(sig_psf, sig_prof)
+    rad = np.linspace(0.2, 6.0, 20)
+    expect = (sig_prof / sig_conv) ** 2 * np.exp(-rad ** 2 / (2.0 * sig_conv ** 2))
+
+    psf_rad = np.linspace(0.0, 20.0, 2001)
+    for psf in [PSFOperator1D(rad, psf_sigma=sig_psf, max_step=0.2),
+                PSFOperator1D(rad, max_step=0.2, psf_profile=(
+                    psf_rad, np.exp(-psf_rad ** 2 / (2.0 * sig_psf ** 2))))]:
+        conv = psf.convolve(np.exp(-psf.r_fine ** 2 / (2.0 * sig_prof ** 2)))
+        assert np.allclose(conv, expect, rtol=5e-3)
+
+    # A batch of models
+    assert psf.sersic(np.array([[2.0], [4.0]]), 1.0, 10.0).shape == (2, 20)
+
+
+def test_reinitialize_ball_covar():
+    """Re-initialized walkers are valid and reproducible with a seed."""
+    from kungpao.model.sersic_1d import update_params, reinitialize_ball_covar
+
+    params = update_params(np.array([3.5, 1.0, 15.0]), np.diag([0.3, 0.05, 2.0]) ** 2)
+    pos = params.sample(nsamples=64)
+    prob = np.linspace(-10.0, 0.0, 64)
+    kwargs = {'center': pos.mean(axis=0), 'disp_floor': 0.1, 'prior_check': params,
+              'limits': np.array([params.low, params.upp])}
+
+    pos_a = reinitialize_ball_covar(pos, prob, rng=np.random.default_rng(42), **kwargs)
+    pos_b = reinitialize_ball_covar(pos, prob, rng=42, **kwargs)
+
+    assert pos_a.shape == (64, 3)
+    assert np.array_equal(pos_a, pos_b)
+    assert np.all(np.isfinite(params.lnprior(pos_a)))
+
+
+def test_ln_prob_pool():
+    """The pool gives the same ln(probability) as the serial call."""
+    import pytest
+
+    from kungpao.model.pool import LnProbPool
+    from kungpao.model.sersic_1d import config_params, BatchLnProbability
+
+    rad = np.logspace(0, 2.2, 40)
+    rho = Sersic(rad, 3.5, 50.0, 15.0)
+    rho_norm, err_norm, params = config_params(rad, rho, 0.05 * rho)
+    ln_prob = BatchLnProbability(params, rad, rho_norm, err_norm)
+    theta = params.sample(nsamples=21)
+
+    with LnProbPool(2, ln_prob=ln_prob) as pool:
+        assert np.allclose(pool(theta), ln_prob(theta))
+        assert np.allclose(pool.map(np.sum, theta), theta.sum(axis=1))
+
+        # Both workers fail, and the pool still works afterwards
+        with pytest.raises(Exception, match="Worker process failed"):
+            pool.map(np.linalg.cholesky, [-np.eye(2)] * 4)
+        assert np.allclose(pool(theta), ln_prob(theta))
+
+
+def test_profile_model():
+    """Multi-component model and its cache."""
+    from kungpao.model.profile import ProfileModel, SersicComponent, ExponentialComponent
+
+    rad = np.logspace(0, 2.2, 40)
+    model = ProfileModel([SersicComponent(), ExponentialComponent(name='disk')])
+    assert model.names == ['n_1', 'I0_1', 'Re_1', 'I0_disk', 'h_disk']
+
+    theta = np.array([[4.0, 2.0, 5.0, 1.0, 30.0], [2.0, 1.0, 8.0, 0.5, 20.0]])
+    expect = Sersic(rad, theta[:, 0:1], theta[:, 1:2], theta[:, 2:3]) + (
+        theta[:, 3:4] * np.exp(-rad / theta[:, 4:5]))
+    assert np.allclose(model(rad, theta), expect)
+
+    # Only the amplitude of the first model changes
+    theta[0, 1] = 3.0
+    expect[0] = Sersic(rad, 4.0, 3.0, 5.0) + np.exp(-rad / 30.0)
+    assert np.allclose(model(rad, theta), expect)
+    assert np.allclose(model(rad, theta[1]), expect[1])
+
+
+def test_chain_diagnostics():
+    """Vectorized autocorrelation time and R-hat."""
+    from emcee.autocorr import integrated_time
+    from kungpao.model.diagnostics import autocorr_time, gelman_rubin
+
+    rng = np.random.default_rng(1)
+    chains = rng.normal(size=(32, 2000, 2))
+    # AR(1) process for the second parameter
+    for step in range(1, chains.shape[1]):
+        chains[:, step, 1] += 0.9 * chains[:, step - 1, 1]
+
+    assert np.allclose(autocorr_time(chains),
+                       integrated_time(chains.transpose(1, 0, 2), quiet=True))
+    assert np.all(np.abs(gelman_rubin(chains) - 1.0) < 0.02)
+
+    chains[:16] += 3.0
+    assert np.all(gelman_rubin(chains) > 1.1)
+
+
+def test_batch_fit(tmp_path, capsys):
+    """A serial batch run, and a resume after an interruption and a failure."""
+    import pytest
+
+    from kungpao.model.batch import batch_fit_sersic, read_batch_results
+
+    rad = np.logspace(0, 2.2, 40)
+    n_ser = np.array([1.5, 2.5, 4.0])
+    rho = Sersic(rad, n_ser[:, np.newaxis], 50.0, 15.0)
+    rho[1] = np.nan
+    err = 0.05 * rho
+    names = ['gal a', 'gal "b"', 'gal c']
+    output = str(tmp_path / 'fits.txt')
+
+    results = batch_fit_sersic(rad, rho, err, output, names=names, verbose=False)
+
+    # The failed fit is only in the log
+    assert list(results['index']) == [0, 2]
+    assert list(results['name']) == ['gal a', 'gal c']
+    assert np.allclose(results['n'], n_ser[[0, 2]], rtol=1e-3)
+    assert np.all(results['flag'] == 0)
+    with open(output + '.log') as log:
+        assert log.read().startswith('1 "gal \\"b\\"" ValueError')
+
+    # Interrupt the run in the middle of the second row
+    with open(output) as f:
+        lines = f.readlines()
+    with open(output, 'w') as f:
+        f.writelines(lines[:2] + [lines[2][:20]])
+
+    # Reading does not change the file
+    assert len(read_batch_results(output)) == 1
+    with open(output) as f:
+        assert f.read().endswith(lines[2][:20])
+
+    rho[1] = Sersic(rad, n_ser[1], 50.0, 15.0)
+    err = 0.05 * rho
+    results = batch_fit_sersic(rad, rho, err, output, names=names)
+
+    assert "Will fit 2 profiles, 1 already done" in capsys.readouterr().out
+    assert list(results['index']) == [0, 1, 2]
+    assert results['name'][1] == 'gal "b"'
+    assert np.allclose(results['n'], n_ser, rtol=1e-3)
+    assert len(read_batch_results(output)) == 3
+
+    # A different input set can not be resumed
+    with pytest.raises(Exception, match="input has changed"):
+        batch_fit_sersic(rad, rho[1:], err[1:], output, names=names[1:], verbose=False)
+    with pytest.raises(Exception, match="input has changed"):
+        batch_fit_sersic(rad, rho[:2], err[:2], output, names=names[:2], verbose=False)
+
+    # Wrong fitting options are not fit failures
+    with pytest.raises(TypeError):
+        batch_fit_sersic(rad, rho, err, output, resume=False, verbose=False, bogus=1)
+
+
+def _gaussian_ln_prob(theta):
+    """ln(probability) of a 2-D unit Gaussian."""
+    return -0.5 * np.sum(theta ** 2)
+
+
+def test_chain_store(tmp_path):
+    """The compact backend stores the same chain as the default one."""
+    import emcee
+    from kungpao.model.chains import ChainStore, chain_summary
+
+    initial = np.random.default_rng(2).normal(size=(8, 2))
+    chain_file = str(tmp_path / 'chain.npy')
+
+    chains = []
+    for backend in (None, ChainStore(), ChainStore(filename=chain_file)):
+        sampler = emcee.EnsembleSampler(8, 2, _gaussian_ln_prob, backend=backend)
+        sampler._random = np.random.mtrand.RandomState(3)
+        # Two runs, so the chain has to grow
+        state = sampler.run_mcmc(initial, 30)
+        sampler.run_mcmc(state, 20)
+        chains.append(sampler.get_chain())
+
+    assert chains[1].dtype == np.float32
+    assert np.allclose(chains[1], chains[0], rtol=1e-6)
+    assert np.array_equal(chains[2], chains[1])
+    assert np.array_equal(np.load(chain_file), chains[1])
+    assert np.array_equal(backend.summary()['best'],
+                          chain_summary(chains[1], sampler.get_log_prob())['best'])
+
+    # Trimming only drops the steps that have not been sampled
+    backend.grow(100, None)
+    assert np.load(chain_file, mmap_mode='r').shape == (150, 8, 2)
+    backend.trim()
+    assert np.array_equal(np.load(chain_file), chains[1])
+    assert np.array_equal(backend.get_chain(), chains[1])
+
+
+def test_run_until_converged(tmp_path):
+    """Early stopping leaves only the sampled steps in the chain file."""
+    import pytest
+    import emcee
+    from kungpao.model.chains import ChainStore, run_until_converged
+
+    initial = np.random.default_rng(2).normal(size=(16, 2))
+    chain_file = str(tmp_path / 'chain.npy')
+
+    sampler = emcee.EnsembleSampler(
+        16, 2, _gaussian_ln_prob, backend=ChainStore(filename=chain_file))
+    sampler._random = np.random.mtrand.RandomState(3)
+    _, diag = run_until_converged(sampler, initial, 2000, n_eff=300, thin=2)
+
+    assert diag['converged']
+    assert diag['n_step'] < 2000
+    assert diag['n_step'] == diag['history'][-1, 0]
+    assert diag['history'][-1, 2] >= 300
+    assert np.load(chain_file).shape == (diag['n_step'] // 2, 16, 2)
+    assert np.array_equal(np.load(chain_file), sampler.get_chain())
+
+    with pytest.raises(Exception, match="multiple of thin"):
+        run_until_converged(sampler, initial, 2001, thin=2)
+
+
+def test_dynesty_fit():
+    """Nested sampling should recover the parameters of a mock profile."""
+    import pytest
+    pytest.importorskip('dynesty')
+    from kungpao.model.sersic_1d import dynesty_fit_one_sersic, norm_prof
+
+    rad = np.logspace(0, 2.2, 40)
+    rho = Sersic(rad, 2.5, 50.0, 15.0)
+    norm, _, _ = norm_prof(rad, rho)
+
+    results = dynesty_fit_one_sersic(
+        rad, rho, 0.05 * rho, nlive=100, dlogz=0.5, verbose=False,
+        rstate=np.random.default_rng(4))
+    low, med, upp = results['percentiles']
+
+    assert np.all(low < [2.5, 50.0 / norm, 15.0]) and np.all(upp > [2.5, 50.0 / norm, 15.0])
+    assert np.isclose(med[0], 2.5, atol=0.1)
+    assert np.isfinite(results['logz'])
+
+
+def test_sersic_grid():
+    """The grid posterior should agree with the MAP fit of mock profiles."""
+    from scipy.special import logsumexp
+    from kungpao.model.grid import SersicGrid
+    from kungpao.model.sersic_1d import map_fit_one_sersic
+
+    rad = np.logspace(0, 2.2, 40)
+    n_ser = np.array([1.5, 2.5, 4.0])
+    rho = Sersic(rad, n_ser[:, np.newaxis], 50.0, 15.0)
+    err = 0.05 * rho
+    rho_noisy = rho + np.random.default_rng(5).normal(size=rho.shape) * err
+
+    grid = SersicGrid(rad)
+    results = grid.fit(rho_noisy, err, percentiles=(0.5, 50, 99.5),
+                       return_posterior=True)
+    assert results['posterior'].shape == (3,) + grid.shape
+
+    for ii in range(3):
+        fit = map_fit_one_sersic(rad, rho_noisy[ii], err[ii])
+        step = np.diff(grid.n_grid)[0]
+        assert abs(results['best'][ii, 0] - fit['best'][0]) <= step
+        low, _, upp = results['percentiles'][ii, :, 0]
+        assert low - step < n_ser[ii] < upp + step
+        assert np.isclose(results['mean'][ii, 0], fit['best'][0],
+                          atol=2.0 * fit['err'][0])
+
+    # The analytic marginalization of I0 at one grid point
+    rho_norm, err_norm, _ = grid.normalize(rho_noisy[1], err[1])
+    ln_like, i0_best, _ = grid.ln_likelihood(rho_norm, err_norm)
+    i0 = np.linspace(0.0, 2.0 * i0_best[0, 1000], 20001)[1:]
+    chi2 = np.sum(((rho_norm[0, grid.flag] - i0[:, None] * grid.templates[1000]) /
+                   err_norm[0, grid.flag]) ** 2, axis=1)
+    ln_num = logsumexp(-0.5 * chi2) + np.log(i0[1] - i0[0]) - 0.5 * np.log(2.0 * np.pi)
+    assert np.isclose(ln_like[0, 1000], ln_num, atol=1e-3)
+
+
+def test_batch_fit_pool(tmp_path):
+    """The process pool gives the same results as the serial run."""
+    from kungpao.model.batch import batch_fit_sersic
+
+    rad = np.logspace(0, 2.2, 40)
+    n_ser = np.linspace(1.0, 5.0, 7)
+    rho = Sersic(rad, n_ser[:, np.newaxis], 50.0, 15.0)
+    names = ['galaxy_%03d_' % ii + 'x' * 150 for ii in range(7)]
+
+    serial = batch_fit_sersic(rad, rho, 0.05 * rho, str(tmp_path / 'serial.txt'),
+                              names=names, verbose=False)
+    pool = batch_fit_sersic(rad, rho, 0.05 * rho, str(tmp_path / 'pool.txt'),
+                            names=names, n_proc=2, chunksize=2, verbose=False)
+    pool = np.sort(pool, order='index')
+
+    assert list(pool['name']) == names
+    assert np.array_equal(pool['index'], serial['index'])
+    assert np.allclose(pool['n'], serial['n'])
+    assert np.allclose(pool['n'], n_ser, rtol=1e-3)
+
+
+def test_emcee_fit(tmp_path):
+    """Thinned emcee run, and the chain is saved once."""
+    import pytest
+    from kungpao.model.sersic_1d import emcee_fit_one_sersic
+
+    rad = np.logspace(0, 2.2, 40)
+    rho = Sersic(rad, 2.5, 50.0, 15.0)
+    output = str(tmp_path / 'fit.npz')
+
+    results, burnin = emcee_fit_one_sersic(
+        rad, rho, 0.05 * rho, n_walkers=16, n_burnin=20, n_samples=30, thin=2,
+        output=output, verbose=False, rng=6)
+    assert burnin['chains'].shape == (16, 10, 3)
+    assert results['chains'].shape == (16, 15, 3)
+
+    saved = np.load(output)
+    assert 'samples' not in saved.files
+    assert np.array_equal(saved['chains'].swapaxes(0, 1).reshape(-1, 3),
+                          results['samples'])
+
+    with pytest.raises(Exception, match="multiples of thin"):
+        emcee_fit_one_sersic(rad, rho, 0.05 * rho, n_walkers=16, n_burnin=20,
+                             n_samples=25, thin=2, verbose=False)